@@ -0,0 +1,324 @@
+"""Columnar mirror of stock_movements and items for reporting aggregates.
+
+Movements are append-only Parquet parts next to the database, each holding
+the rows past the previous high-water mark; items are a Parquet snapshot.
+The refresh_analytics job keeps the mirror current and it can be run by hand:
+
+    python analytics.py --db inventory.db              # append new movements
+    python analytics.py --db inventory.db --rebuild    # rewrite from scratch
+
+aggregate_movements() answers group-bys from the mirror plus the few rows
+written since its high-water mark, and from SQLite alone while there is no
+mirror. pyarrow is optional; without it every aggregate runs on SQLite. Like
+month_end, this module needs no Streamlit so worker processes can use it.
+"""
+
+import argparse
+import calendar
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Bumped whenever the mirrored columns change; an older mirror is rebuilt
+MIRROR_VERSION = 1
+MOVEMENT_COLUMNS = ['id', 'item_id', 'branch_id', 'movement_type', 'quantity', 'unit_cost', 'stock_delta', 'ts', 'user_id',
+                    'from_branch_id', 'to_branch_id']
+ITEM_COLUMNS = ['item_id', 'branch_id', 'name', 'category', 'unit', 'current_stock', 'reserved_stock', 'min_stock',
+                'cost_per_unit']
+# Rows per refresh read and per Parquet row group; ts statistics let filters skip whole groups
+REFRESH_CHUNK = 500000
+ROW_GROUP_SIZE = 131072
+# Small parts are merged into one once there are more than this many
+COMPACT_PARTS = 16
+COMPACT_ROWS = 1000000
+
+GROUP_KEYS = ('branch_id', 'item_id', 'movement_type', 'user_id', 'other_branch_id', 'category', 'day', 'month')
+METRICS = ['quantity', 'value', 'stock_delta', 'movements']
+
+# ===============================
+# MIRROR FILES
+# ===============================
+
+def mirror_available():
+    """Whether pyarrow is installed, which the mirror needs"""
+    return pa is not None
+
+def mirror_dir(db_path):
+    """Directory holding the mirror of a database"""
+    return os.path.splitext(os.path.abspath(db_path))[0] + "_analytics"
+
+def read_manifest(directory):
+    """The mirror's manifest, or None when there is no usable mirror"""
+    try:
+        with open(os.path.join(directory, "manifest.json")) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return manifest if manifest.get('version') == MIRROR_VERSION else None
+
+def write_manifest(directory, manifest):
+    """Swap in a new manifest atomically; readers see either the old file set or the new one"""
+    path = os.path.join(directory, "manifest.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+def open_read_only(db_path):
+    """Read-only connection; the mirror never takes the write lock"""
+    return sqlite3.connect(f"file:{os.path.abspath(db_path)}?mode=ro", uri=True)
+
+def movement_schema():
+    return pa.schema([('id', pa.int64()), ('item_id', pa.string()), ('branch_id', pa.int64()),
+                      ('movement_type', pa.string()), ('quantity', pa.float64()), ('unit_cost', pa.float64()),
+                      ('stock_delta', pa.float64()), ('ts', pa.int64()), ('user_id', pa.string()),
+                      ('from_branch_id', pa.int64()), ('to_branch_id', pa.int64())])
+
+def write_part(directory, table):
+    """Write movement rows to a new part file named after their id range, returns its manifest entry"""
+    ids = table.column('id')
+    name = f"movements-{pc.min(ids).as_py():012d}-{pc.max(ids).as_py():012d}.parquet"
+    pq.write_table(table, os.path.join(directory, name + ".tmp"), row_group_size=ROW_GROUP_SIZE)
+    os.replace(os.path.join(directory, name + ".tmp"), os.path.join(directory, name))
+    return {'file': name, 'rows': table.num_rows, 'first_id': pc.min(ids).as_py(), 'last_id': pc.max(ids).as_py()}
+
+def compact_parts(directory, parts):
+    """Merge the small parts into one once there are too many, returns the new part list"""
+    small = [part for part in parts if part['rows'] < COMPACT_ROWS]
+    if len(parts) <= COMPACT_PARTS or len(small) < 2:
+        return parts
+    merged = pa.concat_tables(pq.read_table(os.path.join(directory, part['file'])) for part in small)
+    return [part for part in parts if part['rows'] >= COMPACT_ROWS] + [write_part(directory, merged)]
+
+def refresh_mirror(db_path, rebuild=False):
+    """Append the movements past the high-water mark and re-snapshot items, returns stats.
+
+    Movements are append-only, so only rows with a higher id are read. The
+    rare deletion (removing an item) shows up as fewer rows under the mark
+    than the mirror holds, and the mirror is rebuilt.
+    """
+    if pa is None:
+        raise RuntimeError("The analytics mirror needs pyarrow")
+    started = time.perf_counter()
+    directory = mirror_dir(db_path)
+    os.makedirs(directory, exist_ok=True)
+    manifest = None if rebuild else read_manifest(directory)
+    conn = open_read_only(db_path)
+    try:
+        if manifest is not None:
+            under_mark = conn.execute("SELECT COUNT(*) FROM stock_movements WHERE id <= ?", (manifest['high_water'],)).fetchone()[0]
+            if under_mark != sum(part['rows'] for part in manifest['parts']):
+                manifest, rebuild = None, True
+        parts = [] if manifest is None else list(manifest['parts'])
+        high_water = 0 if manifest is None else manifest['high_water']
+
+        appended = 0
+        schema = movement_schema()
+        for chunk in pd.read_sql_query(f"SELECT {', '.join(MOVEMENT_COLUMNS)} FROM stock_movements WHERE id > ? ORDER BY id",
+                                       conn, params=(high_water,), chunksize=REFRESH_CHUNK,
+                                       dtype={'branch_id': 'Int64', 'from_branch_id': 'Int64', 'to_branch_id': 'Int64',
+                                              'ts': 'Int64', 'quantity': float, 'unit_cost': float, 'stock_delta': float}):
+            if chunk.empty:
+                continue
+            parts.append(write_part(directory, pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)))
+            high_water = parts[-1]['last_id']
+            appended += len(chunk)
+
+        items = pd.read_sql_query(f"SELECT id as item_id, {', '.join(ITEM_COLUMNS[1:])} FROM items", conn)
+    finally:
+        conn.close()
+
+    pq.write_table(pa.Table.from_pandas(items, preserve_index=False), os.path.join(directory, "items.parquet.tmp"))
+    os.replace(os.path.join(directory, "items.parquet.tmp"), os.path.join(directory, "items.parquet"))
+    parts = compact_parts(directory, parts)
+    write_manifest(directory, {'version': MIRROR_VERSION, 'high_water': high_water, 'parts': parts,
+                               'refreshed_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
+
+    # Parts no longer listed are dropped once the new manifest is in place
+    listed = {part['file'] for part in parts} | {"items.parquet", "manifest.json"}
+    for name in os.listdir(directory):
+        if name not in listed:
+            os.remove(os.path.join(directory, name))
+
+    return {'appended': appended, 'rows': sum(part['rows'] for part in parts), 'parts': len(parts),
+            'high_water': high_water, 'rebuilt': rebuild or manifest is None, 'seconds': round(time.perf_counter() - started, 3)}
+
+def drop_mirror(db_path):
+    """Remove the mirror; aggregates fall back to SQLite until the next refresh"""
+    shutil.rmtree(mirror_dir(db_path), ignore_errors=True)
+
+# ===============================
+# AGGREGATES
+# ===============================
+
+def day_epoch(day):
+    """stock_movements.ts at midnight of a YYYY-MM-DD day"""
+    return calendar.timegm(datetime.strptime(day[:10], "%Y-%m-%d").timetuple())
+
+def aggregate_mirror(directory, manifest, keys, start_ts, end_ts, branch_id, movement_types, categories=None):
+    """Group-by over the Parquet parts; days and months are grouped as integers.
+
+    categories maps item_id to category (a frame of both) when grouping by
+    category; it comes from the live catalog so a recategorised item is never
+    split between the mirror and the tail.
+    """
+    dataset = ds.dataset([os.path.join(directory, part['file']) for part in manifest['parts']], format="parquet")
+    conditions = []
+    if start_ts is not None:
+        conditions += [pc.field('ts') >= start_ts, pc.field('ts') < end_ts]
+    if branch_id is not None:
+        conditions.append(pc.field('branch_id') == int(branch_id))
+    if movement_types:
+        conditions.append(pc.field('movement_type').isin(list(movement_types)))
+    condition = None
+    for term in conditions:
+        condition = term if condition is None else condition & term
+
+    wanted = {'quantity', 'unit_cost', 'stock_delta'} | set(keys) - {'day', 'month', 'category', 'other_branch_id'}
+    if {'day', 'month'} & set(keys):
+        wanted.add('ts')
+    if 'category' in keys:
+        wanted.add('item_id')
+    if 'other_branch_id' in keys:
+        wanted |= {'movement_type', 'from_branch_id', 'to_branch_id'}
+    table = dataset.to_table(columns=sorted(wanted), filter=condition)
+
+    derived = {}
+    if 'day' in keys:
+        derived['day'] = pc.divide(table.column('ts'), 86400)
+    if 'month' in keys:
+        moments = pc.cast(table.column('ts'), pa.timestamp('s'))
+        derived['month'] = pc.add(pc.multiply(pc.year(moments), 12), pc.subtract(pc.month(moments), 1))
+    if 'category' in keys:
+        positions = pc.index_in(table.column('item_id'), value_set=pa.array(categories['item_id'], pa.string()))
+        derived['category'] = pc.take(pa.array(categories['category'], pa.string()), positions)
+    if 'other_branch_id' in keys:
+        derived['other_branch_id'] = pc.if_else(pc.equal(table.column('movement_type'), 'TRANSFER_OUT'),
+                                                table.column('to_branch_id'), table.column('from_branch_id'))
+    derived['value'] = pc.multiply(table.column('quantity'), pc.coalesce(table.column('unit_cost'), 0.0))
+    for name, column in derived.items():
+        table = table.drop_columns([name]) if name in table.column_names else table
+        table = table.append_column(name, column)
+
+    grouped = table.group_by(list(keys)).aggregate([('quantity', 'sum'), ('value', 'sum'), ('stock_delta', 'sum'),
+                                                    ('quantity', 'count')])
+    return grouped.to_pandas().rename(columns={'quantity_sum': 'quantity', 'value_sum': 'value',
+                                               'stock_delta_sum': 'stock_delta', 'quantity_count': 'movements'})
+
+def aggregate_sqlite(conn, keys, start_ts, end_ts, branch_id, movement_types, after_id=0):
+    """The same group-by straight from stock_movements, for rows past after_id"""
+    expressions = {'day': "sm.ts / 86400",
+                   'month': "CAST(strftime('%Y', sm.ts, 'unixepoch') AS INTEGER) * 12 + CAST(strftime('%m', sm.ts, 'unixepoch') AS INTEGER) - 1",
+                   'category': "c.category",
+                   'other_branch_id': "CASE WHEN sm.movement_type = 'TRANSFER_OUT' THEN sm.to_branch_id ELSE sm.from_branch_id END"}
+    columns = [f"{expressions.get(key, 'sm.' + key)} as {key}" for key in keys]
+    query = f'''SELECT {', '.join(columns + ['SUM(sm.quantity) as quantity', 'SUM(sm.quantity * COALESCE(sm.unit_cost, 0)) as value',
+                                           'SUM(sm.stock_delta) as stock_delta', 'COUNT(*) as movements'])}
+                FROM stock_movements sm
+                {"LEFT JOIN item_catalog c ON c.id = sm.item_id" if 'category' in keys else ""}
+                WHERE sm.id > ?'''
+    params = [after_id]
+    if start_ts is not None:
+        query += " AND sm.ts >= ? AND sm.ts < ?"
+        params += [start_ts, end_ts]
+    if branch_id is not None:
+        query += " AND sm.branch_id = ?"
+        params.append(int(branch_id))
+    if movement_types:
+        query += f" AND sm.movement_type IN ({', '.join('?' * len(movement_types))})"
+        params += list(movement_types)
+    if keys:
+        query += f" GROUP BY {', '.join(keys)}"
+    return pd.read_sql_query(query, conn, params=params)
+
+def aggregate_movements(db_path, group_by=(), start=None, end=None, branch_id=None, movement_types=None):
+    """Movement quantity, value, stock change and count per group, routed to the mirror when there is one.
+
+    group_by takes any of GROUP_KEYS; start and end are YYYY-MM-DD days, end
+    exclusive. The mirror answers for rows up to its high-water mark and
+    SQLite only reads the rows written since, so results are always current.
+    The source used is in result.attrs['source'].
+    """
+    group_by = list(dict.fromkeys(group_by))
+    unknown = set(group_by) - set(GROUP_KEYS)
+    if unknown:
+        raise ValueError(f"Cannot group movements by {', '.join(sorted(unknown))}")
+    start_ts = day_epoch(start) if start else None
+    end_ts = day_epoch(end) if end else 2 ** 62
+    if start_ts is None and end:
+        start_ts = 0
+
+    directory = mirror_dir(db_path)
+    manifest = read_manifest(directory) if pa is not None else None
+    frames, source = [], 'sqlite'
+    conn = open_read_only(db_path)
+    try:
+        if manifest is not None:
+            categories = (pd.read_sql_query("SELECT id as item_id, category FROM item_catalog", conn)
+                          if 'category' in group_by else None)
+            try:
+                frames.append(aggregate_mirror(directory, manifest, group_by, start_ts, end_ts, branch_id, movement_types,
+                                               categories))
+                source = 'mirror'
+            except (OSError, pa.ArrowException):
+                # A refresh swapped the parts underneath us; SQLite answers this one
+                manifest = None
+        frames.append(aggregate_sqlite(conn, group_by, start_ts, end_ts, branch_id, movement_types,
+                                       manifest['high_water'] if manifest is not None else 0))
+    finally:
+        conn.close()
+
+    result = pd.concat([frame for frame in frames if not frame.empty] or frames[-1:], ignore_index=True)
+    if group_by:
+        # NULL keys first, as SQLite's ORDER BY puts them
+        result = result.groupby(group_by, as_index=False, dropna=False)[METRICS].sum()
+        result = result.sort_values(group_by, na_position='first')
+    else:
+        # Concatenated frames may hold object columns; totals are floats whatever the source
+        result = result[METRICS].sum().to_frame().T.astype(float)
+    result = result.reset_index(drop=True)
+    result['movements'] = result['movements'].astype('int64')
+    if 'day' in group_by:
+        result['day'] = pd.to_datetime(result['day'].astype('int64'), unit='D').dt.strftime("%Y-%m-%d")
+    if 'month' in group_by:
+        months = result['month'].astype('int64')
+        result['month'] = [f"{month // 12:04d}-{month % 12 + 1:02d}" for month in months]
+    result.attrs['source'] = source
+    return result
+
+# ===============================
+# COMMAND LINE
+# ===============================
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Refresh the columnar analytics mirror")
+    parser.add_argument("--db", default="inventory.db", help="Inventory database")
+    parser.add_argument("--rebuild", action="store_true", help="Rewrite the mirror from scratch")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    config = parse_args(argv)
+    if not os.path.exists(config.db):
+        sys.exit(f"Database not found: {config.db}")
+    if pa is None:
+        sys.exit("The analytics mirror needs pyarrow (pip install pyarrow)")
+
+    stats = refresh_mirror(config.db, config.rebuild)
+    print(f"{'Rebuilt' if stats['rebuilt'] else 'Refreshed'} {mirror_dir(config.db)}: {stats['appended']} new movements, "
+          f"{stats['rows']} in {stats['parts']} parts up to id {stats['high_water']}, in {stats['seconds']}s")
+
+if __name__ == "__main__":
+    main()
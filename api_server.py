@@ -0,0 +1,588 @@
+"""JSON HTTP API over the inventory core for scanners, POS terminals and integrations.
+
+Runs on the standard library only and calls the same functions as the
+Streamlit UI, so stock changes still go through the single writer and show
+up in the UI and the change feed:
+
+    python api_server.py --port 8502
+
+Requests authenticate with HTTP Basic using the app's users. Viewers only
+see final products: their items, stock, movements and events are filtered,
+and routes covering every item answer 403. GET responses carry an ETag
+built from the change feed high-water mark; send it back in If-None-Match
+to get 304 Not Modified until stock changes.
+
+    GET  /health
+    GET  /branches
+    GET  /items?branch_id=&category=
+    GET  /stock?branch_id=&item_id=
+    POST /stock/lookup         {"items": [{"item_id": ..., "branch_id": ...}, ...]}
+    GET  /movements?branch_id=&item_id=&limit=
+    GET  /events?after=&timeout=&limit=
+    POST /movements            {"item_id", "branch_id", "quantity", "movement_type", ...}
+    POST /movements/batch      {"movements": [{...}, ...]}
+    POST /transfers            {"item_id", "from_branch_id", "to_branch_id", "quantity", "reference", "correction": false}
+    GET  /shipments?branch_id=&direction=inbound&status=OPEN
+    GET  /in-transit?branch_id=
+    POST /shipments            {"from_branch_id", "to_branch_id", "lines": [{"item_id", "quantity"}, ...], "reference"}
+    POST /shipments/receive    {"shipment_id", "lines": [{"item_id", "quantity"}, ...]}
+    POST /shipments/close      {"shipment_ids": [...]}
+    POST /production           {"product_id", "branch_id", "quantity", ...}
+    POST /sync                 {"device_id", "scans": [{"client_id", "type", "item_id", ...}, ...]}
+    GET  /reservations?branch_id=&status=&reference=
+    POST /reservations         {"reference", "branch_id", "lines": [{"item_id", "quantity"}, ...], "kind": "ORDER"}
+    POST /reservations/release {"reference"}
+    POST /reservations/fulfil  {"reference"}
+    POST /counts/lines         {"session_id", "lines": [{"item_id", "quantity"}, ...], "mode": "add"}
+    GET  /counts/variances?session_id=
+    GET  /schedule?branch_id=&status=PLANNED
+    POST /schedule             {"runs": [{"final_product_id", "branch_id", "quantity", "due_date", "reference"}, ...]}
+    GET  /mrp?branch_id=&freq=W&lead_time_days=0&horizon_days=
+    GET  /analytics/movements?group_by=month,movement_type&days=365&branch_id=&movement_types=OUT,ADMIN_OUT
+"""
+
+import argparse
+import base64
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import analytics
+import inventory_app as app
+
+# Seconds a verified Basic credential is trusted before checking the users table again
+AUTH_TTL = 300
+
+WRITE_ROLES = ("warehouse_manager", "admin")
+MOVEMENT_TYPES = ("IN", "OUT", "ADMIN_IN", "ADMIN_OUT")
+MAX_BATCH = 500
+MAX_SYNC = 10000
+
+# ===============================
+# CONNECTION POOL
+# ===============================
+
+class ConnectionPool:
+    """Fixed set of read connections shared by the request threads"""
+
+    def __init__(self, db_path, size=8):
+        self._pool = queue.Queue()
+        for _ in range(size):
+            conn = app.get_connection(db_path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            self._pool.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._pool.put(conn)
+
+# ===============================
+# REQUEST HANDLING
+# ===============================
+
+def records(df):
+    """DataFrame rows as JSON-safe dicts (NaN becomes null)"""
+    return df.astype(object).where(df.notna(), None).to_dict(orient="records")
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class InventoryApiHandler(BaseHTTPRequestHandler):
+    """Routes requests to the inventory core; one instance per request"""
+
+    protocol_version = "HTTP/1.1"
+    server_version = "InventoryAPI/1.0"
+
+    # Set by serve()
+    pool = None
+    auth_cache = {}
+    auth_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        logging.getLogger("inventory.api").debug("%s - %s", self.address_string(), format % args)
+
+    # ---- plumbing ----
+
+    def send_json(self, status, payload, etag=None):
+        body = json.dumps(payload, default=str).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if etag:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        try:
+            return json.loads(self.body or b"{}")
+        except ValueError:
+            raise ApiError(400, "Body is not valid JSON")
+
+    def authenticate(self):
+        """Resolve the Basic credentials to (username, role)"""
+        header = self.headers.get("Authorization", "")
+        if not header.startswith("Basic "):
+            raise ApiError(401, "Basic authentication required")
+
+        now = time.time()
+        with self.auth_lock:
+            cached = self.auth_cache.get(header)
+        if cached and cached[2] > now:
+            return cached[0], cached[1]
+
+        try:
+            username, password = base64.b64decode(header[6:]).decode().split(":", 1)
+        except ValueError:
+            raise ApiError(401, "Malformed credentials")
+        result = app.authenticate_user(username, password)
+        if not result:
+            raise ApiError(401, "Invalid username or password")
+        with self.auth_lock:
+            self.auth_cache[header] = (username, result[0], now + AUTH_TTL)
+        return username, result[0]
+
+    def current_etag(self):
+        """Weak validator that changes whenever stock or the shared snapshot changes"""
+        with self.pool.connection() as conn:
+            seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM stock_events").fetchone()[0]
+        return f'W/"{seq}.{app.get_data_hub().current_generation()}"'
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        # Drain the body before anything can fail so a keep-alive connection stays in sync
+        self.body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        try:
+            username, role = self.authenticate()
+            route = self.ROUTES.get((method, url.path.rstrip("/") or "/"))
+            if route is None:
+                raise ApiError(404, f"No route for {method} {url.path}")
+            handler, conditional = route
+
+            if conditional:
+                etag = self.current_etag()
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_json(200, handler(self, query, username, role), etag)
+            else:
+                self.send_json(200, handler(self, query, username, role))
+        except ApiError as e:
+            self.send_json(e.status, {'error': str(e)})
+        except Exception as e:
+            logging.getLogger("inventory.api").exception("Request failed")
+            self.send_json(500, {'error': str(e)})
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def require_write(self, role):
+        if role not in WRITE_ROLES:
+            raise ApiError(403, "This user may not change stock")
+
+    def require_full_read(self, role):
+        """Viewers only see final products, so routes that cover every item are closed to them"""
+        if role == "viewer":
+            raise ApiError(403, "Viewers may only read final products")
+
+    # ---- reads ----
+
+    def get_health(self, query, username, role):
+        return {'status': 'ok', 'etag': self.current_etag()}
+
+    def get_branches(self, query, username, role):
+        return records(app.get_data_hub().get_branches())
+
+    def get_items(self, query, username, role):
+        items_df = app.get_data_hub().get_items(role, query.get('branch_id'))
+        if query.get('category'):
+            items_df = items_df[items_df['category'] == query['category']]
+        return records(items_df)
+
+    def get_stock(self, query, username, role):
+        items_df = app.get_data_hub().get_items(role, query.get('branch_id'))
+        if query.get('item_id'):
+            items_df = items_df[items_df['id'] == query['item_id']]
+        return records(items_df[['id', 'branch_id', 'current_stock', 'reserved_stock', 'available_stock', 'min_stock', 'unit']])
+
+    def post_stock_lookup(self, query, username, role):
+        """Batch: levels for many (item, branch) pairs in one round trip"""
+        wanted = self.read_json().get('items', [])[:MAX_BATCH]
+        items_df = app.get_data_hub().get_items(role).set_index(['id', 'branch_id'])
+        results = []
+        for entry in wanted:
+            key = (entry.get('item_id'), int(entry.get('branch_id', 0)))
+            if key in items_df.index:
+                row = items_df.loc[key]
+                results.append({'item_id': key[0], 'branch_id': key[1], 'current_stock': row['current_stock'],
+                                 'reserved_stock': row['reserved_stock'], 'available_stock': row['available_stock'],
+                                 'min_stock': row['min_stock'], 'unit': row['unit']})
+            else:
+                results.append({'item_id': key[0], 'branch_id': key[1], 'error': 'not found'})
+        return results
+
+    def get_movements(self, query, username, role):
+        sql = "SELECT * FROM stock_movements WHERE 1 = 1"
+        params = []
+        if role == "viewer":
+            # Same rule as get_items: viewers only see final products
+            sql += f" AND item_id IN ({app.VIEWER_ITEMS})"
+        for column in ('branch_id', 'item_id'):
+            if query.get(column):
+                sql += f" AND {column} = ?"
+                params.append(query[column])
+        sql += " ORDER BY id DESC LIMIT ?"
+        params.append(min(int(query.get('limit', 100)), 1000))
+        with self.pool.connection() as conn:
+            return [dict(row) for row in conn.execute(sql, params)]
+
+    def get_events(self, query, username, role):
+        return app.wait_for_events(int(query.get('after', 0)), min(float(query.get('timeout', 0)), 60),
+                                   min(int(query.get('limit', 500)), 1000), final_products_only=role == "viewer")
+
+    # ---- writes ----
+
+    def movement_request(self, body, username):
+        """Validate one movement and build the writer call for it"""
+        try:
+            quantity = float(body['quantity'])
+            item_id, branch_id = str(body['item_id']), int(body['branch_id'])
+        except (KeyError, TypeError, ValueError):
+            raise ApiError(400, "item_id, branch_id and quantity are required")
+        movement_type = body.get('movement_type', 'IN')
+        if movement_type not in MOVEMENT_TYPES or quantity <= 0:
+            raise ApiError(400, f"movement_type must be one of {', '.join(MOVEMENT_TYPES)} with a positive quantity")
+        return (app.write_checked_movement, item_id, branch_id, quantity, movement_type, body.get('reference', ''),
+                body.get('batch_nr', ''), body.get('invoice_nr', ''), body.get('po_nr', ''), username,
+                body.get('expiry_date'), body.get('unit_cost'))
+
+    def post_movement(self, query, username, role):
+        self.require_write(role)
+        request = self.movement_request(self.read_json(), username)
+        try:
+            app.get_stock_writer().execute(*request, tables=("items", "stock_movements"), user_id=username)
+        except LookupError as e:
+            raise ApiError(404, str(e))
+        except ValueError as e:
+            raise ApiError(409, str(e))
+        return {'ok': True}
+
+    def post_movement_batch(self, query, username, role):
+        """Batch: every movement is queued at once so the writer commits them together"""
+        self.require_write(role)
+        movements = self.read_json().get('movements', [])
+        if len(movements) > MAX_BATCH:
+            raise ApiError(413, f"At most {MAX_BATCH} movements per batch")
+
+        results = [None] * len(movements)
+        futures = []
+        writer = app.get_stock_writer()
+        for n, body in enumerate(movements):
+            try:
+                futures.append((n, writer.submit(*self.movement_request(body, username),
+                                                 tables=("items", "stock_movements"), user_id=username)))
+            except ApiError as e:
+                results[n] = {'ok': False, 'error': str(e)}
+        for n, future in futures:
+            try:
+                writer.wait(future)
+                results[n] = {'ok': True}
+            except Exception as e:
+                results[n] = {'ok': False, 'error': str(e)}
+        return results
+
+    def post_transfer(self, query, username, role):
+        """One item between branches: a shipment, or with "correction" an admin's one-step move"""
+        self.require_write(role)
+        body = self.read_json()
+        try:
+            item_id, quantity = str(body['item_id']), float(body['quantity'])
+            from_branch_id, to_branch_id = int(body['from_branch_id']), int(body['to_branch_id'])
+        except (KeyError, TypeError, ValueError):
+            raise ApiError(400, "item_id, from_branch_id, to_branch_id and quantity are required")
+        reference = body.get('reference', '')
+
+        if body.get('correction'):
+            if role != "admin":
+                raise ApiError(403, "Only admins may book one-step transfer corrections")
+            if not reference:
+                raise ApiError(400, "A correction needs a reference")
+            ok, message = app.transfer_stock_between_branches(item_id, from_branch_id, to_branch_id, quantity,
+                                                              f"CORRECTION: {reference}", body.get('batch_nr', ''),
+                                                              body.get('invoice_nr', ''), body.get('po_nr', ''), username)
+            if not ok:
+                raise ApiError(409, message)
+            return {'ok': True, 'message': message}
+
+        try:
+            shipment_id = app.dispatch_shipment(from_branch_id, to_branch_id, [(item_id, quantity)], reference, username)
+        except ValueError as e:
+            raise ApiError(409, str(e))
+        return {'ok': True, 'shipment_id': shipment_id}
+
+    def post_production(self, query, username, role):
+        self.require_write(role)
+        body = self.read_json()
+        try:
+            ok, message = app.produce_item(str(body['product_id']), int(body['branch_id']), float(body['quantity']),
+                                           username, body.get('batch_nr', ''), body.get('expiry_date'), body.get('reservation'))
+        except (KeyError, TypeError, ValueError):
+            raise ApiError(400, "product_id, branch_id and quantity are required")
+        if not ok:
+            raise ApiError(409, message)
+        return {'ok': True, 'message': message}
+
+    def get_reservations(self, query, username, role):
+        self.require_full_read(role)
+        return records(app.get_reservations(query.get('branch_id'), query.get('status', 'ACTIVE'), query.get('reference')))
+
+    def post_reservation(self, query, username, role):
+        """Reserve every line of an order or none of them"""
+        self.require_write(role)
+        body = self.read_json()
+        try:
+            reference, branch_id = str(body['reference']), int(body['branch_id'])
+            lines = [(line['item_id'], line['quantity']) for line in body['lines']]
+        except (KeyError, TypeError, ValueError):
+            raise ApiError(400, "reference, branch_id and lines of item_id and quantity are required")
+        if len(lines) > MAX_BATCH:
+            raise ApiError(413, f"At most {MAX_BATCH} lines per reservation")
+        ok, message = app.allocate_stock(reference, branch_id, lines, username, body.get('kind', 'ORDER'))
+        if not ok:
+            raise ApiError(409, message)
+        return {'ok': True, 'message': message}
+
+    def post_reservation_release(self, query, username, role):
+        self.require_write(role)
+        reference = self.read_json().get('reference')
+        if not reference:
+            raise ApiError(400, "reference is required")
+        return {'ok': True, 'released': app.release_reservations(str(reference), username)}
+
+    def post_reservation_fulfil(self, query, username, role):
+        self.require_write(role)
+        reference = self.read_json().get('reference')
+        if not reference:
+            raise ApiError(400, "reference is required")
+        ok, message = app.fulfil_reservations(str(reference), username)
+        if not ok:
+            raise ApiError(409, message)
+        return {'ok': True, 'message': message}
+
+    def get_shipments(self, query, username, role):
+        self.require_full_read(role)
+        return records(app.get_shipments(query.get('branch_id'), query.get('direction', 'inbound'), query.get('status'),
+                                         int(query.get('limit', 500))))
+
+    def get_in_transit(self, query, username, role):
+        self.require_full_read(role)
+        return records(app.get_in_transit(query.get('branch_id')))
+
+    def post_shipment(self, query, username, role):
+        """Dispatch: the source is debited now, the destination when it receives"""
+        self.require_write(role)
+        body = self.read_json()
+        try:
+            from_branch_id, to_branch_id = int(body['from_branch_id']), int(body['to_branch_id'])
+            lines = [(line['item_id'], line['quantity']) for line in body['lines']]
+        except (KeyError, TypeError, ValueError):
+            raise ApiError(400, "from_branch_id, to_branch_id and lines of item_id and quantity are required")
+        if len(lines) > MAX_BATCH:
+            raise ApiError(413, f"At most {MAX_BATCH} lines per shipment")
+        try:
+            shipment_id = app.dispatch_shipment(from_branch_id, to_branch_id, lines, body.get('reference', ''), username)
+        except ValueError as e:
+            raise ApiError(409, str(e))
+        return {'ok': True, 'shipment_id': shipment_id}
+
+    def post_shipment_receive(self, query, username, role):
+        """Receipt of a shipment; without lines everything outstanding arrives"""
+        self.require_write(role)
+        body = self.read_json()
+        try:
+            shipment_id = int(body['shipment_id'])
+            lines = None if body.get('lines') is None else [(line['item_id'], line['quantity']) for line in body['lines']]
+        except (KeyError, TypeError, ValueError):
+            raise ApiError(400, "shipment_id is required; lines need item_id and quantity")
+        ok, message = app.receive_shipment(shipment_id, lines, username)
+        if not ok:
+            raise ApiError(409, message)
+        return {'ok': True, 'message': message}
+
+    def post_shipment_close(self, query, username, role):
+        """Batch close: whatever is still in transit on these shipments is written off"""
+        self.require_write(role)
+        try:
+            shipment_ids = [int(i) for i in self.read_json()['shipment_ids']]
+        except (KeyError, TypeError, ValueError):
+            raise ApiError(400, "shipment_ids is required")
+        closed, value = app.close_shipments(shipment_ids, username)
+        return {'ok': True, 'closed': closed, 'variance_value': value}
+
+    def post_sync(self, query, username, role):
+        """Offline scanner upload: applied in order, idempotent per client_id"""
+        self.require_write(role)
+        body = self.read_json()
+        scans = body.get('scans', [])
+        if len(scans) > MAX_SYNC:
+            raise ApiError(413, f"At most {MAX_SYNC} scans per sync")
+        results = app.sync_scans(str(body.get('device_id', '')), scans, username)
+        counts = {status: sum(1 for r in results if r['status'] == status) for status in ('applied', 'duplicate', 'conflict')}
+        return {'counts': counts, 'results': results}
+
+    def post_count_lines(self, query, username, role):
+        """Scanner batch for an open cycle count; quantities add to earlier scans unless mode is 'set'"""
+        self.require_write(role)
+        body = self.read_json()
+        try:
+            session_id = int(body['session_id'])
+            lines = [(line['item_id'], line['quantity']) for line in body.get('lines', [])]
+        except (KeyError, TypeError, ValueError):
+            raise ApiError(400, "session_id and lines of item_id and quantity are required")
+        if len(lines) > MAX_SYNC:
+            raise ApiError(413, f"At most {MAX_SYNC} lines per batch")
+        try:
+            stored = app.record_count_lines(session_id, lines, username, f"scanner {body.get('device_id', '')}".strip(),
+                                            body.get('mode', 'add'))
+        except ValueError as e:
+            raise ApiError(409, str(e))
+        return {'ok': True, 'lines': stored}
+
+    def get_count_variances(self, query, username, role):
+        self.require_full_read(role)
+        try:
+            variances = app.get_count_variances(int(query['session_id']))
+        except (KeyError, ValueError) as e:
+            raise ApiError(400 if isinstance(e, KeyError) else 404, str(e))
+        return records(variances)
+
+    def get_schedule(self, query, username, role):
+        self.require_full_read(role)
+        return records(app.get_production_schedule(query.get('branch_id'), query.get('status', 'PLANNED')))
+
+    def post_schedule(self, query, username, role):
+        self.require_write(role)
+        runs = self.read_json().get('runs') or []
+        if len(runs) > MAX_SYNC:
+            raise ApiError(413, f"At most {MAX_SYNC} runs per request")
+        try:
+            scheduled = app.schedule_production(runs, username)
+        except (TypeError, ValueError) as e:
+            raise ApiError(400, str(e))
+        return {'ok': True, 'scheduled': scheduled}
+
+    def get_mrp(self, query, username, role):
+        """Time-phased requirements for the planned schedule"""
+        self.require_full_read(role)
+        freq = query.get('freq', 'W')
+        if freq not in app.MRP_BUCKETS:
+            raise ApiError(400, f"freq must be one of {', '.join(app.MRP_BUCKETS)}")
+        try:
+            lead_time_days = int(query.get('lead_time_days', 0))
+            horizon_days = int(query['horizon_days']) if query.get('horizon_days') else None
+        except ValueError:
+            raise ApiError(400, "lead_time_days and horizon_days must be whole days")
+        result = app.run_mrp(query.get('branch_id'), freq, lead_time_days, horizon_days)
+        return {name: records(frame) for name, frame in result.items()}
+
+    def get_movement_analytics(self, query, username, role):
+        """Movement totals per group, from the columnar mirror when there is one"""
+        self.require_full_read(role)
+        group_by = [key for key in query.get('group_by', '').split(',') if key]
+        if set(group_by) - set(analytics.GROUP_KEYS):
+            raise ApiError(400, f"group_by must be drawn from {', '.join(analytics.GROUP_KEYS)}")
+        try:
+            days = int(query.get('days', 365))
+        except ValueError:
+            raise ApiError(400, "days must be a whole number")
+        movement_types = [name for name in query.get('movement_types', '').split(',') if name] or None
+        totals = app.get_movement_analytics(group_by, days, query.get('branch_id'), movement_types)
+        return {'source': totals.attrs['source'], 'rows': records(totals)}
+
+    # (method, path) -> (handler, supports conditional GET)
+    ROUTES = {
+        ("GET", "/health"): (get_health, False),
+        ("GET", "/branches"): (get_branches, True),
+        ("GET", "/items"): (get_items, True),
+        ("GET", "/stock"): (get_stock, True),
+        ("POST", "/stock/lookup"): (post_stock_lookup, False),
+        ("GET", "/movements"): (get_movements, True),
+        ("GET", "/events"): (get_events, False),
+        ("POST", "/movements"): (post_movement, False),
+        ("POST", "/movements/batch"): (post_movement_batch, False),
+        ("POST", "/transfers"): (post_transfer, False),
+        ("POST", "/production"): (post_production, False),
+        ("POST", "/sync"): (post_sync, False),
+        ("GET", "/shipments"): (get_shipments, True),
+        ("GET", "/in-transit"): (get_in_transit, True),
+        ("POST", "/shipments"): (post_shipment, False),
+        ("POST", "/shipments/receive"): (post_shipment_receive, False),
+        ("POST", "/shipments/close"): (post_shipment_close, False),
+        ("GET", "/reservations"): (get_reservations, True),
+        ("POST", "/reservations"): (post_reservation, False),
+        ("POST", "/reservations/release"): (post_reservation_release, False),
+        ("POST", "/reservations/fulfil"): (post_reservation_fulfil, False),
+        ("POST", "/counts/lines"): (post_count_lines, False),
+        ("GET", "/counts/variances"): (get_count_variances, False),
+        ("GET", "/schedule"): (get_schedule, False),
+        ("POST", "/schedule"): (post_schedule, False),
+        ("GET", "/mrp"): (get_mrp, False),
+        ("GET", "/analytics/movements"): (get_movement_analytics, False),
+    }
+
+# ===============================
+# SERVER
+# ===============================
+
+def serve(host="127.0.0.1", port=8502, pool_size=8):
+    """Build the API server; call serve_forever() on the result"""
+    app.init_database()
+    InventoryApiHandler.pool = ConnectionPool(app.DB_PATH, pool_size)
+    server = ThreadingHTTPServer((host, port), InventoryApiHandler)
+    server.daemon_threads = True
+    return server
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="JSON HTTP API for the inventory")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8502)
+    parser.add_argument("--db", default=app.DB_PATH)
+    parser.add_argument("--pool-size", type=int, default=8, help="pooled read connections")
+    config = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    app.DB_PATH = config.db
+    server = serve(config.host, config.port, config.pool_size)
+    print(f"Inventory API on http://{config.host}:{server.server_port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,793 @@
+"""Load generation and benchmarks for the inventory core.
+
+Builds a synthetic dataset in a temporary SQLite file, times the core
+operations single-threaded and under concurrent writers and readers, and
+writes machine-readable JSON so runs can be compared between commits:
+
+    python benchmark.py --movements 1000000 --output before.json
+    python benchmark.py --movements 1000000 --output after.json --compare before.json
+"""
+
+import argparse
+import base64
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import analytics
+import inventory_app as app
+
+# ===============================
+# SYNTHETIC DATA
+# ===============================
+
+MOVEMENT_TYPES = ['IN', 'OUT', 'TRANSFER_IN', 'TRANSFER_OUT', 'PRODUCTION', 'ADMIN_IN', 'ADMIN_OUT']
+USERS = ['warehouse_manager', 'admin', 'system', 'scanner_01', 'scanner_02']
+
+def level_category(level, depth):
+    """Category for a BOM level: raw materials at the bottom, final products on top"""
+    if level == 0:
+        return "Raw Material"
+    if level == depth:
+        return "Final Product"
+    return "Pre-Final"
+
+def generate_dataset(rng, branches, items, bom_depth, movements, days):
+    """Fill the current DB_PATH with branches, items, multi-level BOMs and movements"""
+    conn = sqlite3.connect(app.DB_PATH)
+    c = conn.cursor()
+    now = datetime.now()
+    created = now.strftime("%Y-%m-%d %H:%M:%S")
+    timings = {}
+
+    started = time.perf_counter()
+    c.execute("DELETE FROM branches")
+    c.executemany("INSERT INTO branches (id, branch_code, branch_name, location, manager_name, contact_info, created_date) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                  [(b, f"B{b:03d}", f"Branch {b:03d}", f"City {b % 17}", f"Manager {b}", "000-000-0000", created)
+                   for b in range(1, branches + 1)])
+
+    # Items are spread evenly over the BOM levels
+    levels = bom_depth + 1
+    catalog = []
+    for n in range(items):
+        level = n * levels // items
+        catalog.append((f"SKU{n:06d}", f"ITEM {n:06d}", level_category(level, bom_depth), level))
+
+    item_rows = []
+    for branch_id in range(1, branches + 1):
+        for item_id, name, category, level in catalog:
+            stock = rng.uniform(0, 10000) if level < bom_depth else rng.uniform(0, 500)
+            item_rows.append((item_id, branch_id, name, category, "kg" if level == 0 else "pieces",
+                              stock, rng.uniform(0, 200), 0, "Main", "General", created, "benchmark"))
+    c.executemany('''INSERT INTO items (id, branch_id, name, category, unit, current_stock, min_stock, cost_per_unit, location, warehouse_area, created_date, created_by)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', item_rows)
+    timings['items_seconds'] = time.perf_counter() - started
+
+    # Every item above level 0 is made from 2-4 items of the level below
+    started = time.perf_counter()
+    by_level = {}
+    for item_id, _, _, level in catalog:
+        by_level.setdefault(level, []).append(item_id)
+    bom_rows = []
+    for level in range(1, levels):
+        lower = by_level.get(level - 1, [])
+        for product_id in by_level.get(level, []):
+            for ingredient_id in rng.sample(lower, min(len(lower), rng.randint(2, 4))):
+                for branch_id in range(1, branches + 1):
+                    bom_rows.append((product_id, ingredient_id, round(rng.uniform(0.1, 3), 3), branch_id, created, "benchmark"))
+    c.executemany('''INSERT INTO bom (final_product_id, ingredient_id, quantity_required, branch_id, created_date, created_by)
+                     VALUES (?, ?, ?, ?, ?, ?)''', bom_rows)
+    timings['bom_seconds'] = time.perf_counter() - started
+
+    # Movements spread over the last `days` days, inserted in chunks
+    started = time.perf_counter()
+    chunk = 50000
+    span = days * 86400
+    item_ids = [row[0] for row in catalog]
+    for offset in range(0, movements, chunk):
+        rows = []
+        for _ in range(min(chunk, movements - offset)):
+            movement_type = rng.choice(MOVEMENT_TYPES)
+            branch_id = rng.randint(1, branches)
+            other_branch = rng.randint(1, branches)
+            moment = (now - timedelta(seconds=rng.randint(0, span))).replace(microsecond=0)
+            is_transfer = movement_type.startswith('TRANSFER')
+            quantity = round(rng.uniform(1, 100), 2)
+            rows.append((rng.choice(item_ids), branch_id, movement_type, quantity,
+                         f"Synthetic {movement_type.lower()}", f"BATCH{rng.randint(1, 5000):05d}",
+                         f"INV{rng.randint(1, 50000):06d}", "", moment.strftime("%Y-%m-%d %H:%M:%S"),
+                         app.movement_epoch(moment), rng.choice(USERS),
+                         branch_id if is_transfer else None, other_branch if is_transfer else None,
+                         quantity if movement_type in app.STOCK_IN_TYPES else -quantity))
+        c.executemany('''INSERT INTO stock_movements (item_id, branch_id, movement_type, quantity, reference, batch_nr, invoice_nr, po_nr, date_time, ts, user_id, from_branch_id, to_branch_id, stock_delta)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+    timings['movements_seconds'] = time.perf_counter() - started
+
+    conn.commit()
+    c.execute("ANALYZE")
+    conn.close()
+    app.notify_data_change(("branches", "items", "bom", "stock_movements"), "benchmark")
+
+    return {
+        'branches': branches,
+        'items_per_branch': items,
+        'item_rows': len(item_rows),
+        'bom_rows': len(bom_rows),
+        'bom_depth': bom_depth,
+        'movements': movements,
+        'days': days,
+        'db_bytes': os.path.getsize(app.DB_PATH),
+        **{k: round(v, 3) for k, v in timings.items()}
+    }
+
+# ===============================
+# MEASUREMENT
+# ===============================
+
+def summarize(name, mode, durations, errors=0, elapsed=None):
+    """Latency percentiles and throughput for one benchmark"""
+    samples = np.array(durations, dtype=float) * 1000
+    total = elapsed if elapsed is not None else samples.sum() / 1000
+    return {
+        'name': name,
+        'mode': mode,
+        'count': int(len(samples)),
+        'errors': int(errors),
+        'mean_ms': round(float(samples.mean()), 3) if len(samples) else None,
+        'p50_ms': round(float(np.percentile(samples, 50)), 3) if len(samples) else None,
+        'p95_ms': round(float(np.percentile(samples, 95)), 3) if len(samples) else None,
+        'p99_ms': round(float(np.percentile(samples, 99)), 3) if len(samples) else None,
+        'max_ms': round(float(samples.max()), 3) if len(samples) else None,
+        'ops_per_sec': round(len(samples) / total, 1) if total else None
+    }
+
+def time_calls(func, iterations):
+    """Call func(i) iterations times, returns (durations, errors)"""
+    durations, errors = [], 0
+    for i in range(iterations):
+        started = time.perf_counter()
+        try:
+            result = func(i)
+            if isinstance(result, tuple) and result and result[0] is False:
+                errors += 1
+        except Exception:
+            errors += 1
+        durations.append(time.perf_counter() - started)
+    return durations, errors
+
+def movement_queries(branch_id):
+    """The movement queries the manager, boss and transfer pages run, keyed by name"""
+    base = '''SELECT sm.*, i.name as item_name, i.unit, i.category, b.branch_name
+              FROM stock_movements sm
+              JOIN items i ON sm.item_id = i.id AND sm.branch_id = i.branch_id
+              JOIN branches b ON sm.branch_id = b.id'''
+    week_ago = app.movement_epoch(datetime.now()) - 7 * 86400
+    return {
+        'movements_latest': (base + " ORDER BY sm.ts DESC, sm.id DESC LIMIT 100", []),
+        'movements_by_branch': (base + " WHERE sm.branch_id = ? ORDER BY sm.ts DESC, sm.id DESC LIMIT 100", [branch_id]),
+        'movements_by_category': (base + " WHERE i.category = ? ORDER BY sm.ts DESC, sm.id DESC LIMIT 100", ['Final Product']),
+        'movements_branch_last_week': (base + " WHERE sm.branch_id = ? AND sm.ts >= ? ORDER BY sm.ts DESC, sm.id DESC LIMIT 100",
+                                       [branch_id, week_ago]),
+        'transfer_history': (base + " WHERE sm.movement_type = 'TRANSFER_OUT' ORDER BY sm.ts DESC, sm.id DESC LIMIT 50", [])
+    }
+
+def run_single_threaded(rng, config):
+    """Time each core operation on its own"""
+    results = []
+    branches = config.branches
+    iterations = config.iterations
+    conn = sqlite3.connect(app.DB_PATH)
+    item_ids = [row[0] for row in conn.execute("SELECT DISTINCT id FROM items WHERE category != 'Final Product'")]
+    products = [row[0] for row in conn.execute("SELECT DISTINCT final_product_id FROM bom")]
+    conn.close()
+
+    def stock_in(i):
+        return app.update_stock(rng.choice(item_ids), rng.randint(1, branches), 5, 'IN', "bench", user_id="benchmark")
+
+    def stock_out(i):
+        return app.update_stock(rng.choice(item_ids), rng.randint(1, branches), 1, 'OUT', "bench", user_id="benchmark")
+
+    def transfer(i):
+        from_branch = rng.randint(1, branches)
+        to_branch = from_branch % branches + 1
+        return app.transfer_stock_between_branches(rng.choice(item_ids), from_branch, to_branch, 1, "bench", user_id="benchmark")
+
+    def produce(i):
+        return app.produce_item(rng.choice(products), rng.randint(1, branches), 1, "benchmark")
+
+    def items_cold(i):
+        # A change forces the shared snapshot to reload
+        app.notify_data_change(("items",), "benchmark")
+        return app.get_items_by_role("warehouse_manager")
+
+    def items_warm(i):
+        return app.get_items_by_role("warehouse_manager", rng.randint(1, branches))
+
+    operations = [
+        ('update_stock_in', stock_in, iterations),
+        ('update_stock_out', stock_out, iterations),
+        ('transfer_stock_between_branches', transfer, iterations),
+        ('produce_item', produce, max(1, iterations // 4)),
+        ('get_items_by_role_cold', items_cold, max(1, iterations // 10)),
+        ('get_items_by_role_warm', items_warm, iterations)
+    ]
+
+    for name, func, count in operations:
+        durations, errors = time_calls(func, count)
+        results.append(summarize(name, 'single', durations, errors))
+        print(f"  {name:34s} p50 {results[-1]['p50_ms']:>9} ms  p95 {results[-1]['p95_ms']:>9} ms")
+
+    for name in movement_queries(1):
+        def query(i, name=name):
+            sql, params = movement_queries(rng.randint(1, branches))[name]
+            conn = app.get_connection()
+            conn.execute(sql, params).fetchall()
+            conn.close()
+        durations, errors = time_calls(query, max(1, iterations // 4))
+        results.append(summarize(name, 'single', durations, errors))
+        print(f"  {name:34s} p50 {results[-1]['p50_ms']:>9} ms  p95 {results[-1]['p95_ms']:>9} ms")
+
+    for name, freq in [('stock_timeseries_daily', 'D'), ('stock_timeseries_monthly', 'MS')]:
+        def timeseries(i, freq=freq):
+            # Fresh generation each call so the hub's query cache is not measured
+            app.notify_data_change(("stock_movements",), "benchmark")
+            return app.get_stock_timeseries(rng.choice(item_ids), None, config.days, freq)
+        durations, errors = time_calls(timeseries, max(1, iterations // 4))
+        results.append(summarize(name, 'single', durations, errors))
+        print(f"  {name:34s} p50 {results[-1]['p50_ms']:>9} ms  p95 {results[-1]['p95_ms']:>9} ms")
+
+    search_terms = ['item 00', 'batch01', 'inv0004', 'synthetic transfer', 'sku0001']
+    for name, search in [('search_items', lambda t: app.search_items(t, "warehouse_manager")),
+                         ('search_movements', app.search_movements)]:
+        durations, errors = time_calls(lambda i: search(search_terms[i % len(search_terms)]), max(1, iterations // 4))
+        results.append(summarize(name, 'single', durations, errors))
+        print(f"  {name:34s} p50 {results[-1]['p50_ms']:>9} ms  p95 {results[-1]['p95_ms']:>9} ms")
+
+    # Sealing chains every generated movement; verifying then walks them all
+    for name, func in [('audit_seal', lambda i: app.seal_audit_log()),
+                       ('audit_verify_full', lambda i: app.verify_audit_log(full=True)),
+                       ('audit_verify_incremental', lambda i: app.verify_audit_log())]:
+        durations, errors = time_calls(func, 1)
+        results.append(summarize(name, 'single', durations, errors))
+        print(f"  {name:34s} p50 {results[-1]['p50_ms']:>9} ms  p95 {results[-1]['p95_ms']:>9} ms")
+
+    def stock_scan(i):
+        conn = app.get_connection()
+        conn.execute("SELECT branch_id, SUM(current_stock), SUM(current_stock < min_stock) FROM branch_stock GROUP BY branch_id").fetchall()
+        conn.close()
+
+    def items_scan(i):
+        conn = app.get_connection()
+        conn.execute("SELECT branch_id, category, SUM(current_stock) FROM items GROUP BY branch_id, category").fetchall()
+        conn.close()
+
+    def summary_read(i):
+        conn = app.get_connection()
+        conn.execute("SELECT branch_id, category, items, out_of_stock, low_stock, total_stock FROM branch_summary").fetchall()
+        conn.close()
+
+    # Dashboard headline counters: trigger-maintained table, and the recount the checker compares it with
+    for name, func in [('branch_stock_scan', stock_scan), ('items_view_scan', items_scan),
+                       ('branch_summary_read', summary_read),
+                       ('branch_summary_check', lambda i: app.check_branch_summary())]:
+        durations, errors = time_calls(func, max(1, iterations // 4))
+        results.append(summarize(name, 'single', durations, errors))
+        print(f"  {name:34s} p50 {results[-1]['p50_ms']:>9} ms  p95 {results[-1]['p95_ms']:>9} ms")
+
+    conn = sqlite3.connect(app.DB_PATH)
+    for table in ('item_catalog', 'branch_stock', 'stock_movements', 'audit_log'):
+        rows = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        size = conn.execute("SELECT SUM(pgsize) FROM dbstat WHERE name = ?", (table,)).fetchone()[0]
+        print(f"  {table + ' bytes/row':34s} {size / max(rows, 1):>9.1f}  ({rows} rows)")
+    conn.close()
+
+    return results
+
+def run_concurrent(config):
+    """Writers and readers hammering the database together for a fixed time"""
+    branches = config.branches
+    conn = sqlite3.connect(app.DB_PATH)
+    item_ids = [row[0] for row in conn.execute("SELECT DISTINCT id FROM items WHERE category != 'Final Product'")]
+    conn.close()
+
+    stop = threading.Event()
+    samples = {'concurrent_write': [], 'concurrent_read_items': [], 'concurrent_read_movements': []}
+    errors = {name: 0 for name in samples}
+    lock = threading.Lock()
+
+    def writer(seed):
+        rng = random.Random(seed)
+        while not stop.is_set():
+            started = time.perf_counter()
+            failed = False
+            try:
+                if rng.random() < 0.2:
+                    from_branch = rng.randint(1, branches)
+                    ok, _ = app.transfer_stock_between_branches(rng.choice(item_ids), from_branch, from_branch % branches + 1,
+                                                                1, "bench", user_id="benchmark")
+                    failed = not ok
+                else:
+                    app.update_stock(rng.choice(item_ids), rng.randint(1, branches), 1,
+                                     rng.choice(['IN', 'OUT']), "bench", user_id="benchmark")
+            except Exception:
+                failed = True
+            with lock:
+                samples['concurrent_write'].append(time.perf_counter() - started)
+                errors['concurrent_write'] += failed
+
+    def reader(seed):
+        rng = random.Random(seed)
+        while not stop.is_set():
+            name = 'concurrent_read_items' if rng.random() < 0.5 else 'concurrent_read_movements'
+            started = time.perf_counter()
+            failed = False
+            try:
+                if name == 'concurrent_read_items':
+                    app.get_items_by_role("boss", rng.randint(1, branches))
+                else:
+                    sql, params = movement_queries(rng.randint(1, branches))['movements_by_branch']
+                    conn = app.get_connection()
+                    conn.execute(sql, params).fetchall()
+                    conn.close()
+            except Exception:
+                failed = True
+            with lock:
+                samples[name].append(time.perf_counter() - started)
+                errors[name] += failed
+
+    threads = [threading.Thread(target=writer, args=(config.seed + n,)) for n in range(config.writers)]
+    threads += [threading.Thread(target=reader, args=(config.seed + 1000 + n,)) for n in range(config.readers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(config.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    results = []
+    mode = f"concurrent_{config.writers}w_{config.readers}r"
+    for name, durations in samples.items():
+        if durations:
+            results.append(summarize(name, mode, durations, errors[name], elapsed))
+            print(f"  {name:34s} {results[-1]['ops_per_sec']:>9} ops/s  p95 {results[-1]['p95_ms']:>9} ms  errors {errors[name]}")
+    return results
+
+def run_cycle_count(rng, config):
+    """A full count of branch 1: freeze, load every line, compute variances and post them"""
+    conn = sqlite3.connect(app.DB_PATH)
+    stock = conn.execute("SELECT item_id, current_stock FROM branch_stock WHERE branch_id = 1").fetchall()
+    conn.close()
+    # One line in ten is off by a few units
+    lines = [(item_id, max(0.0, qty + rng.choice([-3, -1, 2])) if rng.random() < 0.1 else qty) for item_id, qty in stock]
+
+    results = []
+    session = {}
+    steps = [('count_start', lambda: session.update(id=app.start_count_session(1, "benchmark", "benchmark count"))),
+             ('count_record_lines', lambda: app.record_count_lines(session['id'], lines, "benchmark")),
+             ('count_variances', lambda: app.get_count_variances(session['id'])),
+             ('count_post', lambda: app.post_count_session(session['id'], "benchmark"))]
+    for name, func in steps:
+        durations, errors = time_calls(lambda i: func(), 1)
+        results.append(summarize(name, 'single', durations, errors))
+        print(f"  {name:34s} p50 {results[-1]['p50_ms']:>9} ms  ({len(lines)} lines)")
+    return results
+
+def run_shipments(rng, config):
+    """Two-phase transfers out of branch 1: dispatch, partial receipts, inbound listings and a batch close"""
+    conn = sqlite3.connect(app.DB_PATH)
+    item_ids = [row[0] for row in conn.execute("SELECT item_id FROM branch_stock WHERE branch_id = 1 AND current_stock > 10")]
+    conn.close()
+    destinations = list(range(2, config.branches + 1)) or [1]
+
+    shipment_ids = []
+    def dispatch(i):
+        lines = [(item_id, 0.01) for item_id in rng.sample(item_ids, min(3, len(item_ids)))]
+        shipment_ids.append(app.dispatch_shipment(1, 2 if i % 2 else rng.choice(destinations), lines, f"bench {i}", "benchmark"))
+    results = []
+    durations, errors = time_calls(dispatch, config.shipments)
+    results.append(summarize('shipment_dispatch', 'single', durations, errors))
+
+    # Half of the shipments to branch 2 arrive short
+    inbound = shipment_ids[1::2]
+    conn = sqlite3.connect(app.DB_PATH)
+    inbound_lines = {shipment_id: [(item_id, 0.005) for (item_id,) in
+                                   conn.execute("SELECT item_id FROM shipment_lines WHERE shipment_id = ?", (shipment_id,))]
+                     for shipment_id in inbound}
+    conn.close()
+    def receive(i):
+        return app.receive_shipment(inbound[i], inbound_lines[inbound[i]], "benchmark")
+    durations, errors = time_calls(receive, len(inbound) // 2)
+    results.append(summarize('shipment_receive_partial', 'single', durations, errors))
+
+    def inbound_open(i):
+        # A new limit each call misses the hub's query cache without reloading its item snapshot
+        return app.get_shipments(2, "inbound", "OPEN", limit=5000 + i)
+    durations, errors = time_calls(inbound_open, max(1, config.iterations // 4))
+    results.append(summarize('shipments_inbound_open', 'single', durations, errors))
+
+    durations, errors = time_calls(lambda i: app.close_shipments(inbound, "benchmark"), 1)
+    results.append(summarize('shipments_close_batch', 'single', durations, errors))
+
+    for result in results:
+        print(f"  {result['name']:34s} p50 {result['p50_ms']:>9} ms  p95 {result['p95_ms']:>9} ms")
+    print(f"  {len(shipment_ids)} shipments, {len(inbound)} closed in one batch, "
+          f"{len(app.check_in_transit())} in-transit rows drifted")
+    return results
+
+def run_mrp_plan(rng, config):
+    """A quarter's production schedule for every final product in every branch, then a full MRP run"""
+    conn = sqlite3.connect(app.DB_PATH)
+    products = conn.execute("SELECT s.branch_id, s.item_id FROM branch_stock s JOIN item_catalog c ON c.id = s.item_id "
+                            "WHERE c.category = 'Final Product'").fetchall()
+    conn.close()
+    today = datetime.now()
+    schedule = [{'final_product_id': item_id, 'branch_id': branch_id, 'quantity': rng.randint(10, 500),
+                 'due_date': (today + timedelta(days=rng.randint(0, 90))).strftime("%Y-%m-%d")}
+                for branch_id, item_id in products for _ in range(rng.randint(1, 3))]
+
+    results = []
+    plan = {}
+    for name, func in [('mrp_schedule_insert', lambda i: app.schedule_production(schedule, "benchmark")),
+                       ('mrp_plan_weekly', lambda i: plan.update(app.run_mrp(freq="W", lead_time_days=7))),
+                       ('mrp_plan_daily', lambda i: plan.update(app.run_mrp(freq="D", lead_time_days=2)))]:
+        durations, errors = time_calls(func, 1)
+        results.append(summarize(name, 'single', durations, errors))
+        print(f"  {name:34s} p50 {results[-1]['p50_ms']:>9} ms")
+    print(f"  {len(schedule)} scheduled runs, {len(plan['plan'])} time-phased rows, "
+          f"{len(plan['planned_orders'])} planned orders, {len(plan['shortages'])} shortages")
+    return results
+
+def run_forecast(config):
+    """First demand fit over the whole history, then the nightly refit of a single new day"""
+    two_days_ago = (datetime.now() - timedelta(days=2)).strftime("%Y-%m-%d")
+    results = []
+    stats = {}
+    for name, func in [('forecast_initial_fit', lambda i: stats.update(app.fit_demand_forecast(through=two_days_ago))),
+                       ('forecast_nightly_refit', lambda i: stats.update(app.fit_demand_forecast()))]:
+        durations, errors = time_calls(func, 1)
+        results.append(summarize(name, 'single', durations, errors))
+        print(f"  {name:34s} p50 {results[-1]['p50_ms']:>9} ms")
+    print(f"  {stats['series']} demand series fitted through {stats['fitted_through']}")
+    return results
+
+ANALYTICS_GROUPS = [('branch_id', 'item_id'), ('category', 'month'), ('movement_type', 'day')]
+
+def run_analytics(config):
+    """Reporting group-bys on SQLite alone, a full and an incremental mirror refresh, then the same group-bys on the mirror"""
+    analytics.drop_mirror(app.DB_PATH)
+    group_bys = [(f"analytics_{'_'.join(keys)}", lambda i, keys=keys: analytics.aggregate_movements(app.DB_PATH, keys), 3)
+                 for keys in ANALYTICS_GROUPS]
+    stats = {}
+    timings = [(name.replace('analytics_', 'analytics_sqlite_'), func, count) for name, func, count in group_bys]
+    if analytics.mirror_available():
+        timings += [('analytics_mirror_rebuild', lambda i: stats.update(analytics.refresh_mirror(app.DB_PATH, rebuild=True)), 1),
+                    ('analytics_mirror_append', lambda i: analytics.refresh_mirror(app.DB_PATH), 1)]
+        timings += [(name.replace('analytics_', 'analytics_mirror_'), func, count) for name, func, count in group_bys]
+
+    results = []
+    for name, func, count in timings:
+        durations, errors = time_calls(func, count)
+        results.append(summarize(name, 'single', durations, errors))
+        print(f"  {name:34s} p50 {results[-1]['p50_ms']:>9} ms")
+    if stats:
+        print(f"  {stats['rows']} movements mirrored in {stats['parts']} parts")
+    else:
+        print("  pyarrow not installed, mirror skipped")
+    return results
+
+def run_reservations(config):
+    """Concurrent reserve/release cycles on a small set of hot items, then a drift check"""
+    conn = sqlite3.connect(app.DB_PATH)
+    item_ids = [row[0] for row in conn.execute("SELECT item_id FROM branch_stock WHERE branch_id = 1 AND current_stock > 10 LIMIT 20")]
+    conn.close()
+
+    stop = threading.Event()
+    samples = {'reserve': [], 'release': []}
+    errors = {name: 0 for name in samples}
+    rejected = [0]
+    lock = threading.Lock()
+
+    def client(seed):
+        rng = random.Random(seed)
+        n = 0
+        while not stop.is_set():
+            n += 1
+            reference = f"bench-{seed}-{n}"
+            lines = [(item_id, rng.randint(1, 5)) for item_id in rng.sample(item_ids, 3)]
+            for name, call in (('reserve', lambda: app.allocate_stock(reference, 1, lines, "benchmark")),
+                               ('release', lambda: app.release_reservations(reference, "benchmark"))):
+                started = time.perf_counter()
+                failed = False
+                try:
+                    result = call()
+                    if name == 'reserve' and not result[0]:
+                        with lock:
+                            rejected[0] += 1
+                except Exception:
+                    failed = True
+                with lock:
+                    samples[name].append(time.perf_counter() - started)
+                    errors[name] += failed
+
+    threads = [threading.Thread(target=client, args=(config.seed + 2000 + n,)) for n in range(config.writers)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(config.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    results = []
+    mode = f"concurrent_{config.writers}w"
+    for name, durations in samples.items():
+        results.append(summarize(name, mode, durations, errors[name], elapsed))
+        print(f"  {name:34s} {results[-1]['ops_per_sec']:>9} ops/s  p95 {results[-1]['p95_ms']:>9} ms  errors {errors[name]}")
+    print(f"  {rejected[0]} reservations rejected for lack of stock, {len(app.check_reservations())} counters drifted")
+    return results
+
+# ===============================
+# UI RERUNS
+# ===============================
+
+# Page, widget label and the values cycled through for each measured interaction
+UI_INTERACTIONS = [
+    ('warehouse_manager', 'manager_movements', 'show_manager_movement_records', "📊 Records", [50, 200, 100]),
+    ('boss', 'boss_stock', 'show_boss_stock_table', "📦 Category", ["Raw Material", "Final Product", "All"])
+]
+
+# Runs one entry point and records the CPU time of the script thread only, so
+# neither the test harness nor background jobs are counted
+UI_SCRIPT = """
+import time
+import streamlit as st
+import inventory_app as app
+
+started = time.thread_time()
+app.{call}()
+st.session_state['script_cpu'] = time.thread_time() - started
+"""
+
+def time_interactions(call, role, page, label, values, count):
+    """Script CPU seconds per widget change, cycling the widget through values"""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_string(UI_SCRIPT.format(call=call), default_timeout=120)
+    for key, value in dict(authenticated=True, username=role, user_role=role, full_name=role, current_page=page).items():
+        at.session_state[key] = value
+    at.run()
+    at.run()
+
+    samples = []
+    for i in range(count):
+        widget = next(w for w in at.selectbox if w.label == label)
+        widget.set_value(values[i % len(values)]).run()
+        if at.exception:
+            raise RuntimeError(at.exception[0].value)
+        samples.append(at.session_state['script_cpu'])
+    return samples
+
+def run_ui_interactions(config):
+    """CPU per filter change: a full script rerun against only the fragment that owns the widget"""
+    results = []
+    for role, page, fragment, label, values in UI_INTERACTIONS:
+        for mode, call in (('full_rerun', 'main'), ('fragment_rerun', fragment)):
+            samples = time_interactions(call, role, page, label, values, config.ui_interactions)
+            results.append(summarize(f"ui_{page}", mode, samples))
+            print(f"  {page:20s} {mode:14s} cpu p50 {results[-1]['p50_ms']:>9} ms  p95 {results[-1]['p95_ms']:>9} ms")
+    return results
+
+# ===============================
+# REPORTING
+# ===============================
+
+def run_api_load(config):
+    """Requests per second through api_server with keep-alive clients"""
+    import api_server
+
+    server = api_server.serve(port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_port
+    auth = "Basic " + base64.b64encode(b"warehouse_manager:manager123").decode()
+    conn = sqlite3.connect(app.DB_PATH)
+    item_ids = [row[0] for row in conn.execute("SELECT DISTINCT id FROM items WHERE category != 'Final Product'")]
+    conn.close()
+
+    stop = threading.Event()
+    names = ['api_get_stock', 'api_get_stock_304', 'api_post_movement', 'api_post_movement_batch']
+    samples = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    lock = threading.Lock()
+
+    def client(seed):
+        rng = random.Random(seed)
+        api = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        etags = {}
+        while not stop.is_set():
+            branch_id = rng.randint(1, config.branches)
+            roll = rng.random()
+            headers = {"Authorization": auth, "Content-Type": "application/json"}
+            if roll < 0.6:
+                path, body, method = f"/stock?branch_id={branch_id}", None, "GET"
+                if branch_id in etags and rng.random() < 0.5:
+                    headers["If-None-Match"] = etags[branch_id]
+            elif roll < 0.9:
+                path, method = "/movements", "POST"
+                body = json.dumps({'item_id': rng.choice(item_ids), 'branch_id': branch_id, 'quantity': 1,
+                                   'movement_type': rng.choice(['IN', 'OUT']), 'reference': 'api bench'})
+            else:
+                path, method = "/movements/batch", "POST"
+                body = json.dumps({'movements': [{'item_id': rng.choice(item_ids), 'branch_id': branch_id, 'quantity': 1,
+                                                  'movement_type': 'IN', 'reference': 'api bench'} for _ in range(20)]})
+            started = time.perf_counter()
+            failed = False
+            try:
+                api.request(method, path, body, headers)
+                response = api.getresponse()
+                response.read()
+                failed = response.status not in (200, 304)
+                if method == "GET":
+                    etags[branch_id] = response.getheader("ETag")
+                    name = 'api_get_stock_304' if response.status == 304 else 'api_get_stock'
+                else:
+                    name = 'api_post_movement' if path == "/movements" else 'api_post_movement_batch'
+            except Exception:
+                failed = True
+                name = 'api_get_stock' if method == "GET" else 'api_post_movement'
+                api.close()
+                api = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+            with lock:
+                samples[name].append(time.perf_counter() - started)
+                errors[name] += failed
+        api.close()
+
+    threads = [threading.Thread(target=client, args=(config.seed + 2000 + n,)) for n in range(config.api_clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(config.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    server.server_close()
+
+    results = []
+    mode = f"api_{config.api_clients}c"
+    for name in names:
+        if samples[name]:
+            results.append(summarize(name, mode, samples[name], errors[name], elapsed))
+            print(f"  {name:34s} {results[-1]['ops_per_sec']:>8} req/s  p95 {results[-1]['p95_ms']:>9} ms  errors {errors[name]}")
+    total = sum(len(v) for v in samples.values())
+    print(f"  {'total':34s} {total / elapsed:>8.1f} req/s")
+    return results
+
+def git_commit():
+    """Current commit of the working tree, if any"""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+def compare_results(current, baseline_path):
+    """Print p50/p95 and throughput ratios against an earlier results file"""
+    with open(baseline_path) as f:
+        baseline = {(r['name'], r['mode']): r for r in json.load(f)['results']}
+
+    print(f"\nComparison against {baseline_path} (ratio < 1.0 is faster):")
+    for result in current:
+        old = baseline.get((result['name'], result['mode']))
+        if not old or not old.get('p50_ms') or not result.get('p50_ms'):
+            continue
+        p50 = result['p50_ms'] / old['p50_ms']
+        p95 = result['p95_ms'] / old['p95_ms'] if old.get('p95_ms') else float('nan')
+        print(f"  {result['name']:34s} {result['mode']:20s} p50 x{p50:5.2f}  p95 x{p95:5.2f}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the inventory core on a synthetic dataset")
+    parser.add_argument("--branches", type=int, default=10)
+    parser.add_argument("--items", type=int, default=2000, help="items per branch")
+    parser.add_argument("--bom-depth", type=int, default=2, help="BOM levels above raw materials")
+    parser.add_argument("--movements", type=int, default=200000)
+    parser.add_argument("--days", type=int, default=365, help="history spread of generated movements")
+    parser.add_argument("--iterations", type=int, default=200, help="calls per single-threaded operation")
+    parser.add_argument("--shipments", type=int, default=2000, help="shipments dispatched in the transfer benchmark")
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10, help="seconds for the concurrent run")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write JSON results here (default: stdout)")
+    parser.add_argument("--compare", help="earlier JSON results to compare against")
+    parser.add_argument("--keep-db", action="store_true", help="keep the generated database")
+    parser.add_argument("--api-clients", type=int, default=4, help="HTTP clients for the API load test (0 skips it)")
+    parser.add_argument("--ui-interactions", type=int, default=20, help="filter changes per UI rerun benchmark (0 skips it)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    config = parse_args(argv)
+    logging.getLogger("streamlit").setLevel(logging.ERROR)
+    rng = random.Random(config.seed)
+
+    workdir = tempfile.mkdtemp(prefix="inventory-bench-")
+    app.DB_PATH = os.path.join(workdir, "inventory.db")
+    print(f"Generating dataset in {app.DB_PATH}")
+
+    try:
+        app.init_database()
+        dataset = generate_dataset(rng, config.branches, config.items, config.bom_depth, config.movements, config.days)
+        print(f"  {dataset['item_rows']} item rows, {dataset['bom_rows']} BOM rows, {dataset['movements']} movements "
+              f"({dataset['db_bytes'] / 1e6:.1f} MB)")
+
+        print("Single-threaded:")
+        results = run_single_threaded(rng, config)
+        print("Cycle count:")
+        results += run_cycle_count(rng, config)
+        print("MRP:")
+        results += run_mrp_plan(rng, config)
+        print("Forecast:")
+        results += run_forecast(config)
+        print("Analytics:")
+        results += run_analytics(config)
+        print("Shipments:")
+        results += run_shipments(rng, config)
+        print(f"Reservations ({config.writers} clients, {config.duration}s):")
+        results += run_reservations(config)
+        print(f"Concurrent ({config.writers} writers, {config.readers} readers, {config.duration}s):")
+        results += run_concurrent(config)
+        if config.api_clients:
+            print(f"HTTP API ({config.api_clients} keep-alive clients, {config.duration}s):")
+            results += run_api_load(config)
+        if config.ui_interactions:
+            print(f"UI reruns ({config.ui_interactions} filter changes, server CPU):")
+            results += run_ui_interactions(config)
+
+        report = {
+            'meta': {
+                'commit': git_commit(),
+                'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                'python': platform.python_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'config': vars(config)
+            },
+            'dataset': dataset,
+            'results': results
+        }
+
+        if config.output:
+            with open(config.output, "w") as f:
+                json.dump(report, f, indent=2)
+            print(f"Results written to {config.output}")
+        else:
+            json.dump(report, sys.stdout, indent=2)
+            print()
+
+        if config.compare:
+            compare_results(results, config.compare)
+    finally:
+        if config.keep_db:
+            print(f"Database kept at {app.DB_PATH}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
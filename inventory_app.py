@@ -2,10 +2,206 @@ import streamlit as st
 import pandas as pd
 import sqlite3
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 import io
 import uuid
 import hashlib
+import threading
+import time
+import re
+import functools
+import os
+import queue
+import struct
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+import numpy as np
+
+# ===============================
+# CONNECTIONS & INSTRUMENTATION
+# ===============================
+
+DB_PATH = 'inventory.db'
+
+# Write statements slower than this most likely waited on the write lock
+LOCK_WAIT_THRESHOLD = 0.1
+METRIC_WINDOW = 1000
+METRIC_BUFFER = 50000
+
+_FINGERPRINT_PATTERNS = [
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)"), "(?, ...)"),
+    (re.compile(r"\s+"), " "),
+]
+
+_WRITE_PREFIXES = ("INSERT", "UPDATE", "DELETE", "REPLACE", "BEGIN", "COMMIT")
+
+@functools.lru_cache(maxsize=4096)
+def query_fingerprint(sql):
+    """Normalize a statement so runs with different literals share one metric"""
+    text = sql.strip()
+    for pattern, replacement in _FINGERPRINT_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return text[:300]
+
+class PerformanceMetrics:
+    """Rolling timings of queries, page renders and mutators for this process.
+
+    The last METRIC_WINDOW samples per (kind, name) are kept for percentiles.
+    Every sample is also buffered until the flush_metrics job writes it to
+    perf_metrics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._totals = {}
+        self._pending = deque(maxlen=METRIC_BUFFER)
+        self.lock_errors = 0
+        self.slow_writes = 0
+        self.started_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    def record(self, kind, name, seconds, error=False):
+        """Add one timing sample"""
+        key = (kind, name)
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=METRIC_WINDOW)
+                self._totals[key] = [0, 0.0, 0.0, 0]
+            samples.append(seconds)
+            totals = self._totals[key]
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] = max(totals[2], seconds)
+            totals[3] += int(error)
+            self._pending.append((int(time.time()), kind, name, seconds * 1000, int(error)))
+
+    def record_query(self, sql, seconds, error=False):
+        """Time a statement under its fingerprint and count likely lock waits"""
+        fingerprint = query_fingerprint(sql)
+        self.record('query', fingerprint, seconds, error)
+        if seconds >= LOCK_WAIT_THRESHOLD and fingerprint.upper().startswith(_WRITE_PREFIXES):
+            with self._lock:
+                self.slow_writes += 1
+
+    def record_lock_error(self):
+        """Count a 'database is locked' failure"""
+        with self._lock:
+            self.lock_errors += 1
+
+    def summary(self, kind=None):
+        """Per-name counts and percentiles in milliseconds"""
+        with self._lock:
+            keys = [k for k in self._samples if kind is None or k[0] == kind]
+            rows = []
+            for key in keys:
+                window = np.fromiter(self._samples[key], dtype=float) * 1000
+                count, total, slowest, errors = self._totals[key]
+                rows.append({
+                    'kind': key[0],
+                    'name': key[1],
+                    'count': count,
+                    'avg_ms': total * 1000 / count,
+                    'p50_ms': np.percentile(window, 50),
+                    'p95_ms': np.percentile(window, 95),
+                    'max_ms': slowest * 1000,
+                    'total_ms': total * 1000,
+                    'errors': errors
+                })
+        return pd.DataFrame(rows, columns=['kind', 'name', 'count', 'avg_ms', 'p50_ms', 'p95_ms',
+                                           'max_ms', 'total_ms', 'errors'])
+
+    def drain(self):
+        """Take the samples not yet persisted"""
+        with self._lock:
+            pending = list(self._pending)
+            self._pending.clear()
+        return pending
+
+@st.cache_resource
+def get_metrics():
+    """Get the process-wide performance metrics"""
+    return PerformanceMetrics()
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that times every statement by query fingerprint"""
+
+    def _timed(self, method, sql, *args):
+        metrics = self.connection.metrics
+        started = time.perf_counter()
+        error = False
+        try:
+            return method(sql, *args)
+        except sqlite3.Error as e:
+            error = True
+            if isinstance(e, sqlite3.OperationalError) and 'locked' in str(e):
+                metrics.record_lock_error()
+            raise
+        finally:
+            metrics.record_query(sql, time.perf_counter() - started, error)
+
+    def execute(self, sql, parameters=()):
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._timed(super().executemany, sql, seq_of_parameters)
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose statements and commits are recorded in the metrics"""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        started = time.perf_counter()
+        error = False
+        try:
+            super().commit()
+        except sqlite3.Error as e:
+            error = True
+            if isinstance(e, sqlite3.OperationalError) and 'locked' in str(e):
+                self.metrics.record_lock_error()
+            raise
+        finally:
+            self.metrics.record_query("COMMIT", time.perf_counter() - started, error)
+
+def get_connection(db_path=None, **kwargs):
+    """Open an instrumented connection to the inventory database"""
+    conn = sqlite3.connect(db_path or DB_PATH, factory=InstrumentedConnection, **kwargs)
+    conn.metrics = get_metrics()
+    return conn
+
+@contextmanager
+def measure(kind, name):
+    """Time a block (page render, mutator, job) into the metrics"""
+    started = time.perf_counter()
+    error = False
+    try:
+        yield
+    except Exception:
+        error = True
+        raise
+    finally:
+        get_metrics().record(kind, name, time.perf_counter() - started, error)
+
+def instrumented(kind):
+    """Decorator that times every call of a function into the metrics"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with measure(kind, func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
 
 # ===============================
 # DATABASE SETUP & INITIALIZATION
@@ -13,9 +209,12 @@ import hashlib
 
 def init_database():
     """Initialize all database tables"""
-    conn = sqlite3.connect('inventory.db')
+    conn = get_connection()
     c = conn.cursor()
     
+    # WAL lets background jobs and readers run alongside a writer
+    c.execute("PRAGMA journal_mode=WAL")
+    
     # Users table
     c.execute('''CREATE TABLE IF NOT EXISTS users (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -39,23 +238,11 @@ def init_database():
         is_active INTEGER DEFAULT 1
     )''')
     
-    # Items table
-    c.execute('''CREATE TABLE IF NOT EXISTS items (
-        id TEXT NOT NULL,
-        branch_id INTEGER NOT NULL,
-        name TEXT NOT NULL,
-        category TEXT NOT NULL,
-        unit TEXT NOT NULL,
-        current_stock REAL DEFAULT 0,
-        min_stock REAL DEFAULT 0,
-        cost_per_unit REAL DEFAULT 0,
-        location TEXT DEFAULT 'Main',
-        warehouse_area TEXT DEFAULT 'General',
-        created_date TEXT,
-        created_by TEXT,
-        PRIMARY KEY (id, branch_id),
-        FOREIGN KEY (branch_id) REFERENCES branches (id)
-    )''')
+    # Items: one catalog row per SKU, one slim stock row per branch, joined by the items view
+    create_item_tables(c)
+    
+    # Per-branch, per-category headline counters kept current by triggers
+    create_branch_summary(c)
     
     # Bill of Materials table
     c.execute('''CREATE TABLE IF NOT EXISTS bom (
@@ -90,6 +277,300 @@ def init_database():
         FOREIGN KEY (branch_id) REFERENCES branches (id)
     )''')
     
+    # Background job schedule and run history
+    c.execute('''CREATE TABLE IF NOT EXISTS scheduled_jobs (
+        name TEXT PRIMARY KEY,
+        description TEXT,
+        interval_seconds INTEGER NOT NULL,
+        enabled INTEGER DEFAULT 1,
+        next_run TEXT,
+        last_run TEXT,
+        last_status TEXT,
+        last_duration REAL
+    )''')
+    
+    c.execute('''CREATE TABLE IF NOT EXISTS job_runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        job_name TEXT NOT NULL,
+        trigger TEXT,
+        status TEXT NOT NULL,
+        queued_at TEXT,
+        started_at TEXT,
+        finished_at TEXT,
+        duration_seconds REAL,
+        result TEXT,
+        error TEXT,
+        user_id TEXT
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_job_runs_job ON job_runs (job_name, id)")
+    
+    # Reports precomputed by background jobs
+    c.execute('''CREATE TABLE IF NOT EXISTS report_cache (
+        report_key TEXT PRIMARY KEY,
+        payload TEXT NOT NULL,
+        computed_at TEXT,
+        duration_seconds REAL
+    )''')
+    
+    # Daily stock level snapshots
+    c.execute('''CREATE TABLE IF NOT EXISTS stock_snapshots (
+        snapshot_date TEXT NOT NULL,
+        item_id TEXT NOT NULL,
+        branch_id INTEGER NOT NULL,
+        current_stock REAL,
+        min_stock REAL,
+        taken_at TEXT,
+        PRIMARY KEY (snapshot_date, item_id, branch_id)
+    )''')
+    
+    # Persisted query, page and mutator timings
+    c.execute('''CREATE TABLE IF NOT EXISTS perf_metrics (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        recorded_at INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        name TEXT NOT NULL,
+        duration_ms REAL NOT NULL,
+        is_error INTEGER DEFAULT 0
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_perf_metrics_time ON perf_metrics (recorded_at, kind)")
+    
+    # One receipt per offline scan, keyed by the id the device generated
+    c.execute('''CREATE TABLE IF NOT EXISTS sync_receipts (
+        client_id TEXT PRIMARY KEY,
+        device_id TEXT,
+        scan_type TEXT,
+        item_id TEXT,
+        branch_id INTEGER,
+        quantity REAL,
+        status TEXT NOT NULL,
+        message TEXT,
+        first_movement_id INTEGER,
+        last_movement_id INTEGER,
+        captured_at TEXT,
+        synced_at TEXT,
+        user_id TEXT
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sync_receipts_status ON sync_receipts (status, synced_at)")
+    
+    # Cycle counts: stock frozen when the count starts, counted lines streamed in, adjustments posted together
+    c.execute('''CREATE TABLE IF NOT EXISTS count_sessions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        branch_id INTEGER NOT NULL,
+        reference TEXT,
+        status TEXT NOT NULL DEFAULT 'OPEN',
+        snapshot_movement_id INTEGER NOT NULL,
+        posted_movement_id INTEGER,
+        created_at TEXT,
+        created_by TEXT,
+        posted_at TEXT,
+        posted_by TEXT,
+        adjusted_items INTEGER,
+        variance_value REAL,
+        FOREIGN KEY (branch_id) REFERENCES branches (id)
+    )''')
+    c.execute('''CREATE TABLE IF NOT EXISTS count_snapshot (
+        session_id INTEGER NOT NULL,
+        item_id TEXT NOT NULL,
+        frozen_stock REAL NOT NULL,
+        unit_cost REAL,
+        PRIMARY KEY (session_id, item_id)
+    ) WITHOUT ROWID''')
+    c.execute('''CREATE TABLE IF NOT EXISTS count_lines (
+        session_id INTEGER NOT NULL,
+        item_id TEXT NOT NULL,
+        counted_qty REAL NOT NULL,
+        counted_at TEXT,
+        counted_by TEXT,
+        source TEXT,
+        PRIMARY KEY (session_id, item_id)
+    ) WITHOUT ROWID''')
+    
+    # Reservations: stock promised to orders and planned production, one row per reference and item
+    c.execute('''CREATE TABLE IF NOT EXISTS reservations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        reference TEXT NOT NULL,
+        kind TEXT NOT NULL DEFAULT 'ORDER',
+        item_id TEXT NOT NULL,
+        branch_id INTEGER NOT NULL,
+        quantity REAL NOT NULL,
+        status TEXT NOT NULL DEFAULT 'ACTIVE',
+        created_at TEXT,
+        created_by TEXT,
+        closed_at TEXT,
+        closed_by TEXT,
+        FOREIGN KEY (branch_id) REFERENCES branches (id)
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_reservations_reference ON reservations (reference, status)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_reservations_active ON reservations (branch_id, item_id) WHERE status = 'ACTIVE'")
+    
+    # Shipments: transfers leave the source on dispatch and reach the destination on receipt
+    c.execute('''CREATE TABLE IF NOT EXISTS shipments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        reference TEXT,
+        from_branch_id INTEGER NOT NULL,
+        to_branch_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'IN_TRANSIT',
+        dispatched_at TEXT,
+        dispatched_by TEXT,
+        received_at TEXT,
+        closed_at TEXT,
+        closed_by TEXT,
+        variance_value REAL DEFAULT 0,
+        FOREIGN KEY (from_branch_id) REFERENCES branches (id),
+        FOREIGN KEY (to_branch_id) REFERENCES branches (id)
+    )''')
+    # A branch lists its inbound or outbound shipments by status without touching anyone else's
+    c.execute("CREATE INDEX IF NOT EXISTS idx_shipments_inbound ON shipments (to_branch_id, status, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_shipments_outbound ON shipments (from_branch_id, status, id)")
+    c.execute('''CREATE TABLE IF NOT EXISTS shipment_lines (
+        shipment_id INTEGER NOT NULL,
+        item_id TEXT NOT NULL,
+        quantity_sent REAL NOT NULL,
+        quantity_received REAL NOT NULL DEFAULT 0,
+        quantity_lost REAL NOT NULL DEFAULT 0,
+        value_sent REAL DEFAULT 0,
+        PRIMARY KEY (shipment_id, item_id)
+    ) WITHOUT ROWID''')
+    # The lot layers on the truck; receipts recreate them at the destination oldest first
+    c.execute('''CREATE TABLE IF NOT EXISTS shipment_lots (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        shipment_id INTEGER NOT NULL,
+        item_id TEXT NOT NULL,
+        lot_id INTEGER,
+        batch_nr TEXT,
+        received_date TEXT,
+        expiry_date TEXT,
+        unit_cost REAL DEFAULT 0,
+        quantity REAL NOT NULL,
+        remaining REAL NOT NULL
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_shipment_lots_shipment ON shipment_lots (shipment_id, item_id)")
+    # Production schedule: what should be finished where and by when, the input to MRP
+    c.execute('''CREATE TABLE IF NOT EXISTS production_schedule (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        final_product_id TEXT NOT NULL,
+        branch_id INTEGER NOT NULL,
+        quantity REAL NOT NULL,
+        due_date TEXT NOT NULL,
+        reference TEXT,
+        status TEXT NOT NULL DEFAULT 'PLANNED',
+        created_at TEXT,
+        created_by TEXT,
+        FOREIGN KEY (branch_id) REFERENCES branches (id)
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_production_schedule_due ON production_schedule (status, branch_id, due_date)")
+    # Running in-transit stock per branch pair and item
+    c.execute('''CREATE TABLE IF NOT EXISTS in_transit (
+        from_branch_id INTEGER NOT NULL,
+        to_branch_id INTEGER NOT NULL,
+        item_id TEXT NOT NULL,
+        quantity REAL NOT NULL DEFAULT 0,
+        value REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (from_branch_id, to_branch_id, item_id)
+    ) WITHOUT ROWID''')
+    # Demand model state and the stock levels it suggests, stepped forward nightly from new movements
+    c.execute('''CREATE TABLE IF NOT EXISTS demand_forecast (
+        branch_id INTEGER NOT NULL,
+        item_id TEXT NOT NULL,
+        fitted_through TEXT NOT NULL,
+        recent BLOB NOT NULL,
+        level REAL NOT NULL DEFAULT 0,
+        mse_ma REAL NOT NULL DEFAULT 0,
+        mse_ses REAL NOT NULL DEFAULT 0,
+        mse_snaive REAL NOT NULL DEFAULT 0,
+        model TEXT,
+        daily_demand REAL,
+        demand_std REAL,
+        suggested_min_stock REAL,
+        reorder_point REAL,
+        updated_at TEXT,
+        PRIMARY KEY (branch_id, item_id)
+    ) WITHOUT ROWID''')
+    
+    # Day the forecast was last fitted through, kept even when no series had demand
+    c.execute('''CREATE TABLE IF NOT EXISTS demand_forecast_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        fitted_through TEXT NOT NULL
+    )''')
+    c.execute('''INSERT OR IGNORE INTO demand_forecast_state (id, fitted_through)
+                 SELECT 1, MAX(fitted_through) FROM demand_forecast HAVING MAX(fitted_through) IS NOT NULL''')
+    
+    # Stock lots: every receipt opens a lot, every issue draws from lots
+    lots_exist = c.execute("SELECT 1 FROM sqlite_master WHERE name = 'stock_lots'").fetchone()
+    c.execute('''CREATE TABLE IF NOT EXISTS stock_lots (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        item_id TEXT NOT NULL,
+        branch_id INTEGER NOT NULL,
+        batch_nr TEXT,
+        quantity REAL NOT NULL,
+        received_quantity REAL NOT NULL,
+        received_date TEXT,
+        expiry_date TEXT,
+        source_movement_id INTEGER,
+        unit_cost REAL DEFAULT 0,
+        FOREIGN KEY (branch_id) REFERENCES branches (id)
+    )''')
+    c.execute('''CREATE INDEX IF NOT EXISTS idx_stock_lots_open ON stock_lots (item_id, branch_id, expiry_date, received_date)
+                 WHERE quantity > 0''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_stock_lots_batch ON stock_lots (batch_nr)")
+    
+    # Signed quantity each movement put into or took out of each lot
+    c.execute('''CREATE TABLE IF NOT EXISTS lot_movements (
+        movement_id INTEGER NOT NULL,
+        lot_id INTEGER,
+        quantity REAL NOT NULL
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_lot_movements_movement ON lot_movements (movement_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_lot_movements_lot ON lot_movements (lot_id)")
+    
+    # Lots made from (production) or moved out of (transfer) other lots
+    c.execute('''CREATE TABLE IF NOT EXISTS lot_genealogy (
+        parent_lot_id INTEGER NOT NULL,
+        child_lot_id INTEGER NOT NULL,
+        quantity REAL,
+        relation TEXT NOT NULL,
+        movement_id INTEGER,
+        created_date TEXT
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_lot_genealogy_parent ON lot_genealogy (parent_lot_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_lot_genealogy_child ON lot_genealogy (child_lot_id)")
+    
+    # Stock that predates lot tracking becomes one opening lot per item
+    if not lots_exist:
+        c.execute('''INSERT INTO stock_lots (item_id, branch_id, batch_nr, quantity, received_quantity, received_date, unit_cost)
+                     SELECT id, branch_id, 'OPENING', current_stock, current_stock, COALESCE(created_date, ''), cost_per_unit
+                     FROM items WHERE current_stock > 0''')
+    
+    # Columns added after the first release
+    add_column_if_missing(c, 'stock_movements', 'unit_cost', 'REAL')
+    add_column_if_missing(c, 'stock_lots', 'unit_cost', 'REAL DEFAULT 0')
+    if add_column_if_missing(c, 'stock_movements', 'stock_delta', 'REAL'):
+        backfill_stock_deltas(c)
+    if add_column_if_missing(c, 'stock_movements', 'ts', 'INTEGER'):
+        c.execute("UPDATE stock_movements SET ts = CAST(strftime('%s', date_time) AS INTEGER)")
+    
+    # Date-range filters and newest-first listings scan these instead of the table
+    c.execute("CREATE INDEX IF NOT EXISTS idx_stock_movements_ts ON stock_movements (ts)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_stock_movements_branch_ts ON stock_movements (branch_id, ts)")
+    
+    # Rows inserted without ts (imports, direct SQL) get it from date_time
+    c.execute('''CREATE TRIGGER IF NOT EXISTS stock_movements_ts AFTER INSERT ON stock_movements
+                 WHEN new.ts IS NULL BEGIN
+        UPDATE stock_movements SET ts = CAST(strftime('%s', new.date_time) AS INTEGER) WHERE id = new.id;
+    END''')
+    
+    # Daily in/out/net per item and branch, kept current by triggers on stock_movements
+    create_daily_rollup(c)
+    
+    # Change-data-capture outbox for downstream systems
+    create_event_outbox(c)
+    
+    # Append-only, hash-chained record of every movement and item change
+    create_audit_log(c)
+    
+    # Full-text search over items and movement references
+    create_search_index(c)
+    
     # Create default users
     users_exist = c.execute("SELECT COUNT(*) FROM users").fetchone()[0]
     if users_exist == 0:
@@ -120,9 +601,427 @@ def init_database():
     conn.commit()
     conn.close()
 
+def create_item_tables(c):
+    """Create item_catalog, branch_stock and the items view over them, migrating an old items table"""
+    c.execute('''CREATE TABLE IF NOT EXISTS item_catalog (
+        id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        category TEXT NOT NULL,
+        unit TEXT NOT NULL,
+        location TEXT DEFAULT 'Main',
+        warehouse_area TEXT DEFAULT 'General',
+        created_date TEXT,
+        created_by TEXT
+    ) WITHOUT ROWID''')
+    c.execute('''CREATE TABLE IF NOT EXISTS branch_stock (
+        item_id TEXT NOT NULL,
+        branch_id INTEGER NOT NULL,
+        current_stock REAL DEFAULT 0,
+        reserved_stock REAL DEFAULT 0,
+        min_stock REAL DEFAULT 0,
+        cost_per_unit REAL DEFAULT 0,
+        PRIMARY KEY (branch_id, item_id),
+        FOREIGN KEY (branch_id) REFERENCES branches (id)
+    ) WITHOUT ROWID''')
+    # Clustered by branch for per-branch scans; SKU lookups across branches use the index
+    c.execute("CREATE INDEX IF NOT EXISTS idx_branch_stock_item ON branch_stock (item_id)")
+    
+    # Before the split every branch carried its own copy of the metadata; the first copy wins
+    if c.execute("SELECT 1 FROM sqlite_master WHERE name = 'items' AND type = 'table'").fetchone():
+        c.execute('''INSERT OR IGNORE INTO item_catalog (id, name, category, unit, location, warehouse_area, created_date, created_by)
+                     SELECT id, name, category, unit, location, warehouse_area, created_date, created_by
+                     FROM items WHERE rowid IN (SELECT MIN(rowid) FROM items GROUP BY id)''')
+        c.execute('''INSERT OR IGNORE INTO branch_stock (item_id, branch_id, current_stock, min_stock, cost_per_unit)
+                     SELECT id, branch_id, current_stock, min_stock, cost_per_unit FROM items''')
+        # Its triggers go with it and are recreated on the new tables
+        c.execute("DROP TABLE items")
+    
+    # Units promised to open reservations; available = current_stock - reserved_stock
+    add_column_if_missing(c, 'branch_stock', 'reserved_stock', 'REAL DEFAULT 0')
+    view = c.execute("SELECT sql FROM sqlite_master WHERE name = 'items' AND type = 'view'").fetchone()
+    if view and 'available_stock' not in view[0]:
+        c.execute("DROP VIEW items")
+    
+    # CROSS JOIN pins branch_stock as the outer loop: one primary-key probe into the catalog per stock row
+    c.execute('''CREATE VIEW IF NOT EXISTS items AS
+        SELECT s.item_id AS id, s.branch_id, c.name, c.category, c.unit, s.current_stock, s.min_stock, s.cost_per_unit,
+               s.reserved_stock, s.current_stock - s.reserved_stock AS available_stock, c.location, c.warehouse_area, c.created_date, c.created_by
+        FROM branch_stock s
+        CROSS JOIN item_catalog c ON c.id = s.item_id''')
+    
+    # Writes through the view land in the right table; the catalog keeps the first metadata for a SKU
+    c.execute('''CREATE TRIGGER IF NOT EXISTS items_view_insert INSTEAD OF INSERT ON items BEGIN
+        INSERT INTO item_catalog (id, name, category, unit, location, warehouse_area, created_date, created_by)
+        VALUES (new.id, new.name, new.category, new.unit, COALESCE(new.location, 'Main'),
+                COALESCE(new.warehouse_area, 'General'), new.created_date, new.created_by)
+        ON CONFLICT (id) DO NOTHING;
+        INSERT INTO branch_stock (item_id, branch_id, current_stock, min_stock, cost_per_unit)
+        VALUES (new.id, new.branch_id, COALESCE(new.current_stock, 0), COALESCE(new.min_stock, 0), COALESCE(new.cost_per_unit, 0));
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS items_view_update INSTEAD OF UPDATE ON items BEGIN
+        UPDATE branch_stock SET current_stock = new.current_stock, min_stock = new.min_stock, cost_per_unit = new.cost_per_unit
+        WHERE item_id = old.id AND branch_id = old.branch_id;
+        UPDATE item_catalog SET name = new.name, category = new.category, unit = new.unit,
+                                location = new.location, warehouse_area = new.warehouse_area
+        WHERE id = old.id AND (name IS NOT new.name OR category IS NOT new.category OR unit IS NOT new.unit
+                               OR location IS NOT new.location OR warehouse_area IS NOT new.warehouse_area);
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS items_view_delete INSTEAD OF DELETE ON items BEGIN
+        DELETE FROM branch_stock WHERE item_id = old.id AND branch_id = old.branch_id;
+    END''')
+
+# Full recount of the branch summary; the triggers must always agree with it
+BRANCH_SUMMARY_RECOUNT = '''SELECT s.branch_id, c.category, COUNT(*) as items,
+                                 SUM(s.current_stock <= 0) as out_of_stock,
+                                 SUM(s.current_stock > 0 AND s.current_stock <= s.min_stock) as low_stock,
+                                 SUM(s.current_stock) as total_stock,
+                                 SUM(s.current_stock * s.cost_per_unit) as stock_value
+                          FROM branch_stock s
+                          CROSS JOIN item_catalog c ON c.id = s.item_id
+                          GROUP BY s.branch_id, c.category'''
+
+def create_branch_summary(c):
+    """Create the branch summary counters and the triggers that keep them in step with branch_stock"""
+    exists = c.execute("SELECT 1 FROM sqlite_master WHERE name = 'branch_summary'").fetchone()
+    c.execute('''CREATE TABLE IF NOT EXISTS branch_summary (
+        branch_id INTEGER NOT NULL,
+        category TEXT NOT NULL,
+        items INTEGER DEFAULT 0,
+        out_of_stock INTEGER DEFAULT 0,
+        low_stock INTEGER DEFAULT 0,
+        total_stock REAL DEFAULT 0,
+        stock_value REAL DEFAULT 0,
+        PRIMARY KEY (branch_id, category)
+    ) WITHOUT ROWID''')
+    
+    c.execute('''CREATE TRIGGER IF NOT EXISTS branch_summary_insert AFTER INSERT ON branch_stock BEGIN
+        INSERT INTO branch_summary (branch_id, category, items, out_of_stock, low_stock, total_stock, stock_value)
+        SELECT new.branch_id, category, 1, new.current_stock <= 0, new.current_stock > 0 AND new.current_stock <= new.min_stock,
+               new.current_stock, new.current_stock * new.cost_per_unit
+        FROM item_catalog WHERE id = new.item_id
+        ON CONFLICT (branch_id, category) DO UPDATE SET
+            items = items + 1,
+            out_of_stock = out_of_stock + excluded.out_of_stock,
+            low_stock = low_stock + excluded.low_stock,
+            total_stock = total_stock + excluded.total_stock,
+            stock_value = stock_value + excluded.stock_value;
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS branch_summary_delete AFTER DELETE ON branch_stock BEGIN
+        UPDATE branch_summary SET
+            items = items - 1,
+            out_of_stock = out_of_stock - (old.current_stock <= 0),
+            low_stock = low_stock - (old.current_stock > 0 AND old.current_stock <= old.min_stock),
+            total_stock = total_stock - old.current_stock,
+            stock_value = stock_value - old.current_stock * old.cost_per_unit
+        WHERE branch_id = old.branch_id AND category = (SELECT category FROM item_catalog WHERE id = old.item_id);
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS branch_summary_update AFTER UPDATE OF current_stock, min_stock, cost_per_unit ON branch_stock
+                 WHEN new.current_stock IS NOT old.current_stock OR new.min_stock IS NOT old.min_stock
+                      OR new.cost_per_unit IS NOT old.cost_per_unit BEGIN
+        UPDATE branch_summary SET
+            out_of_stock = out_of_stock + (new.current_stock <= 0) - (old.current_stock <= 0),
+            low_stock = low_stock + (new.current_stock > 0 AND new.current_stock <= new.min_stock)
+                                  - (old.current_stock > 0 AND old.current_stock <= old.min_stock),
+            total_stock = total_stock + new.current_stock - old.current_stock,
+            stock_value = stock_value + new.current_stock * new.cost_per_unit - old.current_stock * old.cost_per_unit
+        WHERE branch_id = new.branch_id AND category = (SELECT category FROM item_catalog WHERE id = new.item_id);
+    END''')
+    # A recategorised SKU moves its stock rows between categories in every branch
+    c.execute('''CREATE TRIGGER IF NOT EXISTS branch_summary_category AFTER UPDATE OF category ON item_catalog
+                 WHEN new.category IS NOT old.category BEGIN
+        UPDATE branch_summary SET
+            items = branch_summary.items - 1,
+            out_of_stock = branch_summary.out_of_stock - (s.current_stock <= 0),
+            low_stock = branch_summary.low_stock - (s.current_stock > 0 AND s.current_stock <= s.min_stock),
+            total_stock = branch_summary.total_stock - s.current_stock,
+            stock_value = branch_summary.stock_value - s.current_stock * s.cost_per_unit
+        FROM branch_stock s
+        WHERE s.item_id = new.id AND branch_summary.branch_id = s.branch_id AND branch_summary.category = old.category;
+        INSERT INTO branch_summary (branch_id, category, items, out_of_stock, low_stock, total_stock, stock_value)
+        SELECT branch_id, new.category, 1, current_stock <= 0, current_stock > 0 AND current_stock <= min_stock,
+               current_stock, current_stock * cost_per_unit
+        FROM branch_stock WHERE item_id = new.id
+        ON CONFLICT (branch_id, category) DO UPDATE SET
+            items = items + 1,
+            out_of_stock = out_of_stock + excluded.out_of_stock,
+            low_stock = low_stock + excluded.low_stock,
+            total_stock = total_stock + excluded.total_stock,
+            stock_value = stock_value + excluded.stock_value;
+    END''')
+    
+    if not exists:
+        c.execute(f"INSERT INTO branch_summary (branch_id, category, items, out_of_stock, low_stock, total_stock, stock_value) "
+                  f"{BRANCH_SUMMARY_RECOUNT}")
+
+def add_column_if_missing(c, table, column, declaration):
+    """Add a column to an existing table unless it is already there"""
+    columns = {row[1] for row in c.execute(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+        return True
+    return False
+
+def backfill_stock_deltas(c):
+    """Work out the signed stock effect of movements recorded before stock_delta existed"""
+    in_types = ", ".join(f"'{t}'" for t in STOCK_IN_TYPES)
+    c.execute(f'''UPDATE stock_movements SET stock_delta = CASE
+                      WHEN movement_type IN ({in_types}) THEN quantity
+                      ELSE -quantity
+                  END
+                  WHERE movement_type != 'ADMIN_SET' ''')
+    
+    # ADMIN_SET only kept the old level in its reference text
+    for movement_id, quantity, reference in c.execute(
+            "SELECT id, quantity, reference FROM stock_movements WHERE movement_type = 'ADMIN_SET'").fetchall():
+        match = re.match(r"SET from (-?[\d.]+) to", reference or "")
+        if match:
+            c.execute("UPDATE stock_movements SET stock_delta = ? WHERE id = ?", (quantity - float(match.group(1)), movement_id))
+
+def create_daily_rollup(c):
+    """Create the daily movement rollup and the triggers that keep it in step"""
+    exists = c.execute("SELECT 1 FROM sqlite_master WHERE name = 'stock_daily'").fetchone()
+    c.execute('''CREATE TABLE IF NOT EXISTS stock_daily (
+        item_id TEXT NOT NULL,
+        branch_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        qty_in REAL DEFAULT 0,
+        qty_out REAL DEFAULT 0,
+        net_change REAL DEFAULT 0,
+        movements INTEGER DEFAULT 0,
+        PRIMARY KEY (item_id, branch_id, day)
+    ) WITHOUT ROWID''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_stock_daily_day ON stock_daily (day)")
+    
+    c.execute('''CREATE TRIGGER IF NOT EXISTS stock_daily_insert AFTER INSERT ON stock_movements
+                 WHEN new.stock_delta IS NOT NULL BEGIN
+        INSERT INTO stock_daily (item_id, branch_id, day, qty_in, qty_out, net_change, movements)
+        VALUES (new.item_id, new.branch_id, substr(new.date_time, 1, 10),
+                max(new.stock_delta, 0), max(-new.stock_delta, 0), new.stock_delta, 1)
+        ON CONFLICT (item_id, branch_id, day) DO UPDATE SET
+            qty_in = qty_in + excluded.qty_in,
+            qty_out = qty_out + excluded.qty_out,
+            net_change = net_change + excluded.net_change,
+            movements = movements + 1;
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS stock_daily_delete AFTER DELETE ON stock_movements
+                 WHEN old.stock_delta IS NOT NULL BEGIN
+        UPDATE stock_daily SET
+            qty_in = qty_in - max(old.stock_delta, 0),
+            qty_out = qty_out - max(-old.stock_delta, 0),
+            net_change = net_change - old.stock_delta,
+            movements = movements - 1
+        WHERE item_id = old.item_id AND branch_id = old.branch_id AND day = substr(old.date_time, 1, 10);
+    END''')
+    
+    if not exists:
+        c.execute('''INSERT INTO stock_daily (item_id, branch_id, day, qty_in, qty_out, net_change, movements)
+                     SELECT item_id, branch_id, substr(date_time, 1, 10),
+                            SUM(max(stock_delta, 0)), SUM(max(-stock_delta, 0)), SUM(stock_delta), COUNT(*)
+                     FROM stock_movements WHERE stock_delta IS NOT NULL
+                     GROUP BY item_id, branch_id, substr(date_time, 1, 10)''')
+
+def create_event_outbox(c):
+    """Create the stock change outbox and the triggers that fill it inside each writing transaction"""
+    c.execute('''CREATE TABLE IF NOT EXISTS stock_events (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        event_type TEXT NOT NULL,
+        item_id TEXT NOT NULL,
+        branch_id INTEGER NOT NULL,
+        movement_id INTEGER,
+        movement_type TEXT,
+        quantity REAL,
+        stock_delta REAL,
+        stock_after REAL,
+        reference TEXT,
+        user_id TEXT,
+        created_at TEXT NOT NULL
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_stock_events_time ON stock_events (created_at)")
+    
+    # Durable read positions of downstream consumers
+    c.execute('''CREATE TABLE IF NOT EXISTS event_consumers (
+        name TEXT PRIMARY KEY,
+        last_seq INTEGER NOT NULL DEFAULT 0,
+        updated_at TEXT
+    )''')
+    
+    # Movements are inserted before items.current_stock moves, so the level after is old stock plus delta
+    c.execute('''CREATE TRIGGER IF NOT EXISTS stock_events_movement AFTER INSERT ON stock_movements
+                 WHEN new.stock_delta IS NOT NULL BEGIN
+        INSERT INTO stock_events (event_type, item_id, branch_id, movement_id, movement_type, quantity, stock_delta,
+                                  stock_after, reference, user_id, created_at)
+        VALUES ('movement', new.item_id, new.branch_id, new.id, new.movement_type, new.quantity, new.stock_delta,
+                COALESCE((SELECT current_stock FROM branch_stock WHERE item_id = new.item_id AND branch_id = new.branch_id), 0) + new.stock_delta,
+                new.reference, new.user_id, new.date_time);
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS stock_events_item_created AFTER INSERT ON branch_stock BEGIN
+        INSERT INTO stock_events (event_type, item_id, branch_id, stock_after, user_id, created_at)
+        VALUES ('item_created', new.item_id, new.branch_id, new.current_stock,
+                (SELECT created_by FROM item_catalog WHERE id = new.item_id), datetime('now', 'localtime'));
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS stock_events_item_deleted AFTER DELETE ON branch_stock BEGIN
+        INSERT INTO stock_events (event_type, item_id, branch_id, stock_after, created_at)
+        VALUES ('item_deleted', old.item_id, old.branch_id, 0, datetime('now', 'localtime'));
+    END''')
+
+def create_audit_log(c):
+    """Create the compact audit log, its string dictionary and the triggers that append to it"""
+    audit_exists = c.execute("SELECT 1 FROM sqlite_master WHERE name = 'audit_log'").fetchone()
+    
+    # Item ids, users, movement types and references are stored once and referenced by id
+    c.execute('''CREATE TABLE IF NOT EXISTS audit_strings (
+        id INTEGER PRIMARY KEY,
+        value TEXT NOT NULL UNIQUE
+    )''')
+    
+    # op: 1 movement, 2 movement deleted, 3 item created, 4 item deleted.
+    # ts is epoch seconds of the same local wall-clock time date_time holds.
+    # hash stays NULL until seal_audit_log chains the row to its branch.
+    c.execute('''CREATE TABLE IF NOT EXISTS audit_log (
+        seq INTEGER PRIMARY KEY,
+        branch_id INTEGER NOT NULL,
+        ts INTEGER NOT NULL,
+        op INTEGER NOT NULL,
+        type_ref INTEGER,
+        item_ref INTEGER,
+        user_ref INTEGER,
+        reference_ref INTEGER,
+        movement_id INTEGER,
+        quantity REAL,
+        stock_delta REAL,
+        hash BLOB
+    )''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_audit_log_branch ON audit_log (branch_id, seq)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_audit_log_unsealed ON audit_log (seq) WHERE hash IS NULL")
+    
+    # Where each branch's chain was last verified
+    c.execute('''CREATE TABLE IF NOT EXISTS audit_checkpoints (
+        branch_id INTEGER PRIMARY KEY,
+        last_seq INTEGER NOT NULL,
+        last_hash BLOB NOT NULL,
+        verified_at TEXT
+    )''')
+    
+    # Append-only: rows may only gain their hash
+    c.execute('''CREATE TRIGGER IF NOT EXISTS audit_log_no_delete BEFORE DELETE ON audit_log BEGIN
+        SELECT RAISE(ABORT, 'audit_log is append-only');
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS audit_log_no_update
+                 BEFORE UPDATE OF seq, branch_id, ts, op, type_ref, item_ref, user_ref, reference_ref, movement_id,
+                                  quantity, stock_delta ON audit_log BEGIN
+        SELECT RAISE(ABORT, 'audit_log is append-only');
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS audit_log_no_reseal BEFORE UPDATE OF hash ON audit_log
+                 WHEN old.hash IS NOT NULL BEGIN
+        SELECT RAISE(ABORT, 'audit_log rows are sealed');
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS audit_strings_no_change BEFORE UPDATE ON audit_strings BEGIN
+        SELECT RAISE(ABORT, 'audit_strings is append-only');
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS audit_strings_no_delete BEFORE DELETE ON audit_strings BEGIN
+        SELECT RAISE(ABORT, 'audit_strings is append-only');
+    END''')
+    
+    def ref(value):
+        return f"(SELECT id FROM audit_strings WHERE value = {value})"
+    
+    def intern(*values):
+        union = " UNION ALL ".join(f"SELECT {value} AS value" for value in values)
+        return f"INSERT OR IGNORE INTO audit_strings (value) SELECT value FROM ({union}) WHERE value IS NOT NULL;"
+    
+    now = "CAST(strftime('%s', 'now', 'localtime') AS INTEGER)"
+    for name, event, row, op, ts in (('audit_movement_insert', 'INSERT', 'new', 1,
+                                      f"COALESCE(CAST(strftime('%s', new.date_time) AS INTEGER), {now})"),
+                                     ('audit_movement_delete', 'DELETE', 'old', 2, now)):
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON stock_movements BEGIN
+            {intern(f"{row}.movement_type", f"{row}.item_id", f"{row}.user_id", f"NULLIF({row}.reference, '')")}
+            INSERT INTO audit_log (branch_id, ts, op, type_ref, item_ref, user_ref, reference_ref, movement_id, quantity, stock_delta)
+            VALUES ({row}.branch_id, {ts}, {op}, {ref(f"{row}.movement_type")}, {ref(f"{row}.item_id")},
+                    {ref(f"{row}.user_id")}, {ref(f"NULLIF({row}.reference, '')")}, {row}.id, {row}.quantity, {row}.stock_delta);
+        END''')
+    for name, event, row, op, user in (('audit_item_insert', 'INSERT', 'new', 3,
+                                        "(SELECT created_by FROM item_catalog WHERE id = new.item_id)"),
+                                       ('audit_item_delete', 'DELETE', 'old', 4, "NULL")):
+        c.execute(f'''CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON branch_stock BEGIN
+            {intern(f"{row}.item_id", user)}
+            INSERT INTO audit_log (branch_id, ts, op, item_ref, user_ref, quantity)
+            VALUES ({row}.branch_id, {now}, {op}, {ref(f"{row}.item_id")}, {ref(user)}, {row}.current_stock);
+        END''')
+    
+    # Movements recorded before the audit log existed open each branch's chain
+    if not audit_exists:
+        c.execute('''INSERT OR IGNORE INTO audit_strings (value)
+                     SELECT value FROM (SELECT movement_type AS value FROM stock_movements
+                                        UNION SELECT item_id FROM stock_movements
+                                        UNION SELECT user_id FROM stock_movements
+                                        UNION SELECT NULLIF(reference, '') FROM stock_movements)
+                     WHERE value IS NOT NULL''')
+        c.execute('''INSERT INTO audit_log (branch_id, ts, op, type_ref, item_ref, user_ref, reference_ref, movement_id, quantity, stock_delta)
+                     SELECT sm.branch_id, COALESCE(CAST(strftime('%s', sm.date_time) AS INTEGER), 0), 1,
+                            t.id, i.id, u.id, r.id, sm.id, sm.quantity, sm.stock_delta
+                     FROM stock_movements sm
+                     LEFT JOIN audit_strings t ON t.value = sm.movement_type
+                     LEFT JOIN audit_strings i ON i.value = sm.item_id
+                     LEFT JOIN audit_strings u ON u.value = sm.user_id
+                     LEFT JOIN audit_strings r ON r.value = NULLIF(sm.reference, '')
+                     ORDER BY sm.id''')
+
+def create_search_index(c):
+    """Create the FTS5 search tables and the triggers that keep them in sync"""
+    existing = {row[0] for row in c.execute("SELECT name FROM sqlite_master WHERE name IN ('items_fts', 'movements_fts')")}
+    
+    # Items keep their own copy: items has no stable integer key to point at
+    c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(
+        item_id, name, category, branch_id UNINDEXED,
+        tokenize = 'unicode61'
+    )''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS items_fts_insert AFTER INSERT ON branch_stock BEGIN
+        INSERT INTO items_fts (item_id, name, category, branch_id)
+        SELECT id, name, category, new.branch_id FROM item_catalog WHERE id = new.item_id;
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS items_fts_delete AFTER DELETE ON branch_stock BEGIN
+        DELETE FROM items_fts WHERE rowid IN (
+            SELECT rowid FROM items_fts WHERE items_fts MATCH 'item_id:' || '"' || replace(old.item_id, '"', '""') || '"'
+        ) AND item_id = old.item_id AND branch_id = old.branch_id;
+    END''')
+    # A catalog change re-indexes the SKU in every branch that stocks it
+    c.execute('''CREATE TRIGGER IF NOT EXISTS items_fts_update AFTER UPDATE OF name, category ON item_catalog BEGIN
+        DELETE FROM items_fts WHERE rowid IN (
+            SELECT rowid FROM items_fts WHERE items_fts MATCH 'item_id:' || '"' || replace(old.id, '"', '""') || '"'
+        ) AND item_id = old.id;
+        INSERT INTO items_fts (item_id, name, category, branch_id)
+        SELECT new.id, new.name, new.category, branch_id FROM branch_stock WHERE item_id = new.id;
+    END''')
+    
+    # Movements are indexed in place through their integer id
+    c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS movements_fts USING fts5(
+        item_id, reference, batch_nr, invoice_nr, po_nr,
+        content = 'stock_movements', content_rowid = 'id', tokenize = 'unicode61'
+    )''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS movements_fts_insert AFTER INSERT ON stock_movements BEGIN
+        INSERT INTO movements_fts (rowid, item_id, reference, batch_nr, invoice_nr, po_nr)
+        VALUES (new.id, new.item_id, new.reference, new.batch_nr, new.invoice_nr, new.po_nr);
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS movements_fts_delete AFTER DELETE ON stock_movements BEGIN
+        INSERT INTO movements_fts (movements_fts, rowid, item_id, reference, batch_nr, invoice_nr, po_nr)
+        VALUES ('delete', old.id, old.item_id, old.reference, old.batch_nr, old.invoice_nr, old.po_nr);
+    END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS movements_fts_update AFTER UPDATE OF item_id, reference, batch_nr, invoice_nr, po_nr ON stock_movements BEGIN
+        INSERT INTO movements_fts (movements_fts, rowid, item_id, reference, batch_nr, invoice_nr, po_nr)
+        VALUES ('delete', old.id, old.item_id, old.reference, old.batch_nr, old.invoice_nr, old.po_nr);
+        INSERT INTO movements_fts (rowid, item_id, reference, batch_nr, invoice_nr, po_nr)
+        VALUES (new.id, new.item_id, new.reference, new.batch_nr, new.invoice_nr, new.po_nr);
+    END''')
+    
+    # Index rows that existed before the search tables
+    if 'items_fts' not in existing:
+        c.execute("INSERT INTO items_fts (item_id, name, category, branch_id) SELECT id, name, category, branch_id FROM items")
+    if 'movements_fts' not in existing:
+        c.execute("INSERT INTO movements_fts (movements_fts) VALUES ('rebuild')")
+
 def load_sample_data():
     """Load sample inventory data into main branch"""
-    conn = sqlite3.connect('inventory.db')
+    conn = get_connection()
     c = conn.cursor()
     
     # Check if data exists
@@ -169,6 +1068,7 @@ def load_sample_data():
                      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
                   (item_id, main_branch_id, name, category, unit, current_stock, min_stock, 0, "Main", "General",
                    datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "system"))
+        create_lot(c, item_id, main_branch_id, current_stock, "OPENING", datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
     
     # Add sample BOM data
     sample_bom = [
@@ -198,6 +1098,7 @@ def load_sample_data():
     
     conn.commit()
     conn.close()
+    notify_data_change(("items", "bom"), "system")
 
 # ===============================
 # AUTHENTICATION & PERMISSIONS
@@ -205,7 +1106,7 @@ def load_sample_data():
 
 def authenticate_user(username, password):
     """Authenticate user and return role"""
-    conn = sqlite3.connect('inventory.db')
+    conn = get_connection()
     c = conn.cursor()
     
     password_hash = hashlib.sha256(password.encode()).hexdigest()
@@ -238,136 +1139,973 @@ def check_permission(required_role):
     return user_role in permissions.get(required_role, [])
 
 # ===============================
-# DATABASE OPERATIONS
+# SHARED DATA HUB
 # ===============================
 
-def get_all_branches(active_only=True):
-    """Get all branches"""
-    conn = sqlite3.connect('inventory.db')
-    query = "SELECT * FROM branches"
-    if active_only:
-        query += " WHERE is_active = 1"
-    query += " ORDER BY branch_name"
+class InventoryDataHub:
+    """Process-wide inventory snapshot shared by every Streamlit session.
+
+    Branches and items are loaded once per change instead of once per
+    session rerun. Write functions call notify_data_change() so the snapshot
+    is marked stale immediately; PRAGMA data_version also catches commits made
+    by other processes. Sessions compare their last seen generation against
+    the hub to learn about changes made by other users.
+    """
+
+    QUERY_CACHE_SIZE = 64
+    RECENT_CHANGES = 200
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.generation = 0
+        self._lock = threading.RLock()
+        self._conn = get_connection(db_path, check_same_thread=False)
+        self._data_version = None
+        self._stale = True
+        self._branches = None
+        self._items = None
+        self._query_cache = OrderedDict()
+        self._changes = deque(maxlen=self.RECENT_CHANGES)
+        self._subscribers = {}
+        self._undelivered = deque()
+
+    def _check_data_version(self):
+        """Detect commits from connections the hub was not told about"""
+        version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if self._data_version is not None and version != self._data_version and not self._stale:
+            self._publish(("external",), None)
+        self._data_version = version
+
+    def _ensure_fresh(self):
+        """Reload the snapshot if anything changed since the last load"""
+        with self._lock:
+            self._reload_if_stale()
+        self._deliver()
+
+    def _reload_if_stale(self):
+        self._check_data_version()
+        if self._stale:
+            self._branches = pd.read_sql_query("SELECT * FROM branches ORDER BY branch_name", self._conn)
+            self._items = pd.read_sql_query("""SELECT i.*, b.branch_name, b.branch_code 
+                                               FROM items i 
+                                               JOIN branches b ON i.branch_id = b.id
+                                               ORDER BY b.branch_name, i.category, i.name""", self._conn)
+            self._query_cache.clear()
+            self._stale = False
+
+    def _publish(self, tables, user_id):
+        """Record a change; subscribers are called by _deliver once the lock is released"""
+        self.generation += 1
+        self._stale = True
+        change = {'generation': self.generation, 'tables': tuple(tables), 'user_id': user_id,
+                  'time': datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        self._changes.append(change)
+        self._undelivered.append(change)
+
+    def _deliver(self):
+        """Fan out published changes to subscribers outside the hub lock"""
+        while True:
+            try:
+                change = self._undelivered.popleft()
+            except IndexError:
+                return
+            for callback in list(self._subscribers.values()):
+                try:
+                    callback(change)
+                except Exception:
+                    pass
+
+    def notify(self, tables, user_id=None):
+        """Called by write functions after they commit"""
+        with self._lock:
+            self._publish(tables, user_id)
+        self._deliver()
+
+    def subscribe(self, callback):
+        """Register a callback for change notifications, returns a token"""
+        token = uuid.uuid4().hex
+        with self._lock:
+            self._subscribers[token] = callback
+        return token
+
+    def unsubscribe(self, token):
+        """Remove a change notification callback"""
+        with self._lock:
+            self._subscribers.pop(token, None)
+
+    def changes_since(self, generation):
+        """Changes published after the given generation, oldest first"""
+        self._ensure_fresh()
+        with self._lock:
+            return [c for c in self._changes if c['generation'] > generation]
+
+    def get_branches(self, active_only=True):
+        """Branches from the shared snapshot"""
+        self._ensure_fresh()
+        with self._lock:
+            df = self._branches
+        if active_only:
+            df = df[df['is_active'] == 1]
+        return df.reset_index(drop=True)
+
+    def get_items(self, user_role, branch_id=None):
+        """Items visible to a role from the shared snapshot"""
+        self._ensure_fresh()
+        with self._lock:
+            df = self._items
+        if user_role == "viewer":
+            # Viewers only see final products
+            df = df[df['category'] == 'Final Product']
+        if branch_id:
+            df = df[df['branch_id'] == int(branch_id)]
+        return df.reset_index(drop=True)
+
+    def current_generation(self):
+        """Generation after checking for commits from other connections"""
+        with self._lock:
+            self._check_data_version()
+            generation = self.generation
+        self._deliver()
+        return generation
+
+    def query(self, query, params=()):
+        """Run a read query, sharing the result between sessions until the next change"""
+        params = tuple(p.item() if hasattr(p, 'item') else p for p in params)
+        key = (query, params)
+        with self._lock:
+            self._reload_if_stale()
+            df = self._query_cache.get(key)
+            if df is not None:
+                self._query_cache.move_to_end(key)
+            else:
+                df = pd.read_sql_query(query, self._conn, params=list(params))
+                self._query_cache[key] = df
+                if len(self._query_cache) > self.QUERY_CACHE_SIZE:
+                    self._query_cache.popitem(last=False)
+        self._deliver()
+        return df.copy()
+
+@st.cache_resource
+def get_data_hub():
+    """Get the process-wide data hub"""
+    return InventoryDataHub(DB_PATH)
+
+def notify_data_change(tables, user_id=None):
+    """Tell the shared hub (and its subscribers) that tables changed"""
+    get_data_hub().notify(tables, user_id)
+
+# ===============================
+# READ SNAPSHOT
+# ===============================
+
+# Roles that only read; their pages are served from the snapshot copy
+READ_ONLY_ROLES = ("boss", "viewer")
+
+# Seconds a snapshot may lag the live database once something has changed
+SNAPSHOT_MAX_AGE = 30
+
+class SnapshotDataHub(InventoryDataHub):
+    """Data hub over a periodic backup-API copy of the database.
+
+    Read-only roles query the copy, so heavy reports never hold read
+    transactions or compete for cache on the file managers write to. The copy
+    is rebuilt at most every SNAPSHOT_MAX_AGE seconds, and only after the live
+    database changed; a reader that finds another thread refreshing keeps
+    using the previous copy instead of waiting.
+    """
+
+    def __init__(self, db_path, source_hub):
+        self.snapshot_path = f"{db_path}.snapshot"
+        self.source_hub = source_hub
+        self.source_generation = None
+        self.refreshed_at = None
+        self.refresh_seconds = None
+        self._refresh_lock = threading.Lock()
+        super().__init__(db_path)
+
+    def _check_data_version(self):
+        """The copy never changes in place; freshness is decided in _refresh_if_due"""
+
+    def _ensure_fresh(self):
+        self._refresh_if_due()
+        super()._ensure_fresh()
+
+    def query(self, query, params=()):
+        self._refresh_if_due()
+        return super().query(query, params)
+
+    def _refresh_if_due(self):
+        """Refresh outside the hub lock so other readers keep using the current copy"""
+        due = (self.refreshed_at is None or
+               time.time() - self.refreshed_at >= SNAPSHOT_MAX_AGE and
+               self.source_hub.current_generation() != self.source_generation)
+        if due and self._refresh_lock.acquire(blocking=self.refreshed_at is None):
+            try:
+                if self.refreshed_at is None or time.time() - self.refreshed_at >= SNAPSHOT_MAX_AGE:
+                    self._refresh()
+            finally:
+                self._refresh_lock.release()
+
+    def _refresh(self):
+        """Copy the live database with the backup API and swap the copy in atomically"""
+        started = time.perf_counter()
+        generation = self.source_hub.current_generation()
+        temp_path = f"{self.snapshot_path}.{uuid.uuid4().hex[:8]}.tmp"
+        
+        source = sqlite3.connect(self.db_path)
+        target = sqlite3.connect(temp_path)
+        try:
+            source.backup(target)
+            target.execute("PRAGMA journal_mode=DELETE")
+        finally:
+            target.close()
+            source.close()
+        os.replace(temp_path, self.snapshot_path)
+        
+        # immutable: the file is never written again, so readers skip locking entirely
+        conn = get_connection(f"file:{os.path.abspath(self.snapshot_path)}?mode=ro&immutable=1",
+                              uri=True, check_same_thread=False)
+        with self._lock:
+            old_conn, self._conn = self._conn, conn
+            self.source_generation = generation
+            self.refreshed_at = time.time()
+            self.refresh_seconds = time.perf_counter() - started
+            self._publish(("snapshot",), None)
+        self._deliver()
+        old_conn.close()
+
+@st.cache_resource
+def get_snapshot_hub():
+    """Get the process-wide read snapshot hub"""
+    return SnapshotDataHub(DB_PATH, get_data_hub())
+
+def get_read_hub():
+    """Hub for the current session: the snapshot for read-only roles, live data otherwise"""
+    if st.session_state.get('user_role') in READ_ONLY_ROLES:
+        return get_snapshot_hub()
+    return get_data_hub()
+
+# ===============================
+# STOCK MOVEMENTS & LOTS
+# ===============================
+
+STOCK_IN_TYPES = ['IN', 'ADMIN_IN', 'TRANSFER_IN', 'PRODUCTION']
+
+# FEFO: earliest expiry first, then oldest receipt. FIFO: oldest receipt first.
+LOT_ALLOCATION = 'FEFO'
+LOT_ORDER = {
+    'FEFO': "expiry_date IS NULL, expiry_date, received_date, id",
+    'FIFO': "received_date, id"
+}
+
+# Issues are costed from their FIFO lot layers or at the moving average ('AVERAGE')
+COSTING_METHOD = 'FIFO'
+
+# Remainders smaller than this are rounding noise
+QUANTITY_EPSILON = 1e-9
+
+UNIX_EPOCH = datetime(1970, 1, 1)
+
+def movement_epoch(timestamp):
+    """stock_movements.ts for a wall-clock time, as SQLite's strftime('%s') reads date_time"""
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    return int((timestamp - UNIX_EPOCH).total_seconds())
+
+def record_movement(c, item_id, branch_id, movement_type, quantity, reference="", batch_nr="", invoice_nr="", po_nr="",
+                    user_id="system", timestamp=None, from_branch_id=None, to_branch_id=None, unit_cost=None, stock_delta=None):
+    """Insert a stock movement row on an open cursor, returns its id.
+
+    stock_delta is the signed change to current_stock; it defaults from the
+    movement type and must be given for types that set a level (ADMIN_SET).
+    """
+    if stock_delta is None:
+        stock_delta = quantity if movement_type in STOCK_IN_TYPES else -quantity
+    timestamp = timestamp or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    c.execute('''INSERT INTO stock_movements (item_id, branch_id, movement_type, quantity, reference, batch_nr, invoice_nr, po_nr, date_time, ts, user_id, from_branch_id, to_branch_id, unit_cost, stock_delta)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+              (item_id, branch_id, movement_type, quantity, reference, batch_nr, invoice_nr, po_nr,
+               timestamp, movement_epoch(timestamp), user_id, from_branch_id, to_branch_id, unit_cost, stock_delta))
+    return c.lastrowid
+
+def create_lot(c, item_id, branch_id, quantity, batch_nr, received_date, expiry_date=None, movement_id=None, unit_cost=0):
+    """Open a new lot holding quantity, returns its id"""
+    c.execute('''INSERT INTO stock_lots (item_id, branch_id, batch_nr, quantity, received_quantity, received_date, expiry_date, source_movement_id, unit_cost)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+              (item_id, branch_id, batch_nr, quantity, quantity, received_date, expiry_date or None, movement_id, unit_cost or 0))
+    lot_id = c.lastrowid
+    if movement_id is not None:
+        c.execute("INSERT INTO lot_movements (movement_id, lot_id, quantity) VALUES (?, ?, ?)", (movement_id, lot_id, quantity))
+    return lot_id
+
+def receive_lots(c, item_id, branch_id, quantity, movement_id, batch_nr="", received_date=None, expiry_date=None, source_lots=None,
+                 unit_cost=0):
+    """Put incoming stock into lots, returns the lots created.
+
+    source_lots carries lots consumed elsewhere (a transfer out); each one is
+    recreated here with its batch, dates and a genealogy link so traces follow
+    the goods between branches. Recreated lots keep their own cost layer.
+    """
+    received_date = received_date or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    created = []
+    remaining = quantity
+    
+    for source in source_lots or []:
+        if source['lot_id'] is None or remaining <= QUANTITY_EPSILON:
+            continue
+        take = min(source['quantity'], remaining)
+        lot_id = create_lot(c, item_id, branch_id, take, source['batch_nr'], source['received_date'],
+                            source['expiry_date'], movement_id, source['unit_cost'])
+        c.execute('''INSERT INTO lot_genealogy (parent_lot_id, child_lot_id, quantity, relation, movement_id, created_date)
+                     VALUES (?, ?, ?, 'transfer', ?, ?)''',
+                  (source['lot_id'], lot_id, take, movement_id, received_date))
+        created.append({'lot_id': lot_id, 'quantity': take, 'batch_nr': source['batch_nr'],
+                        'received_date': source['received_date'], 'expiry_date': source['expiry_date'],
+                        'unit_cost': source['unit_cost']})
+        remaining -= take
+    
+    if remaining > QUANTITY_EPSILON:
+        batch = batch_nr or f"LOT{movement_id:06d}"
+        lot_id = create_lot(c, item_id, branch_id, remaining, batch, received_date, expiry_date, movement_id, unit_cost)
+        created.append({'lot_id': lot_id, 'quantity': remaining, 'batch_nr': batch,
+                        'received_date': received_date, 'expiry_date': expiry_date or None,
+                        'unit_cost': unit_cost or 0})
+    
+    return created
+
+def consume_lots(c, item_id, branch_id, quantity, movement_id):
+    """Take outgoing stock from lots in LOT_ALLOCATION order, returns the allocations.
+
+    Must run before items.current_stock is reduced: stock not covered by any
+    lot (items created before lot tracking, direct edits) is first put into an
+    OPENING lot so it is consumed oldest-first like everything else.
+    """
+    order = LOT_ORDER[LOT_ALLOCATION]
+    query = f'''SELECT id, quantity, batch_nr, received_date, expiry_date, unit_cost FROM stock_lots
+                WHERE item_id = ? AND branch_id = ? AND quantity > 0
+                ORDER BY {order}'''
+    lots = c.execute(query, (item_id, branch_id)).fetchall()
+    available = sum(lot[1] for lot in lots)
+    
+    if available + QUANTITY_EPSILON < quantity:
+        item = c.execute("SELECT current_stock, created_date, cost_per_unit FROM items WHERE id = ? AND branch_id = ?",
+                         (item_id, branch_id)).fetchone()
+        if item and item[0] - available > QUANTITY_EPSILON:
+            create_lot(c, item_id, branch_id, item[0] - available, "OPENING", item[1] or "", unit_cost=item[2])
+            lots = c.execute(query, (item_id, branch_id)).fetchall()
+    
+    allocations = []
+    remaining = quantity
+    
+    for lot_id, lot_qty, batch_nr, received_date, expiry_date, unit_cost in lots:
+        if remaining <= QUANTITY_EPSILON:
+            break
+        take = min(lot_qty, remaining)
+        c.execute("UPDATE stock_lots SET quantity = ? WHERE id = ?",
+                  (0 if lot_qty - take <= QUANTITY_EPSILON else lot_qty - take, lot_id))
+        c.execute("INSERT INTO lot_movements (movement_id, lot_id, quantity) VALUES (?, ?, ?)", (movement_id, lot_id, -take))
+        allocations.append({'lot_id': lot_id, 'quantity': take, 'batch_nr': batch_nr,
+                            'received_date': received_date, 'expiry_date': expiry_date, 'unit_cost': unit_cost})
+        remaining -= take
+    
+    # Stock going negative: keep the unallocated part visible, priced at average cost
+    if remaining > QUANTITY_EPSILON:
+        c.execute("INSERT INTO lot_movements (movement_id, lot_id, quantity) VALUES (?, NULL, ?)", (movement_id, -remaining))
+        average = c.execute("SELECT cost_per_unit FROM branch_stock WHERE item_id = ? AND branch_id = ?", (item_id, branch_id)).fetchone()
+        allocations.append({'lot_id': None, 'quantity': remaining, 'batch_nr': None,
+                            'received_date': None, 'expiry_date': None, 'unit_cost': average[0] if average else 0})
+    
+    return allocations
+
+def update_average_cost(c, item_id, branch_id, quantity, unit_cost):
+    """Fold a receipt into the item's moving-average cost, before current_stock is raised"""
+    c.execute('''UPDATE branch_stock SET cost_per_unit = CASE
+                     WHEN current_stock <= 0 OR current_stock + ? <= 0 THEN ?
+                     ELSE (current_stock * cost_per_unit + ? * ?) / (current_stock + ?)
+                 END
+                 WHERE item_id = ? AND branch_id = ?''',
+              (quantity, unit_cost, quantity, unit_cost, quantity, item_id, branch_id))
+
+def issue_cost(c, item_id, branch_id, quantity, allocations):
+    """Unit cost of an issue: its lot layers under FIFO, the moving average otherwise"""
+    if COSTING_METHOD == 'FIFO' and quantity > 0:
+        return sum(a['quantity'] * (a['unit_cost'] or 0) for a in allocations) / quantity
+    average = c.execute("SELECT cost_per_unit FROM branch_stock WHERE item_id = ? AND branch_id = ?", (item_id, branch_id)).fetchone()
+    return average[0] if average else 0
+
+def apply_stock_movement(c, item_id, branch_id, quantity, movement_type, reference="", batch_nr="", invoice_nr="", po_nr="",
+                         user_id="system", timestamp=None, from_branch_id=None, to_branch_id=None, expiry_date=None,
+                         source_lots=None, unit_cost=None):
+    """Record a movement, move the lots and adjust current_stock and cost on an open cursor.
+
+    Receipts without a unit_cost come in at the cost of their source lots, or
+    at the current average. Returns (movement_id, lots) where lots are the lots
+    created for incoming types or the allocations consumed for outgoing ones.
+    """
+    timestamp = timestamp or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    
+    if movement_type in STOCK_IN_TYPES:
+        if unit_cost is None and source_lots:
+            unit_cost = sum(a['quantity'] * (a['unit_cost'] or 0) for a in source_lots) / sum(a['quantity'] for a in source_lots)
+        if unit_cost is None:
+            average = c.execute("SELECT cost_per_unit FROM branch_stock WHERE item_id = ? AND branch_id = ?", (item_id, branch_id)).fetchone()
+            unit_cost = average[0] if average else 0
+        
+        movement_id = record_movement(c, item_id, branch_id, movement_type, quantity, reference, batch_nr, invoice_nr, po_nr,
+                                      user_id, timestamp, from_branch_id, to_branch_id, unit_cost)
+        lots = receive_lots(c, item_id, branch_id, quantity, movement_id, batch_nr, timestamp, expiry_date, source_lots, unit_cost)
+        update_average_cost(c, item_id, branch_id, quantity, unit_cost)
+        c.execute("UPDATE branch_stock SET current_stock = current_stock + ? WHERE item_id = ? AND branch_id = ?", 
+                 (quantity, item_id, branch_id))
+    else:
+        movement_id = record_movement(c, item_id, branch_id, movement_type, quantity, reference, batch_nr, invoice_nr, po_nr,
+                                      user_id, timestamp, from_branch_id, to_branch_id)
+        lots = consume_lots(c, item_id, branch_id, quantity, movement_id)
+        c.execute("UPDATE stock_movements SET unit_cost = ? WHERE id = ?",
+                  (issue_cost(c, item_id, branch_id, quantity, lots), movement_id))
+        c.execute("UPDATE branch_stock SET current_stock = current_stock - ? WHERE item_id = ? AND branch_id = ?", 
+                 (quantity, item_id, branch_id))
     
-    df = pd.read_sql_query(query, conn)
+    return movement_id, lots
+
+def get_item_lots(item_id, branch_id, include_empty=False):
+    """Get the lots of an item in a branch in allocation order"""
+    conn = get_connection()
+    query = '''SELECT * FROM stock_lots WHERE item_id = ? AND branch_id = ?'''
+    if not include_empty:
+        query += " AND quantity > 0"
+    query += f" ORDER BY {LOT_ORDER[LOT_ALLOCATION]}"
+    df = pd.read_sql_query(query, conn, params=[item_id, int(branch_id)])
     conn.close()
     return df
 
-def get_items_by_role(user_role, branch_id=None):
-    """Get items based on user role"""
-    conn = sqlite3.connect('inventory.db')
-    
-    if user_role == "viewer":
-        # Viewers only see final products
-        query = """SELECT i.*, b.branch_name, b.branch_code 
-                   FROM items i 
-                   JOIN branches b ON i.branch_id = b.id 
-                   WHERE i.category = 'Final Product'"""
-    else:
-        # Others see all items
-        query = """SELECT i.*, b.branch_name, b.branch_code 
-                   FROM items i 
-                   JOIN branches b ON i.branch_id = b.id"""
-    
-    if branch_id:
-        query += f" AND i.branch_id = {branch_id}"
-    
-    query += " ORDER BY b.branch_name, i.category, i.name"
-    
-    df = pd.read_sql_query(query, conn)
+def find_lots(batch_nr):
+    """Get every lot with a batch number, in any branch"""
+    conn = get_connection()
+    df = pd.read_sql_query('''SELECT l.*, i.name as item_name, b.branch_name
+                              FROM stock_lots l
+                              LEFT JOIN items i ON l.item_id = i.id AND l.branch_id = i.branch_id
+                              LEFT JOIN branches b ON l.branch_id = b.id
+                              WHERE l.batch_nr = ?
+                              ORDER BY l.received_date''', conn, params=[batch_nr])
     conn.close()
     return df
 
-def add_branch(branch_code, branch_name, location="", manager_name="", contact_info=""):
-    """Add new branch"""
-    conn = sqlite3.connect('inventory.db')
-    c = conn.cursor()
-    c.execute("INSERT INTO branches (branch_code, branch_name, location, manager_name, contact_info, created_date) VALUES (?, ?, ?, ?, ?, ?)",
-              (branch_code, branch_name, location, manager_name, contact_info, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-    conn.commit()
+def get_expiring_lots(days):
+    """Get open lots expiring within days, soonest first"""
+    conn = get_connection()
+    cutoff = (datetime.now() + timedelta(days=days)).strftime("%Y-%m-%d")
+    df = pd.read_sql_query('''SELECT l.*, i.name as item_name, b.branch_name
+                              FROM stock_lots l
+                              LEFT JOIN items i ON l.item_id = i.id AND l.branch_id = i.branch_id
+                              LEFT JOIN branches b ON l.branch_id = b.id
+                              WHERE l.quantity > 0 AND l.expiry_date IS NOT NULL AND l.expiry_date <= ?
+                              ORDER BY l.expiry_date''', conn, params=[cutoff])
     conn.close()
+    return df
 
-def update_stock(item_id, branch_id, quantity, movement_type, reference="", batch_nr="", invoice_nr="", po_nr="", user_id="system"):
-    """Update stock and record movement"""
-    conn = sqlite3.connect('inventory.db')
-    c = conn.cursor()
-    
-    # Update stock
-    if movement_type in ['IN', 'ADMIN_IN', 'TRANSFER_IN', 'PRODUCTION']:
-        c.execute("UPDATE items SET current_stock = current_stock + ? WHERE id = ? AND branch_id = ?", 
-                 (quantity, item_id, branch_id))
+def trace_lot(lot_id, direction="forward"):
+    """Follow lot genealogy from one lot.
+
+    forward: every lot made from or transferred out of this lot (where did it go).
+    backward: every lot this lot was made from or transferred from (where did it come from).
+    """
+    if direction == "forward":
+        step = "g.parent_lot_id = t.lot_id", "g.child_lot_id"
     else:
-        c.execute("UPDATE items SET current_stock = current_stock - ? WHERE id = ? AND branch_id = ?", 
-                 (quantity, item_id, branch_id))
-    
-    # Record movement
-    c.execute('''INSERT INTO stock_movements (item_id, branch_id, movement_type, quantity, reference, batch_nr, invoice_nr, po_nr, date_time, user_id)
-                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-              (item_id, branch_id, movement_type, quantity, reference, batch_nr, invoice_nr, po_nr,
-               datetime.now().strftime("%Y-%m-%d %H:%M:%S"), user_id))
-    
-    conn.commit()
+        step = "g.child_lot_id = t.lot_id", "g.parent_lot_id"
+    
+    conn = get_connection()
+    df = pd.read_sql_query(f'''WITH RECURSIVE trace (lot_id, depth, relation, quantity) AS (
+                                   SELECT ?, 0, NULL, NULL
+                                   UNION
+                                   SELECT {step[1]}, t.depth + 1, g.relation, g.quantity
+                                   FROM lot_genealogy g
+                                   JOIN trace t ON {step[0]}
+                                   WHERE t.depth < 50
+                               )
+                               SELECT t.depth, t.relation, t.quantity as linked_quantity, l.id as lot_id, l.item_id,
+                                      i.name as item_name, b.branch_name, l.batch_nr, l.received_date, l.expiry_date,
+                                      l.received_quantity, l.quantity as remaining
+                               FROM trace t
+                               JOIN stock_lots l ON l.id = t.lot_id
+                               LEFT JOIN items i ON l.item_id = i.id AND l.branch_id = i.branch_id
+                               LEFT JOIN branches b ON l.branch_id = b.id
+                               WHERE t.depth > 0
+                               ORDER BY t.depth, l.id''', conn, params=[int(lot_id)])
     conn.close()
+    return df
 
-def transfer_stock_between_branches(item_id, from_branch_id, to_branch_id, quantity, reference="", batch_nr="", invoice_nr="", po_nr="", user_id="system"):
-    """Transfer stock between branches"""
-    conn = sqlite3.connect('inventory.db')
-    c = conn.cursor()
-    
-    try:
-        # Check source stock
-        from_item = c.execute("SELECT current_stock FROM items WHERE id = ? AND branch_id = ?", 
-                            (item_id, from_branch_id)).fetchone()
-        
-        if not from_item or from_item[0] < quantity:
-            conn.close()
-            return False, "Insufficient stock in source branch"
-        
-        # Create item in destination if needed
-        to_item = c.execute("SELECT current_stock FROM items WHERE id = ? AND branch_id = ?", 
-                          (item_id, to_branch_id)).fetchone()
+# ===============================
+# WRITE QUEUE
+# ===============================
+
+# Most mutations a single group commit may carry
+WRITE_BATCH_SIZE = 64
+
+# Seconds a caller waits for its queued mutation
+WRITE_TIMEOUT = 60
+
+class WriteRequest:
+    """One queued mutation and the future its caller waits on"""
+
+    def __init__(self, func, args, kwargs, tables, user_id):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.tables = tables
+        self.user_id = user_id
+        self.future = Future()
+
+class StockWriter:
+    """Single writer thread that owns all stock mutations.
+
+    Callers queue a function taking a cursor; the writer drains whatever is
+    waiting, runs each function in its own savepoint inside one IMMEDIATE
+    transaction and commits once. A failing mutation only rolls back its
+    savepoint. Futures resolve after the commit so callers never see
+    uncommitted results.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.mutations = 0
+        self.largest_batch = 0
+        self._thread = threading.Thread(target=self._run, name="stock-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, func, *args, tables=(), user_id=None, **kwargs):
+        """Queue func(cursor, *args, **kwargs), returns a Future for its result"""
+        request = WriteRequest(func, args, kwargs, tables, user_id)
+        self._queue.put(request)
+        return request.future
+
+    def execute(self, func, *args, tables=(), user_id=None, **kwargs):
+        """Queue a mutation and wait for its committed result"""
+        return self.wait(self.submit(func, *args, tables=tables, user_id=user_id, **kwargs))
+
+    def wait(self, future):
+        """Result of a submitted mutation.
+
+        A request still queued after WRITE_TIMEOUT is cancelled, so a caller
+        told it failed can retry without it committing later; one the writer
+        has already started is waited for.
+        """
+        try:
+            return future.result(timeout=WRITE_TIMEOUT)
+        except TimeoutError:
+            if future.cancel():
+                raise
+            return future.result()
+
+    def stats(self):
+        with self._lock:
+            return {'batches': self.batches, 'mutations': self.mutations, 'largest_batch': self.largest_batch,
+                    'queued': self._queue.qsize()}
+
+    def _run(self):
+        conn = get_connection(self.db_path, isolation_level=None, timeout=30)
+        c = conn.cursor()
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit_batch(conn, c, batch)
+
+    def _commit_batch(self, conn, c, batch):
+        started = time.perf_counter()
+        done = []
         
-        if not to_item:
-            item_details = c.execute("SELECT name, category, unit, min_stock, cost_per_unit, location, warehouse_area FROM items WHERE id = ? AND branch_id = ?", 
-                                   (item_id, from_branch_id)).fetchone()
-            
-            if item_details:
-                c.execute('''INSERT INTO items (id, branch_id, name, category, unit, current_stock, min_stock, cost_per_unit, location, warehouse_area, created_date, created_by)
-                             VALUES (?, ?, ?, ?, ?, 0, ?, ?, ?, ?, ?, ?)''',
-                         (item_id, to_branch_id, item_details[0], item_details[1], item_details[2], 
-                          item_details[3], item_details[4], item_details[5], item_details[6],
-                          datetime.now().strftime("%Y-%m-%d %H:%M:%S"), user_id))
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            for request in batch:
+                if not request.future.set_running_or_notify_cancel():
+                    continue
+                c.execute("SAVEPOINT mutation")
+                try:
+                    result = request.func(c, *request.args, **request.kwargs)
+                    c.execute("RELEASE mutation")
+                    done.append((request, result))
+                except Exception as e:
+                    c.execute("ROLLBACK TO mutation")
+                    c.execute("RELEASE mutation")
+                    request.future.set_exception(e)
+            conn.commit()
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+            get_metrics().record('writer', 'group_commit', time.perf_counter() - started, True)
+            return
         
-        # Update stocks
-        c.execute("UPDATE items SET current_stock = current_stock - ? WHERE id = ? AND branch_id = ?", 
-                 (quantity, item_id, from_branch_id))
-        c.execute("UPDATE items SET current_stock = current_stock + ? WHERE id = ? AND branch_id = ?", 
-                 (quantity, item_id, to_branch_id))
+        get_metrics().record('writer', 'group_commit', time.perf_counter() - started)
+        with self._lock:
+            self.batches += 1
+            self.mutations += len(done)
+            self.largest_batch = max(self.largest_batch, len(done))
         
-        # Record movements
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        # One change notification per user for the whole batch
+        changes = {}
+        for request, _ in done:
+            changes.setdefault(request.user_id, set()).update(request.tables)
+        for user_id, tables in changes.items():
+            if tables:
+                notify_data_change(tuple(sorted(tables)), user_id)
         
-        c.execute('''INSERT INTO stock_movements (item_id, branch_id, movement_type, quantity, reference, batch_nr, invoice_nr, po_nr, date_time, user_id, from_branch_id, to_branch_id)
-                     VALUES (?, ?, 'TRANSFER_OUT', ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                 (item_id, from_branch_id, quantity, reference, batch_nr, invoice_nr, po_nr, timestamp, user_id, from_branch_id, to_branch_id))
+        for request, result in done:
+            request.future.set_result(result)
+
+@st.cache_resource
+def get_stock_writer():
+    """Get the process-wide stock writer"""
+    return StockWriter(DB_PATH)
+
+# ===============================
+# CHANGE EVENTS
+# ===============================
+
+# Events every consumer has read are pruned after this many days
+EVENT_RETENTION_DAYS = 30
+
+# Items a viewer may see
+VIEWER_ITEMS = "SELECT id FROM item_catalog WHERE category = 'Final Product'"
+
+def read_events(after_seq=0, limit=500, final_products_only=False):
+    """Stock change events after a sequence number, oldest first"""
+    conn = get_connection()
+    conn.row_factory = sqlite3.Row
+    query = "SELECT * FROM stock_events WHERE seq > ?" + (f" AND item_id IN ({VIEWER_ITEMS})" if final_products_only else "")
+    rows = conn.execute(query + " ORDER BY seq LIMIT ?", (after_seq, limit)).fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+def get_latest_event_seq():
+    """Highest event sequence number written so far"""
+    conn = get_connection()
+    seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM stock_events").fetchone()[0]
+    conn.close()
+    return seq
+
+def get_consumer_offset(name):
+    """Last event a consumer acknowledged, 0 for a new consumer"""
+    conn = get_connection()
+    row = conn.execute("SELECT last_seq FROM event_consumers WHERE name = ?", (name,)).fetchone()
+    conn.close()
+    return row[0] if row else 0
+
+def commit_consumer_offset(name, seq):
+    """Durably record that a consumer has processed every event up to seq"""
+    conn = get_connection(timeout=30)
+    conn.execute('''INSERT INTO event_consumers (name, last_seq, updated_at) VALUES (?, ?, ?)
+                    ON CONFLICT (name) DO UPDATE SET last_seq = MAX(last_seq, excluded.last_seq), updated_at = excluded.updated_at''',
+                 (name, seq, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+    conn.commit()
+    conn.close()
+
+def get_event_consumers():
+    """Registered consumers with how far they are behind"""
+    conn = get_connection()
+    df = pd.read_sql_query('''SELECT c.name, c.last_seq, c.updated_at,
+                                     (SELECT COALESCE(MAX(seq), 0) FROM stock_events) - c.last_seq as lag
+                              FROM event_consumers c ORDER BY c.name''', conn)
+    conn.close()
+    return df
+
+def wait_for_events(after_seq, timeout=30, limit=500, final_products_only=False):
+    """Long-poll: events after after_seq, waiting up to timeout seconds for the first one.
+
+    Commits in this process wake the wait through the data hub; commits from
+    other processes are picked up by polling once a second.
+    """
+    events = read_events(after_seq, limit, final_products_only)
+    if events or timeout <= 0:
+        return events
+    
+    wake = threading.Event()
+    hub = get_data_hub()
+    token = hub.subscribe(lambda change: wake.set())
+    deadline = time.time() + timeout
+    try:
+        while True:
+            wake.wait(min(1.0, max(0, deadline - time.time())))
+            wake.clear()
+            events = read_events(after_seq, limit, final_products_only)
+            if events or time.time() >= deadline:
+                return events
+    finally:
+        hub.unsubscribe(token)
+
+def consume_events(consumer, batch_size=100, timeout=None):
+    """Yield stock events for a named consumer in order, resuming from its durable offset.
+
+    The offset is committed once every event of a batch has been taken, so a
+    consumer that crashes mid-batch sees that batch again (at-least-once).
+    With timeout None the generator follows the stream forever; otherwise it
+    stops after timeout seconds without new events.
+    """
+    offset = get_consumer_offset(consumer)
+    while True:
+        events = wait_for_events(offset, 30 if timeout is None else timeout, batch_size)
+        if not events:
+            if timeout is None:
+                continue
+            return
+        for event in events:
+            yield event
+        offset = events[-1]['seq']
+        commit_consumer_offset(consumer, offset)
+
+# ===============================
+# AUDIT LOG
+# ===============================
+
+AUDIT_OPS = {1: "movement", 2: "movement deleted", 3: "item created", 4: "item deleted"}
+# Hashed fields in record order; NULLs hash as zero
+AUDIT_COLUMNS = ("seq, branch_id, ts, op, COALESCE(type_ref, 0), COALESCE(item_ref, 0), COALESCE(user_ref, 0), "
+                 "COALESCE(reference_ref, 0), COALESCE(movement_id, 0), COALESCE(quantity, 0.0), COALESCE(stock_delta, 0.0)")
+AUDIT_RECORD = struct.Struct("<9q2d")
+AUDIT_GENESIS = bytes(16)
+
+def audit_hash(previous, row):
+    """Chain hash of one audit row (selected with AUDIT_COLUMNS) onto the previous one"""
+    return hashlib.blake2b(previous + AUDIT_RECORD.pack(*row[:11]), digest_size=16).digest()
+
+def seal_audit_log():
+    """Hash every unsealed audit row onto its branch's chain, returns the number sealed"""
+    conn = get_connection(timeout=30, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        heads = {}
+        sealed = []
+        for row in conn.execute(f"SELECT {AUDIT_COLUMNS} FROM audit_log WHERE hash IS NULL ORDER BY seq").fetchall():
+            branch_id = row[1]
+            if branch_id not in heads:
+                last = conn.execute("SELECT hash FROM audit_log WHERE branch_id = ? AND hash IS NOT NULL ORDER BY seq DESC LIMIT 1",
+                                    (branch_id,)).fetchone()
+                heads[branch_id] = last[0] if last else AUDIT_GENESIS
+            heads[branch_id] = audit_hash(heads[branch_id], row)
+            sealed.append((heads[branch_id], row[0]))
+        conn.executemany("UPDATE audit_log SET hash = ? WHERE seq = ?", sealed)
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return len(sealed)
+
+def verify_audit_log(full=False):
+    """Re-walk each branch's hash chain, returns one result per branch.
+
+    Verification resumes from the branch's last checkpoint unless full is set;
+    the checkpoint row itself is re-checked so a truncated chain is caught.
+    """
+    conn = get_connection(timeout=30)
+    checkpoints = {} if full else {branch_id: (last_seq, last_hash) for branch_id, last_seq, last_hash
+                                   in conn.execute("SELECT branch_id, last_seq, last_hash FROM audit_checkpoints")}
+    branch_ids = sorted({row[0] for row in conn.execute("SELECT DISTINCT branch_id FROM audit_log")} | set(checkpoints))
+    verified_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    results = []
+    
+    for branch_id in branch_ids:
+        last_seq, head = checkpoints.get(branch_id, (0, AUDIT_GENESIS))
+        checked, broken_at = 0, None
         
-        c.execute('''INSERT INTO stock_movements (item_id, branch_id, movement_type, quantity, reference, batch_nr, invoice_nr, po_nr, date_time, user_id, from_branch_id, to_branch_id)
-                     VALUES (?, ?, 'TRANSFER_IN', ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                 (item_id, to_branch_id, quantity, reference, batch_nr, invoice_nr, po_nr, timestamp, user_id, from_branch_id, to_branch_id))
+        if last_seq:
+            anchor = conn.execute("SELECT hash FROM audit_log WHERE seq = ? AND branch_id = ?", (last_seq, branch_id)).fetchone()
+            if not anchor or anchor[0] != head:
+                broken_at = last_seq
         
-        conn.commit()
-        conn.close()
-        return True, f"Successfully transferred {quantity} units"
+        if broken_at is None:
+            rows = conn.execute(f'''SELECT {AUDIT_COLUMNS}, hash FROM audit_log
+                                    WHERE branch_id = ? AND seq > ? AND hash IS NOT NULL ORDER BY seq''', (branch_id, last_seq))
+            for row in rows:
+                head = audit_hash(head, row)
+                if head != row[11]:
+                    broken_at = row[0]
+                    break
+                last_seq = row[0]
+                checked += 1
         
+        if broken_at is None and last_seq:
+            conn.execute('''INSERT INTO audit_checkpoints (branch_id, last_seq, last_hash, verified_at) VALUES (?, ?, ?, ?)
+                            ON CONFLICT (branch_id) DO UPDATE SET last_seq = excluded.last_seq, last_hash = excluded.last_hash,
+                                                                  verified_at = excluded.verified_at''',
+                         (branch_id, last_seq, head, verified_at))
+        results.append({'branch_id': branch_id, 'rows_checked': checked, 'verified_to': last_seq,
+                        'ok': broken_at is None, 'broken_at': broken_at})
+    
+    conn.commit()
+    conn.close()
+    return results
+
+def get_audit_trail(branch_id=None, item_id=None, limit=200):
+    """Most recent audit rows decoded to readable values"""
+    conn = get_connection()
+    query = '''SELECT a.seq, datetime(a.ts, 'unixepoch') as date_time, a.branch_id, a.op,
+                      t.value as movement_type, i.value as item_id, u.value as user_id, r.value as reference,
+                      a.movement_id, a.quantity, a.stock_delta, a.hash IS NOT NULL as sealed
+               FROM audit_log a
+               LEFT JOIN audit_strings t ON t.id = a.type_ref
+               LEFT JOIN audit_strings i ON i.id = a.item_ref
+               LEFT JOIN audit_strings u ON u.id = a.user_ref
+               LEFT JOIN audit_strings r ON r.id = a.reference_ref
+               WHERE 1 = 1'''
+    params = []
+    if branch_id:
+        query += " AND a.branch_id = ?"
+        params.append(branch_id)
+    if item_id:
+        query += " AND a.item_ref = (SELECT id FROM audit_strings WHERE value = ?)"
+        params.append(item_id)
+    query += " ORDER BY a.seq DESC LIMIT ?"
+    params.append(limit)
+    df = pd.read_sql_query(query, conn, params=params)
+    conn.close()
+    df['op'] = df['op'].map(AUDIT_OPS)
+    return df
+
+# ===============================
+# DATABASE OPERATIONS
+# ===============================
+
+def get_all_branches(active_only=True):
+    """Get all branches"""
+    return get_read_hub().get_branches(active_only)
+
+def get_items_by_role(user_role, branch_id=None):
+    """Get items based on user role"""
+    return get_read_hub().get_items(user_role, branch_id)
+
+@instrumented('mutator')
+def add_branch(branch_code, branch_name, location="", manager_name="", contact_info=""):
+    """Add new branch"""
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute("INSERT INTO branches (branch_code, branch_name, location, manager_name, contact_info, created_date) VALUES (?, ?, ?, ?, ?, ?)",
+              (branch_code, branch_name, location, manager_name, contact_info, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+    conn.commit()
+    conn.close()
+    notify_data_change(("branches",))
+
+def write_update_stock(c, item_id, branch_id, quantity, movement_type, reference="", batch_nr="", invoice_nr="", po_nr="",
+                       user_id="system", expiry_date=None, unit_cost=None):
+    """Apply one stock movement on the writer's cursor"""
+    apply_stock_movement(c, item_id, branch_id, quantity, movement_type, reference, batch_nr, invoice_nr, po_nr,
+                         user_id, expiry_date=expiry_date, unit_cost=unit_cost)
+
+@instrumented('mutator')
+def update_stock(item_id, branch_id, quantity, movement_type, reference="", batch_nr="", invoice_nr="", po_nr="", user_id="system",
+                 expiry_date=None, unit_cost=None):
+    """Update stock and record movement"""
+    get_stock_writer().execute(write_update_stock, item_id, branch_id, quantity, movement_type, reference, batch_nr,
+                               invoice_nr, po_nr, user_id, expiry_date, unit_cost,
+                               tables=("items", "stock_movements"), user_id=user_id)
+
+def write_checked_movement(c, item_id, branch_id, quantity, movement_type, *args, **kwargs):
+    """Apply one movement from an API client on the writer's cursor.
+
+    Raises LookupError when the branch does not stock the item and ValueError
+    when an OUT or ADMIN_OUT exceeds the available (unreserved) stock.
+    """
+    item = c.execute("SELECT current_stock - reserved_stock FROM branch_stock WHERE item_id = ? AND branch_id = ?",
+                     (item_id, branch_id)).fetchone()
+    if not item:
+        raise LookupError(f"Unknown item {item_id} in branch {branch_id}")
+    if movement_type in ('OUT', 'ADMIN_OUT') and item[0] < quantity - QUANTITY_EPSILON:
+        raise ValueError(f"Insufficient available stock: {item[0]:g} available, {quantity:g} requested")
+    write_update_stock(c, item_id, branch_id, quantity, movement_type, *args, **kwargs)
+
+def write_set_stock_level(c, item_id, branch_id, new_stock, reference="", batch_nr="", invoice_nr="", user_id="system"):
+    """Set an absolute stock level on the writer's cursor, returns the old level"""
+    old = c.execute("SELECT current_stock, cost_per_unit FROM branch_stock WHERE item_id = ? AND branch_id = ?", (item_id, branch_id)).fetchone()
+    old_stock, average_cost = old if old else (0, 0)
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    
+    # Counted surpluses come in at the current average cost
+    movement_id = record_movement(c, item_id, branch_id, 'ADMIN_SET', new_stock,
+                                  f"SET from {old_stock} to {new_stock} - {reference}", batch_nr, invoice_nr, "",
+                                  user_id, timestamp, unit_cost=average_cost, stock_delta=new_stock - old_stock)
+    
+    if new_stock > old_stock:
+        receive_lots(c, item_id, branch_id, new_stock - old_stock, movement_id, batch_nr, timestamp, unit_cost=average_cost)
+    elif new_stock < old_stock:
+        consume_lots(c, item_id, branch_id, old_stock - new_stock, movement_id)
+    
+    c.execute("UPDATE branch_stock SET current_stock = ? WHERE item_id = ? AND branch_id = ?", (new_stock, item_id, branch_id))
+    return old_stock
+
+@instrumented('mutator')
+def set_stock_level(item_id, branch_id, new_stock, reference="", batch_nr="", invoice_nr="", user_id="system"):
+    """Set stock to an absolute level, booking the difference against lots"""
+    return get_stock_writer().execute(write_set_stock_level, item_id, branch_id, new_stock, reference, batch_nr, invoice_nr,
+                                      user_id, tables=("items", "stock_movements"), user_id=user_id)
+
+def check_transfer(c, from_branch_id, to_branch_id, lines):
+    """Validate (item_id, quantity) lines moving between branches on the writer's cursor; raises ValueError"""
+    if from_branch_id == to_branch_id:
+        raise ValueError("Source and destination must differ")
+    if not c.execute("SELECT 1 FROM branches WHERE id = ? AND is_active = 1", (to_branch_id,)).fetchone():
+        raise ValueError(f"Unknown destination branch {to_branch_id}")
+    # Units reserved in the source branch stay there
+    for item_id, quantity in lines:
+        if quantity <= 0:
+            raise ValueError(f"{item_id}: quantity must be positive")
+        row = c.execute("SELECT current_stock - reserved_stock FROM branch_stock WHERE item_id = ? AND branch_id = ?",
+                        (item_id, from_branch_id)).fetchone()
+        if not row or row[0] < quantity - QUANTITY_EPSILON:
+            raise ValueError(f"{item_id}: need {quantity}, available {row[0] if row else 0}")
+
+def write_transfer(c, item_id, from_branch_id, to_branch_id, quantity, reference="", batch_nr="", invoice_nr="", po_nr="", user_id="system"):
+    """Move stock between branches in one step on the writer's cursor, returns (success, message).
+
+    For corrections and goods already on site; anything that travels goes
+    through dispatch_shipment and receive_shipment.
+    """
+    try:
+        check_transfer(c, from_branch_id, to_branch_id, [(item_id, quantity)])
+    except ValueError as e:
+        return False, str(e)
+    
+    # First arrival in the destination only needs a stock row; the catalog already describes the item
+    c.execute('''INSERT INTO branch_stock (item_id, branch_id, current_stock, min_stock, cost_per_unit)
+                 SELECT item_id, ?, 0, min_stock, cost_per_unit FROM branch_stock WHERE item_id = ? AND branch_id = ?
+                 ON CONFLICT (item_id, branch_id) DO NOTHING''',
+              (to_branch_id, item_id, from_branch_id))
+    
+    # Both legs share a timestamp; the lots taken out travel to the destination
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    
+    _, allocations = apply_stock_movement(c, item_id, from_branch_id, quantity, 'TRANSFER_OUT', reference, batch_nr,
+                                          invoice_nr, po_nr, user_id, timestamp, from_branch_id, to_branch_id)
+    apply_stock_movement(c, item_id, to_branch_id, quantity, 'TRANSFER_IN', reference, batch_nr, invoice_nr, po_nr,
+                         user_id, timestamp, from_branch_id, to_branch_id, source_lots=allocations)
+    
+    return True, f"Successfully transferred {quantity} units"
+
+@instrumented('mutator')
+def transfer_stock_between_branches(item_id, from_branch_id, to_branch_id, quantity, reference="", batch_nr="", invoice_nr="", po_nr="", user_id="system"):
+    """Transfer stock between branches"""
+    try:
+        return get_stock_writer().execute(write_transfer, item_id, from_branch_id, to_branch_id, quantity, reference,
+                                          batch_nr, invoice_nr, po_nr, user_id,
+                                          tables=("items", "stock_movements"), user_id=user_id)
     except Exception as e:
-        conn.rollback()
-        conn.close()
         return False, f"Transfer failed: {str(e)}"
 
 def get_bom(final_product_id, branch_id):
     """Get Bill of Materials for a product in a specific branch"""
-    conn = sqlite3.connect('inventory.db')
-    query = '''SELECT b.*, i.name as ingredient_name, i.unit, i.current_stock
+    conn = get_connection()
+    query = '''SELECT b.*, i.name as ingredient_name, i.unit, i.current_stock, i.available_stock
                FROM bom b
                JOIN items i ON b.ingredient_id = i.id AND b.branch_id = i.branch_id
                WHERE b.final_product_id = ? AND b.branch_id = ?'''
@@ -375,9 +2113,10 @@ def get_bom(final_product_id, branch_id):
     conn.close()
     return df
 
+@instrumented('mutator')
 def add_bom_item(final_product_id, ingredient_id, quantity_required, branch_id, user_id):
     """Add item to Bill of Materials"""
-    conn = sqlite3.connect('inventory.db')
+    conn = get_connection()
     c = conn.cursor()
     c.execute('''INSERT OR REPLACE INTO bom (final_product_id, ingredient_id, quantity_required, branch_id, created_date, created_by)
                  VALUES (?, ?, ?, ?, ?, ?)''', 
@@ -385,82 +2124,1773 @@ def add_bom_item(final_product_id, ingredient_id, quantity_required, branch_id,
                datetime.now().strftime("%Y-%m-%d %H:%M:%S"), user_id))
     conn.commit()
     conn.close()
+    notify_data_change(("bom",), user_id)
+
+@instrumented('mutator')
+def delete_bom_item(final_product_id, ingredient_id, branch_id):
+    """Remove item from Bill of Materials"""
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute('DELETE FROM bom WHERE final_product_id = ? AND ingredient_id = ? AND branch_id = ?', 
+              (final_product_id, ingredient_id, branch_id))
+    conn.commit()
+    conn.close()
+    notify_data_change(("bom",))
+
+def write_produce_item(c, final_product_id, branch_id, quantity_to_produce, user_id, batch_nr="", expiry_date=None,
+                       reservation=None):
+    """Consume BOM ingredients and book the product on the writer's cursor, returns (success, message)"""
+    # Ingredients reserved for this run count as available to it; everything else reserved does not
+    bom = c.execute('''SELECT b.ingredient_id, b.quantity_required, i.name,
+                              i.available_stock + COALESCE((SELECT SUM(r.quantity) FROM reservations r
+                                                            WHERE r.reference = ? AND r.status = 'ACTIVE'
+                                                              AND r.item_id = b.ingredient_id AND r.branch_id = b.branch_id), 0)
+                       FROM bom b
+                       JOIN items i ON b.ingredient_id = i.id AND b.branch_id = i.branch_id
+                       WHERE b.final_product_id = ? AND b.branch_id = ?''', (reservation, final_product_id, branch_id)).fetchall()
+    
+    if not bom:
+        return False, "No Bill of Materials found for this product"
+    
+    # Check if enough ingredients available
+    insufficient_ingredients = []
+    for ingredient_id, quantity_required, ingredient_name, have in bom:
+        required_qty = quantity_required * quantity_to_produce
+        if have < required_qty:
+            insufficient_ingredients.append(f"{ingredient_name}: Need {required_qty}, Available {have}")
+    
+    if insufficient_ingredients:
+        return False, f"Insufficient ingredients: {'; '.join(insufficient_ingredients)}"
+    
+    if reservation:
+        write_close_reservations(c, reservation, 'FULFILLED', user_id, branch_id)
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    
+    # Deduct ingredients
+    consumed = []
+    ingredient_cost = 0
+    for ingredient_id, quantity_required, _, _ in bom:
+        required_qty = quantity_required * quantity_to_produce
+        issue_id, allocations = apply_stock_movement(c, ingredient_id, branch_id, required_qty, 'OUT',
+                                                     f'Production of {quantity_to_produce} x {final_product_id}', '', '', '',
+                                                     user_id, timestamp)
+        consumed.extend(allocations)
+        ingredient_cost += c.execute("SELECT quantity * unit_cost FROM stock_movements WHERE id = ?", (issue_id,)).fetchone()[0]
+    
+    # Add final product to stock at the rolled-up ingredient cost
+    movement_id, lots = apply_stock_movement(c, final_product_id, branch_id, quantity_to_produce, 'PRODUCTION',
+                                             f'Produced {quantity_to_produce} units', batch_nr, '', '', user_id,
+                                             timestamp, expiry_date=expiry_date,
+                                             unit_cost=ingredient_cost / quantity_to_produce)
+    
+    # Link the new lot to every ingredient lot it was made from
+    c.executemany('''INSERT INTO lot_genealogy (parent_lot_id, child_lot_id, quantity, relation, movement_id, created_date)
+                     VALUES (?, ?, ?, 'production', ?, ?)''',
+                  [(allocation['lot_id'], lots[0]['lot_id'], allocation['quantity'], movement_id, timestamp)
+                   for allocation in consumed if allocation['lot_id'] is not None])
+    
+    return True, f"Successfully produced {quantity_to_produce} units (batch {lots[0]['batch_nr']})"
+
+@instrumented('mutator')
+def produce_item(final_product_id, branch_id, quantity_to_produce, user_id, batch_nr="", expiry_date=None, reservation=None):
+    """Produce final product and automatically deduct ingredients based on BOM"""
+    try:
+        return get_stock_writer().execute(write_produce_item, final_product_id, branch_id, quantity_to_produce, user_id,
+                                          batch_nr, expiry_date, reservation,
+                                          tables=("items", "stock_movements", "reservations"), user_id=user_id)
+    except Exception as e:
+        return False, f"Error during production: {str(e)}"
+
+def find_duplicate_movements(limit=200):
+    """Movements recorded more than once with the same item, branch, type, quantity, second and user.
+
+    Only reported, never deleted: identical movements are usually real (several
+    scans or a batch in the same second), and removing one would leave stock,
+    lots and the movement ledger disagreeing.
+    """
+    return get_read_hub().query('''SELECT item_id, branch_id, movement_type, quantity, date_time, user_id,
+                                          COUNT(*) as copies, MIN(id) as first_id, MAX(id) as last_id
+                                   FROM stock_movements
+                                   GROUP BY item_id, branch_id, movement_type, quantity, date_time, user_id,
+                                            from_branch_id, to_branch_id
+                                   HAVING COUNT(*) > 1
+                                   ORDER BY date_time DESC
+                                   LIMIT ?''', (limit,))
+
+def write_add_item(c, item_id, name, category, unit, current_stock, min_stock, branch_id, user_id, cost_per_unit=0):
+    """Insert an item and its opening lot on the writer's cursor"""
+    created_date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    c.execute('''INSERT INTO items (id, branch_id, name, category, unit, current_stock, min_stock, cost_per_unit, location, warehouse_area, created_date, created_by)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+              (item_id, branch_id, name, category, unit, current_stock, min_stock, cost_per_unit, "Main", "General",
+               created_date, user_id))
+    if current_stock > 0:
+        create_lot(c, item_id, branch_id, current_stock, "OPENING", created_date, unit_cost=cost_per_unit)
+
+@instrumented('mutator')
+def add_item(item_id, name, category, unit, current_stock, min_stock, branch_id, user_id, cost_per_unit=0):
+    """Add new item to branch"""
+    get_stock_writer().execute(write_add_item, item_id, name, category, unit, current_stock, min_stock, branch_id, user_id,
+                               cost_per_unit, tables=("items",), user_id=user_id)
+
+def write_delete_item(c, item_id, branch_id):
+    """Delete an item and its movements on the writer's cursor"""
+    c.execute('DELETE FROM items WHERE id = ? AND branch_id = ?', (item_id, branch_id))
+    c.execute('DELETE FROM stock_movements WHERE item_id = ? AND branch_id = ?', (item_id, branch_id))
+    c.execute('UPDATE stock_lots SET quantity = 0 WHERE item_id = ? AND branch_id = ?', (item_id, branch_id))
+
+@instrumented('mutator')
+def delete_item(item_id, branch_id, user_id="system"):
+    """Delete an item and its movements from a branch.
+
+    Its lots are emptied rather than removed so genealogy through them still resolves.
+    """
+    get_stock_writer().execute(write_delete_item, item_id, branch_id, tables=("items", "stock_movements"), user_id=user_id)
+
+def get_inventory_valuation(group_by="branch"):
+    """Inventory value per branch or category: FIFO lot layers next to the moving average"""
+    group_column = {"branch": "b.branch_name", "category": "i.category"}[group_by]
+    query = f'''SELECT {group_column} as grp,
+                         COUNT(*) as items,
+                         SUM(i.current_stock) as total_stock,
+                         SUM(i.current_stock * i.cost_per_unit) as average_value,
+                         SUM(COALESCE(l.fifo_value, 0)) as fifo_value
+                  FROM items i
+                  JOIN branches b ON i.branch_id = b.id
+                  LEFT JOIN (SELECT item_id, branch_id, SUM(quantity * unit_cost) as fifo_value
+                             FROM stock_lots WHERE quantity > 0
+                             GROUP BY item_id, branch_id) l
+                         ON l.item_id = i.id AND l.branch_id = i.branch_id
+                  WHERE b.is_active = 1
+                  GROUP BY grp
+                  ORDER BY grp'''
+    return get_read_hub().query(query).rename(columns={'grp': group_by})
+
+SEARCH_PAGE_SIZE = 20
+
+def build_search_query(text):
+    """Turn free text into an FTS5 query where every word must match as a prefix"""
+    tokens = re.findall(r"\w+", text.lower())
+    return " AND ".join(f'"{token}"*' for token in tokens)
+
+def search_items(text, user_role, limit=SEARCH_PAGE_SIZE, offset=0):
+    """Ranked full-text search over item ids, names and categories, returns (results, total)"""
+    match = build_search_query(text)
+    if not match:
+        return pd.DataFrame(), 0
+    
+    conditions = "items_fts MATCH ?"
+    if user_role == "viewer":
+        # Viewers only see final products
+        conditions += " AND i.category = 'Final Product'"
+    
+    # Shared through the hub, so repeated searches and reruns are served until the next change
+    hub = get_read_hub()
+    total = int(hub.query(f'''SELECT COUNT(*) as total
+                              FROM items_fts f
+                              JOIN items i ON i.id = f.item_id AND i.branch_id = f.branch_id
+                              WHERE {conditions}''', (match,))['total'].iloc[0])
+    df = hub.query(f'''SELECT i.id, i.name, i.category, i.current_stock, i.unit, b.branch_name,
+                             bm25(items_fts, 5.0, 10.0, 1.0, 0.0) AS score
+                      FROM items_fts f
+                      JOIN items i ON i.id = f.item_id AND i.branch_id = f.branch_id
+                      JOIN branches b ON i.branch_id = b.id
+                      WHERE {conditions}
+                      ORDER BY score
+                      LIMIT ? OFFSET ?''', (match, limit, offset))
+    return df, total
+
+def search_movements(text, limit=SEARCH_PAGE_SIZE, offset=0):
+    """Ranked full-text search over movement references, batch, invoice and PO numbers, returns (results, total)"""
+    match = build_search_query(text)
+    if not match:
+        return pd.DataFrame(), 0
+    
+    hub = get_read_hub()
+    total = int(hub.query("SELECT COUNT(*) as total FROM movements_fts WHERE movements_fts MATCH ?", (match,))['total'].iloc[0])
+    df = hub.query('''SELECT sm.id, sm.date_time, sm.item_id, i.name as item_name, b.branch_name,
+                             sm.movement_type, sm.quantity, sm.reference, sm.batch_nr, sm.invoice_nr, sm.po_nr,
+                             bm25(movements_fts, 2.0, 1.0, 5.0, 5.0, 5.0) AS score
+                      FROM movements_fts
+                      JOIN stock_movements sm ON sm.id = movements_fts.rowid
+                      LEFT JOIN items i ON sm.item_id = i.id AND sm.branch_id = i.branch_id
+                      LEFT JOIN branches b ON sm.branch_id = b.id
+                      WHERE movements_fts MATCH ?
+                      ORDER BY score
+                      LIMIT ? OFFSET ?''', (match, limit, offset))
+    return df, total
+
+# ===============================
+# SCANNER SYNC
+# ===============================
+
+SYNC_SCAN_TYPES = ("IN", "OUT", "TRANSFER")
+
+def apply_sync_scan(c, scan, device_id, user_id):
+    """Apply one offline scan on the writer's cursor, returns (status, message)"""
+    scan_type = scan.get('type', 'IN')
+    try:
+        item_id, branch_id, quantity = str(scan['item_id']), int(scan['branch_id']), float(scan['quantity'])
+    except (KeyError, TypeError, ValueError):
+        return 'conflict', "item_id, branch_id and quantity are required"
+    if scan_type not in SYNC_SCAN_TYPES or quantity <= 0:
+        return 'conflict', f"type must be one of {', '.join(SYNC_SCAN_TYPES)} with a positive quantity"
+    
+    # Units reserved for orders or production runs cannot be scanned out
+    item = c.execute("SELECT current_stock - reserved_stock FROM branch_stock WHERE item_id = ? AND branch_id = ?",
+                     (item_id, branch_id)).fetchone()
+    if not item:
+        return 'conflict', f"Unknown item {item_id} in branch {branch_id}"
+    
+    reference = scan.get('reference') or f"Scanner {device_id}"
+    if scan_type == 'TRANSFER':
+        # Scanned transfers travel as shipments; one-step moves are admin corrections
+        if not scan.get('to_branch_id'):
+            return 'conflict', "to_branch_id is required for transfers"
+        to_branch_id = int(scan['to_branch_id'])
+        shipment_id = write_dispatch_shipment(c, branch_id, to_branch_id, [(item_id, quantity)], reference, user_id)
+        return 'applied', f"Shipment #{shipment_id} dispatched to branch {to_branch_id}"
+    
+    if scan_type == 'OUT' and item[0] < quantity - QUANTITY_EPSILON:
+        return 'conflict', f"Insufficient available stock: {item[0]:g} available, {quantity:g} scanned out"
+    write_update_stock(c, item_id, branch_id, quantity, scan_type, reference, scan.get('batch_nr', ''),
+                       user_id=user_id, expiry_date=scan.get('expiry_date'))
+    return 'applied', f"{scan_type} {quantity:g}"
+
+def write_sync_scans(c, device_id, scans, user_id="system"):
+    """Apply a device's queued scans in order on the writer's cursor, one result per scan.
+
+    Scans already applied under the same client_id are reported as duplicates
+    and not applied again. A conflicting scan is rolled back on its own and
+    recorded; sending it again retries it.
+    """
+    synced_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    results = []
+    
+    for scan in scans:
+        client_id = scan.get('client_id')
+        if not client_id:
+            results.append({'client_id': None, 'status': 'conflict', 'message': "client_id is required"})
+            continue
+        client_id = str(client_id)
+        
+        done = c.execute("SELECT status, message FROM sync_receipts WHERE client_id = ?", (client_id,)).fetchone()
+        if done and done[0] == 'applied':
+            results.append({'client_id': client_id, 'status': 'duplicate', 'message': done[1]})
+            continue
+        
+        last_before = c.execute("SELECT COALESCE(MAX(id), 0) FROM stock_movements").fetchone()[0]
+        c.execute("SAVEPOINT scan")
+        try:
+            status, message = apply_sync_scan(c, scan, device_id, user_id)
+        except Exception as e:
+            status, message = 'conflict', str(e)
+        if status != 'applied':
+            c.execute("ROLLBACK TO scan")
+        c.execute("RELEASE scan")
+        
+        first_id, last_id = c.execute("SELECT MIN(id), MAX(id) FROM stock_movements WHERE id > ?", (last_before,)).fetchone()
+        c.execute('''INSERT INTO sync_receipts (client_id, device_id, scan_type, item_id, branch_id, quantity, status, message,
+                                              first_movement_id, last_movement_id, captured_at, synced_at, user_id)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                     ON CONFLICT (client_id) DO UPDATE SET
+                         status = excluded.status, message = excluded.message,
+                         first_movement_id = excluded.first_movement_id, last_movement_id = excluded.last_movement_id,
+                         synced_at = excluded.synced_at''',
+                  (client_id, device_id, scan.get('type', 'IN'), scan.get('item_id'), scan.get('branch_id'),
+                   scan.get('quantity'), status, message, first_id, last_id, scan.get('captured_at'), synced_at, user_id))
+        results.append({'client_id': client_id, 'status': status, 'message': message})
+    
+    return results
+
+@instrumented('mutator')
+def sync_scans(device_id, scans, user_id="system"):
+    """Upload an offline device's scans in one transaction, returns per-scan results"""
+    return get_stock_writer().execute(write_sync_scans, device_id, list(scans), user_id,
+                                      tables=("items", "stock_movements", "shipments"), user_id=user_id)
+
+def get_sync_receipts(status=None, limit=200):
+    """Most recent scan receipts, optionally only one status"""
+    conn = get_connection()
+    query = "SELECT * FROM sync_receipts"
+    params = []
+    if status:
+        query += " WHERE status = ?"
+        params.append(status)
+    query += " ORDER BY synced_at DESC, rowid DESC LIMIT ?"
+    params.append(limit)
+    df = pd.read_sql_query(query, conn, params=params)
+    conn.close()
+    return df
+
+# ===============================
+# CYCLE COUNTS
+# ===============================
+
+COUNT_LINE_MODES = ("set", "add")
+
+def write_start_count(c, branch_id, user_id, reference="", categories=None):
+    """Freeze the branch's stock for a new count session on the writer's cursor, returns the session id"""
+    created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # Movements after this id happened after the freeze and are carried over when posting
+    c.execute('''INSERT INTO count_sessions (branch_id, reference, status, snapshot_movement_id, created_at, created_by)
+                 SELECT ?, ?, 'OPEN', COALESCE(MAX(id), 0), ?, ? FROM stock_movements''',
+              (branch_id, reference, created_at, user_id))
+    session_id = c.lastrowid
+    
+    query = '''INSERT INTO count_snapshot (session_id, item_id, frozen_stock, unit_cost)
+               SELECT ?, s.item_id, s.current_stock, s.cost_per_unit
+               FROM branch_stock s
+               CROSS JOIN item_catalog c ON c.id = s.item_id
+               WHERE s.branch_id = ?'''
+    params = [session_id, branch_id]
+    if categories:
+        query += f" AND c.category IN ({', '.join('?' * len(categories))})"
+        params += list(categories)
+    c.execute(query, params)
+    return session_id
+
+@instrumented('mutator')
+def start_count_session(branch_id, user_id="system", reference="", categories=None):
+    """Open a count session for a branch, optionally limited to some categories"""
+    return get_stock_writer().execute(write_start_count, int(branch_id), user_id, reference, categories,
+                                      tables=("count_sessions",), user_id=user_id)
+
+def normalize_count_lines(counts):
+    """Counted quantities summed per item from a DataFrame or (item_id, quantity) pairs"""
+    df = counts.copy() if isinstance(counts, pd.DataFrame) else pd.DataFrame(list(counts), columns=['item_id', 'counted_qty'])
+    df = df.rename(columns={'quantity': 'counted_qty', 'qty': 'counted_qty', 'counted': 'counted_qty'})
+    if not {'item_id', 'counted_qty'} <= set(df.columns):
+        raise ValueError("Count lines need item_id and counted_qty columns")
+    
+    df['item_id'] = df['item_id'].astype(str).str.strip()
+    df['counted_qty'] = pd.to_numeric(df['counted_qty'], errors='coerce')
+    invalid = df['counted_qty'].isna() | (df['counted_qty'] < 0) | (df['item_id'] == '')
+    if invalid.any():
+        raise ValueError(f"{int(invalid.sum())} count lines have no item id or no valid non-negative quantity")
+    # The same SKU counted in several places adds up
+    return df.groupby('item_id', as_index=False)['counted_qty'].sum()
+
+def write_count_lines(c, session_id, lines, user_id, source="upload", mode="set"):
+    """Store counted quantities on the writer's cursor; 'set' replaces earlier counts, 'add' accumulates"""
+    status = c.execute("SELECT status FROM count_sessions WHERE id = ?", (session_id,)).fetchone()
+    if not status or status[0] != 'OPEN':
+        raise ValueError(f"Count session {session_id} is not open")
+    
+    counted_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    update = "excluded.counted_qty" if mode == "set" else "counted_qty + excluded.counted_qty"
+    c.executemany(f'''INSERT INTO count_lines (session_id, item_id, counted_qty, counted_at, counted_by, source)
+                      VALUES (?, ?, ?, ?, ?, ?)
+                      ON CONFLICT (session_id, item_id) DO UPDATE SET
+                          counted_qty = {update}, counted_at = excluded.counted_at,
+                          counted_by = excluded.counted_by, source = excluded.source''',
+                  [(session_id, item_id, qty, counted_at, user_id, source) for item_id, qty in lines])
+    return len(lines)
+
+@instrumented('mutator')
+def record_count_lines(session_id, counts, user_id="system", source="upload", mode="set"):
+    """Add an upload or scanner batch of counted quantities to an open session, returns the lines stored"""
+    if mode not in COUNT_LINE_MODES:
+        raise ValueError(f"mode must be one of {', '.join(COUNT_LINE_MODES)}")
+    lines = normalize_count_lines(counts)
+    return get_stock_writer().execute(write_count_lines, int(session_id), list(lines.itertuples(index=False, name=None)),
+                                      user_id, source, mode, tables=("count_sessions",), user_id=user_id)
+
+def count_variances(conn, session_id):
+    """Variance of every snapshot and counted line of a session, computed column-wise.
+
+    Counts describe the stock at the freeze, so movements booked since then
+    are added on top: the posted level is counted + moved since. For a posted
+    session only movements up to the posting are taken into account.
+    """
+    session = conn.execute("SELECT branch_id, snapshot_movement_id, posted_movement_id FROM count_sessions WHERE id = ?",
+                           (session_id,)).fetchone()
+    if not session:
+        raise ValueError(f"Unknown count session {session_id}")
+    branch_id, snapshot_id, posted_id = session
+    
+    snapshot = pd.read_sql_query("SELECT item_id, frozen_stock, unit_cost FROM count_snapshot WHERE session_id = ?",
+                                 conn, params=[session_id])
+    lines = pd.read_sql_query("SELECT item_id, counted_qty, counted_by, source FROM count_lines WHERE session_id = ?",
+                              conn, params=[session_id])
+    since = pd.read_sql_query('''SELECT item_id, SUM(stock_delta) as moved_since
+                                 FROM stock_movements
+                                 WHERE id > ? AND id <= ? AND branch_id = ? AND stock_delta IS NOT NULL
+                                 GROUP BY item_id''', conn, params=[snapshot_id, posted_id or 2 ** 62, branch_id])
+    catalog = pd.read_sql_query('''SELECT c.id as item_id, c.name, c.category, c.unit
+                                   FROM count_snapshot s JOIN item_catalog c ON c.id = s.item_id
+                                   WHERE s.session_id = ?
+                                   UNION
+                                   SELECT c.id, c.name, c.category, c.unit
+                                   FROM count_lines l JOIN item_catalog c ON c.id = l.item_id
+                                   WHERE l.session_id = ?''', conn, params=[session_id, session_id])
+    
+    df = (snapshot.merge(lines, on='item_id', how='outer')
+                  .merge(since, on='item_id', how='left')
+                  .merge(catalog, on='item_id', how='left'))
+    df['moved_since'] = df['moved_since'].fillna(0.0)
+    df['variance'] = df['counted_qty'] - df['frozen_stock']
+    df['variance_value'] = df['variance'] * df['unit_cost'].fillna(0.0)
+    df['expected_stock'] = df['frozen_stock'] + df['moved_since']
+    df['new_stock'] = (df['counted_qty'] + df['moved_since']).where(df['frozen_stock'].notna())
+    df['status'] = np.select([df['frozen_stock'].isna(), df['counted_qty'].isna(),
+                              df['variance'].abs() <= QUANTITY_EPSILON, df['variance'] > 0],
+                             ['unknown', 'not counted', 'match', 'over'], default='short')
+    columns = ['item_id', 'name', 'category', 'unit', 'frozen_stock', 'counted_qty', 'variance', 'unit_cost',
+               'variance_value', 'moved_since', 'expected_stock', 'new_stock', 'status', 'counted_by', 'source']
+    return df[columns].sort_values('item_id').reset_index(drop=True)
+
+def get_count_variances(session_id):
+    """Variance report for a count session"""
+    conn = get_connection()
+    try:
+        return count_variances(conn, int(session_id))
+    finally:
+        conn.close()
+
+def write_post_count(c, session_id, user_id):
+    """Post every counted variance of an open session on the writer's cursor, returns (success, message)"""
+    session = c.execute("SELECT branch_id, reference, status FROM count_sessions WHERE id = ?", (session_id,)).fetchone()
+    if not session or session[2] != 'OPEN':
+        return False, f"Count session {session_id} is not open"
+    branch_id, reference = session[0], session[1]
+    
+    # Movements up to here are carried over; the adjustments below come after the boundary
+    posted_id = c.execute("SELECT COALESCE(MAX(id), 0) FROM stock_movements").fetchone()[0]
+    c.execute("UPDATE count_sessions SET posted_movement_id = ? WHERE id = ?", (posted_id, session_id))
+    variances = count_variances(c.connection, session_id)
+    adjust = variances[variances['status'].isin(['over', 'short'])]
+    
+    label = f"Count #{session_id}" + (f" - {reference}" if reference else "")
+    for item_id, new_stock in zip(adjust['item_id'], adjust['new_stock']):
+        write_set_stock_level(c, item_id, branch_id, float(new_stock), label, user_id=user_id)
+    
+    value = float(adjust['variance_value'].sum())
+    c.execute('''UPDATE count_sessions SET status = 'POSTED', posted_at = ?, posted_by = ?, adjusted_items = ?, variance_value = ?
+                 WHERE id = ?''', (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), user_id, len(adjust), value, session_id))
+    return True, f"Posted {len(adjust)} adjustments, net variance value {value:,.2f}"
+
+@instrumented('mutator')
+def post_count_session(session_id, user_id="system"):
+    """Post all adjustments of a count session in one transaction, returns (success, message)"""
+    return get_stock_writer().execute(write_post_count, int(session_id), user_id,
+                                      tables=("items", "stock_movements", "count_sessions"), user_id=user_id)
+
+def write_cancel_count(c, session_id):
+    """Close an open count session without posting on the writer's cursor"""
+    c.execute("UPDATE count_sessions SET status = 'CANCELLED' WHERE id = ? AND status = 'OPEN'", (session_id,))
+    return c.rowcount == 1
+
+@instrumented('mutator')
+def cancel_count_session(session_id, user_id="system"):
+    """Cancel an open count session, returns whether one was cancelled"""
+    return get_stock_writer().execute(write_cancel_count, int(session_id), tables=("count_sessions",), user_id=user_id)
+
+def get_count_sessions(branch_id=None, status=None, limit=100):
+    """Count sessions with their progress, newest first"""
+    query = '''SELECT cs.*, b.branch_name,
+                      (SELECT COUNT(*) FROM count_snapshot s WHERE s.session_id = cs.id) as snapshot_items,
+                      (SELECT COUNT(*) FROM count_lines l WHERE l.session_id = cs.id) as counted_items
+               FROM count_sessions cs
+               JOIN branches b ON b.id = cs.branch_id
+               WHERE 1 = 1'''
+    params = []
+    if branch_id is not None:
+        query += " AND cs.branch_id = ?"
+        params.append(int(branch_id))
+    if status:
+        query += " AND cs.status = ?"
+        params.append(status)
+    query += " ORDER BY cs.id DESC LIMIT ?"
+    params.append(limit)
+    return get_read_hub().query(query, tuple(params))
+
+# ===============================
+# RESERVATIONS
+# ===============================
+
+RESERVATION_KINDS = ("ORDER", "PRODUCTION")
+
+def write_reserve(c, reference, branch_id, lines, kind, user_id):
+    """Reserve every (item_id, quantity) line on the writer's cursor, all or nothing, returns the lines reserved.
+
+    Each line is one conditional update that only succeeds while enough stock
+    is unreserved, so concurrent callers can never promise the same units.
+    A short line raises ValueError and the writer rolls the whole call back.
+    """
+    created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for item_id, quantity in lines:
+        c.execute('''UPDATE branch_stock SET reserved_stock = reserved_stock + ?
+                     WHERE branch_id = ? AND item_id = ? AND current_stock - reserved_stock >= ? - ?''',
+                  (quantity, branch_id, item_id, quantity, QUANTITY_EPSILON))
+        if c.rowcount == 0:
+            row = c.execute("SELECT current_stock - reserved_stock FROM branch_stock WHERE branch_id = ? AND item_id = ?",
+                            (branch_id, item_id)).fetchone()
+            raise ValueError(f"{item_id}: need {quantity}, available {row[0] if row else 0}")
+        c.execute('''INSERT INTO reservations (reference, kind, item_id, branch_id, quantity, status, created_at, created_by)
+                     VALUES (?, ?, ?, ?, ?, 'ACTIVE', ?, ?)''',
+                  (reference, kind, item_id, branch_id, quantity, created_at, user_id))
+    return len(lines)
+
+def reservation_lines(lines):
+    """Positive quantities summed per item from (item_id, quantity) pairs"""
+    totals = {}
+    for item_id, quantity in lines:
+        quantity = float(quantity)
+        if quantity <= 0:
+            raise ValueError(f"{item_id}: quantity must be positive")
+        totals[str(item_id)] = totals.get(str(item_id), 0) + quantity
+    return list(totals.items())
+
+@instrumented('mutator')
+def allocate_stock(reference, branch_id, lines, user_id="system", kind="ORDER"):
+    """Reserve stock for an order or other reference, all lines or none, returns (success, message)"""
+    if kind not in RESERVATION_KINDS:
+        return False, f"kind must be one of {', '.join(RESERVATION_KINDS)}"
+    try:
+        reserved = get_stock_writer().execute(write_reserve, reference, int(branch_id), reservation_lines(lines), kind, user_id,
+                                              tables=("items", "reservations"), user_id=user_id)
+    except ValueError as e:
+        return False, f"Insufficient available stock: {e}"
+    return True, f"Reserved {reserved} lines for {reference}"
+
+def write_allocate_production(c, final_product_id, branch_id, quantity_to_produce, reference, user_id):
+    """Reserve the BOM ingredients of a planned production run on the writer's cursor"""
+    bom = c.execute("SELECT ingredient_id, quantity_required FROM bom WHERE final_product_id = ? AND branch_id = ?",
+                    (final_product_id, branch_id)).fetchall()
+    if not bom:
+        raise ValueError("No Bill of Materials found for this product")
+    lines = reservation_lines((ingredient_id, quantity_required * quantity_to_produce) for ingredient_id, quantity_required in bom)
+    return write_reserve(c, reference, branch_id, lines, 'PRODUCTION', user_id)
+
+@instrumented('mutator')
+def allocate_production(final_product_id, branch_id, quantity_to_produce, user_id="system", reference=None):
+    """Reserve ingredients for planned production; produce_item with the same reference uses them, returns (success, message)"""
+    reference = reference or f"Production {final_product_id} x {quantity_to_produce} ({datetime.now():%Y-%m-%d %H:%M})"
+    try:
+        get_stock_writer().execute(write_allocate_production, final_product_id, int(branch_id), quantity_to_produce,
+                                   reference, user_id, tables=("items", "reservations"), user_id=user_id)
+    except ValueError as e:
+        return False, f"Cannot reserve ingredients: {e}"
+    return True, f"Ingredients reserved as '{reference}'"
+
+def write_close_reservations(c, reference, status, user_id, branch_id=None):
+    """Close the active reservations of a reference on the writer's cursor, returns their (item_id, branch_id, quantity)"""
+    query = "SELECT id, item_id, branch_id, quantity FROM reservations WHERE reference = ? AND status = 'ACTIVE'"
+    params = [reference]
+    if branch_id is not None:
+        query += " AND branch_id = ?"
+        params.append(branch_id)
+    rows = c.execute(query, params).fetchall()
+    
+    closed_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    c.executemany("UPDATE reservations SET status = ?, closed_at = ?, closed_by = ? WHERE id = ?",
+                  [(status, closed_at, user_id, row[0]) for row in rows])
+    c.executemany("UPDATE branch_stock SET reserved_stock = MAX(reserved_stock - ?, 0) WHERE item_id = ? AND branch_id = ?",
+                  [(quantity, item_id, branch) for _, item_id, branch, quantity in rows])
+    return [row[1:] for row in rows]
+
+@instrumented('mutator')
+def release_reservations(reference, user_id="system"):
+    """Give the stock held by a reference back, returns the number of lines released"""
+    return len(get_stock_writer().execute(write_close_reservations, reference, 'RELEASED', user_id,
+                                          tables=("items", "reservations"), user_id=user_id))
+
+def write_fulfil_reservations(c, reference, user_id):
+    """Issue the reserved stock of an order on the writer's cursor, returns (success, message)"""
+    lines = write_close_reservations(c, reference, 'FULFILLED', user_id)
+    if not lines:
+        return False, f"No active reservations for {reference}"
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for item_id, branch_id, quantity in lines:
+        have = c.execute("SELECT current_stock FROM branch_stock WHERE item_id = ? AND branch_id = ?", (item_id, branch_id)).fetchone()
+        # Reserved units can still leave through unplanned OUT movements
+        if not have or have[0] < quantity - QUANTITY_EPSILON:
+            raise ValueError(f"{item_id}: {quantity} reserved but only {have[0] if have else 0} on hand")
+        apply_stock_movement(c, item_id, branch_id, quantity, 'OUT', f"Order {reference}", user_id=user_id, timestamp=timestamp)
+    return True, f"Issued {len(lines)} reserved lines for {reference}"
+
+@instrumented('mutator')
+def fulfil_reservations(reference, user_id="system"):
+    """Ship an order: issue its reserved stock and close the reservations, returns (success, message)"""
+    try:
+        return get_stock_writer().execute(write_fulfil_reservations, reference, user_id,
+                                          tables=("items", "stock_movements", "reservations"), user_id=user_id)
+    except ValueError as e:
+        return False, f"Cannot fulfil {reference}: {e}"
+
+def get_reservations(branch_id=None, status="ACTIVE", reference=None, kind=None, limit=1000):
+    """Reservations with item names, newest first"""
+    query = '''SELECT r.*, c.name as item_name, c.unit
+               FROM reservations r
+               JOIN item_catalog c ON c.id = r.item_id
+               WHERE 1 = 1'''
+    params = []
+    for column, value in (("r.branch_id", branch_id), ("r.status", status), ("r.reference", reference), ("r.kind", kind)):
+        if value is not None:
+            query += f" AND {column} = ?"
+            params.append(int(value) if column == "r.branch_id" else value)
+    query += " ORDER BY r.id DESC LIMIT ?"
+    params.append(limit)
+    return get_read_hub().query(query, tuple(params))
+
+# Reserved totals recomputed from the open reservations; the running counters must agree with it
+RESERVED_RECOUNT = '''SELECT s.branch_id, s.item_id, s.reserved_stock, COALESCE(r.reserved, 0) as reserved_recount
+                      FROM branch_stock s
+                      LEFT JOIN (SELECT branch_id, item_id, SUM(quantity) as reserved FROM reservations
+                                 WHERE status = 'ACTIVE' GROUP BY branch_id, item_id) r
+                             ON r.branch_id = s.branch_id AND r.item_id = s.item_id
+                      WHERE s.reserved_stock != 0 OR r.reserved IS NOT NULL'''
+
+def write_rebuild_reserved_stock(c):
+    """Reset drifted reserved_stock counters to a recount on the writer's cursor, returns how many changed"""
+    drifted = [(reserved, branch_id, item_id) for branch_id, item_id, stored, reserved in c.execute(RESERVED_RECOUNT).fetchall()
+               if abs(stored - reserved) > 1e-6]
+    c.executemany("UPDATE branch_stock SET reserved_stock = ? WHERE branch_id = ? AND item_id = ?", drifted)
+    return len(drifted)
+
+def check_reservations(repair=False):
+    """Compare reserved_stock with the sum of active reservations, returns the rows that disagree"""
+    conn = get_connection()
+    recount = pd.read_sql_query(RESERVED_RECOUNT, conn, dtype={'reserved_stock': float, 'reserved_recount': float})
+    conn.close()
+    drifted = recount[~np.isclose(recount['reserved_stock'], recount['reserved_recount'], atol=1e-6)].reset_index(drop=True)
+    if repair and not drifted.empty:
+        get_stock_writer().execute(write_rebuild_reserved_stock, tables=("items",))
+    return drifted
+
+# ===============================
+# SHIPMENTS
+# ===============================
+
+# Shipments still expecting goods
+OPEN_SHIPMENT_STATUSES = ("IN_TRANSIT", "PARTIAL")
+
+def write_dispatch_shipment(c, from_branch_id, to_branch_id, lines, reference, user_id, timestamp=None):
+    """Send (item_id, quantity) lines on their way on the writer's cursor, returns the shipment id.
+
+    The source is debited now and the goods, with their lot layers, sit in
+    the in-transit ledger until the destination receives them.
+    """
+    # Check every line before writing anything
+    check_transfer(c, from_branch_id, to_branch_id, lines)
+    
+    timestamp = timestamp or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    c.execute('''INSERT INTO shipments (reference, from_branch_id, to_branch_id, status, dispatched_at, dispatched_by)
+                 VALUES (?, ?, ?, 'IN_TRANSIT', ?, ?)''', (reference, from_branch_id, to_branch_id, timestamp, user_id))
+    shipment_id = c.lastrowid
+    label = f"Shipment #{shipment_id}" + (f" - {reference}" if reference else "")
+    
+    for item_id, quantity in lines:
+        # First arrival in the destination only needs a stock row; the catalog already describes the item
+        c.execute('''INSERT INTO branch_stock (item_id, branch_id, current_stock, min_stock, cost_per_unit)
+                     SELECT item_id, ?, 0, min_stock, cost_per_unit FROM branch_stock WHERE item_id = ? AND branch_id = ?
+                     ON CONFLICT (item_id, branch_id) DO NOTHING''', (to_branch_id, item_id, from_branch_id))
+        movement_id, allocations = apply_stock_movement(c, item_id, from_branch_id, quantity, 'TRANSFER_OUT', label,
+                                                        user_id=user_id, timestamp=timestamp,
+                                                        from_branch_id=from_branch_id, to_branch_id=to_branch_id)
+        # Stock issued beyond its lots is priced at the movement's cost
+        issue_cost = c.execute("SELECT unit_cost FROM stock_movements WHERE id = ?", (movement_id,)).fetchone()[0] or 0
+        layers = [(shipment_id, item_id, a['lot_id'], a['batch_nr'], a['received_date'], a['expiry_date'],
+                   a['unit_cost'] if a['lot_id'] is not None else issue_cost, a['quantity'], a['quantity']) for a in allocations]
+        c.executemany('''INSERT INTO shipment_lots (shipment_id, item_id, lot_id, batch_nr, received_date, expiry_date, unit_cost,
+                                                    quantity, remaining)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', layers)
+        value = sum(layer[6] * layer[7] for layer in layers)
+        c.execute("INSERT INTO shipment_lines (shipment_id, item_id, quantity_sent, value_sent) VALUES (?, ?, ?, ?)",
+                  (shipment_id, item_id, quantity, value))
+        c.execute('''INSERT INTO in_transit (from_branch_id, to_branch_id, item_id, quantity, value) VALUES (?, ?, ?, ?, ?)
+                     ON CONFLICT (from_branch_id, to_branch_id, item_id) DO UPDATE SET
+                         quantity = quantity + excluded.quantity, value = value + excluded.value''',
+                  (from_branch_id, to_branch_id, item_id, quantity, value))
+    return shipment_id
+
+@instrumented('mutator')
+def dispatch_shipment(from_branch_id, to_branch_id, lines, reference="", user_id="system"):
+    """Dispatch a shipment of (item_id, quantity) lines, returns its id; ValueError if stock is short"""
+    return get_stock_writer().execute(write_dispatch_shipment, int(from_branch_id), int(to_branch_id),
+                                      reservation_lines(lines), reference, user_id,
+                                      tables=("items", "stock_movements", "shipments"), user_id=user_id)
+
+def write_receive_shipment(c, shipment_id, lines, user_id, timestamp=None):
+    """Book arriving goods on the writer's cursor; lines of None receive everything outstanding, returns the new status"""
+    shipment = c.execute("SELECT from_branch_id, to_branch_id, reference, status FROM shipments WHERE id = ?",
+                         (shipment_id,)).fetchone()
+    if not shipment or shipment[3] not in OPEN_SHIPMENT_STATUSES:
+        raise ValueError(f"Shipment {shipment_id} is not in transit")
+    from_branch_id, to_branch_id, reference, _ = shipment
+    
+    outstanding = dict(c.execute('''SELECT item_id, quantity_sent - quantity_received - quantity_lost FROM shipment_lines
+                                    WHERE shipment_id = ?''', (shipment_id,)).fetchall())
+    lines = [(item_id, qty) for item_id, qty in outstanding.items() if qty > QUANTITY_EPSILON] if lines is None else lines
+    for item_id, quantity in lines:
+        if quantity > outstanding.get(item_id, 0) + QUANTITY_EPSILON:
+            raise ValueError(f"{item_id}: receiving {quantity} but only {outstanding.get(item_id, 0)} outstanding")
+    
+    timestamp = timestamp or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    label = f"Shipment #{shipment_id}" + (f" - {reference}" if reference else "")
+    for item_id, quantity in lines:
+        # Oldest layers arrive first
+        layers = c.execute('''SELECT id, lot_id, batch_nr, received_date, expiry_date, unit_cost, remaining FROM shipment_lots
+                              WHERE shipment_id = ? AND item_id = ? AND remaining > 0 ORDER BY id''',
+                           (shipment_id, item_id)).fetchall()
+        source_lots, taken, remaining = [], [], quantity
+        for layer_id, lot_id, batch_nr, received_date, expiry_date, unit_cost, left in layers:
+            if remaining <= QUANTITY_EPSILON:
+                break
+            take = min(left, remaining)
+            source_lots.append({'lot_id': lot_id, 'quantity': take, 'batch_nr': batch_nr, 'received_date': received_date,
+                                'expiry_date': expiry_date, 'unit_cost': unit_cost})
+            taken.append((0 if left - take <= QUANTITY_EPSILON else left - take, layer_id))
+            remaining -= take
+        c.executemany("UPDATE shipment_lots SET remaining = ? WHERE id = ?", taken)
+        
+        apply_stock_movement(c, item_id, to_branch_id, quantity, 'TRANSFER_IN', label, user_id=user_id, timestamp=timestamp,
+                             from_branch_id=from_branch_id, to_branch_id=to_branch_id, source_lots=source_lots)
+        value = sum(lot['quantity'] * (lot['unit_cost'] or 0) for lot in source_lots)
+        c.execute("UPDATE shipment_lines SET quantity_received = quantity_received + ? WHERE shipment_id = ? AND item_id = ?",
+                  (quantity, shipment_id, item_id))
+        c.execute('''UPDATE in_transit SET quantity = quantity - ?, value = value - ?
+                     WHERE from_branch_id = ? AND to_branch_id = ? AND item_id = ?''',
+                  (quantity, value, from_branch_id, to_branch_id, item_id))
+    
+    open_lines = c.execute('''SELECT COUNT(*) FROM shipment_lines
+                              WHERE shipment_id = ? AND quantity_sent - quantity_received - quantity_lost > ?''',
+                           (shipment_id, QUANTITY_EPSILON)).fetchone()[0]
+    status = 'PARTIAL' if open_lines else 'RECEIVED'
+    c.execute("UPDATE shipments SET status = ?, received_at = ? WHERE id = ?", (status, timestamp, shipment_id))
+    return status
+
+@instrumented('mutator')
+def receive_shipment(shipment_id, lines=None, user_id="system"):
+    """Receive a shipment in full, or only the given (item_id, quantity) lines, returns (success, message)"""
+    try:
+        status = get_stock_writer().execute(write_receive_shipment, int(shipment_id),
+                                            None if lines is None else reservation_lines(lines), user_id,
+                                            tables=("items", "stock_movements", "shipments"), user_id=user_id)
+    except ValueError as e:
+        return False, f"Cannot receive: {e}"
+    return True, f"Shipment #{shipment_id} {'received in full' if status == 'RECEIVED' else 'partly received'}"
+
+def write_close_shipments(c, shipment_ids, user_id):
+    """Write off whatever never arrived on a batch of shipments on the writer's cursor, returns (shipments, value)"""
+    ids = json.dumps([int(i) for i in shipment_ids])
+    open_ids = f"SELECT id FROM shipments WHERE id IN (SELECT value FROM json_each(?)) AND status IN {OPEN_SHIPMENT_STATUSES}"
+    
+    # Everything below works on the whole batch at once
+    c.execute(f'''UPDATE in_transit SET quantity = in_transit.quantity - lost.quantity, value = in_transit.value - lost.value
+                  FROM (SELECT s.from_branch_id, s.to_branch_id, l.item_id,
+                               SUM(l.remaining) as quantity, SUM(l.remaining * l.unit_cost) as value
+                        FROM shipment_lots l JOIN shipments s ON s.id = l.shipment_id
+                        WHERE l.shipment_id IN ({open_ids}) AND l.remaining > 0
+                        GROUP BY s.from_branch_id, s.to_branch_id, l.item_id) lost
+                  WHERE in_transit.from_branch_id = lost.from_branch_id AND in_transit.to_branch_id = lost.to_branch_id
+                    AND in_transit.item_id = lost.item_id''', (ids,))
+    c.execute(f'''UPDATE shipments SET status = 'CLOSED', closed_at = ?, closed_by = ?,
+                      variance_value = (SELECT COALESCE(SUM(remaining * unit_cost), 0) FROM shipment_lots
+                                        WHERE shipment_id = shipments.id)
+                  WHERE id IN ({open_ids})
+                  RETURNING variance_value''', (datetime.now().strftime("%Y-%m-%d %H:%M:%S"), user_id, ids))
+    closed = c.fetchall()
+    closed_ids = f"SELECT id FROM shipments WHERE id IN (SELECT value FROM json_each(?)) AND status = 'CLOSED'"
+    c.execute(f'''UPDATE shipment_lines SET quantity_lost = quantity_sent - quantity_received
+                  WHERE shipment_id IN ({closed_ids})''', (ids,))
+    c.execute(f"UPDATE shipment_lots SET remaining = 0 WHERE shipment_id IN ({closed_ids}) AND remaining > 0", (ids,))
+    return len(closed), sum(value for (value,) in closed)
+
+@instrumented('mutator')
+def close_shipments(shipment_ids, user_id="system"):
+    """Close open shipments, booking what is still in transit as lost, returns (closed, variance value)"""
+    return get_stock_writer().execute(write_close_shipments, list(shipment_ids), user_id, tables=("shipments",),
+                                      user_id=user_id)
+
+def get_shipments(branch_id=None, direction="inbound", status=None, limit=500):
+    """Shipments into or out of a branch, newest first; status 'OPEN' means still expecting goods"""
+    query = '''SELECT s.*, bf.branch_name as from_branch_name, bt.branch_name as to_branch_name,
+                      (SELECT COUNT(*) FROM shipment_lines l WHERE l.shipment_id = s.id) as lines,
+                      (SELECT SUM(l.quantity_sent - l.quantity_received - l.quantity_lost)
+                       FROM shipment_lines l WHERE l.shipment_id = s.id) as outstanding
+               FROM shipments s
+               JOIN branches bf ON bf.id = s.from_branch_id
+               JOIN branches bt ON bt.id = s.to_branch_id
+               WHERE 1 = 1'''
+    params = []
+    if branch_id is not None:
+        query += f" AND s.{'to_branch_id' if direction == 'inbound' else 'from_branch_id'} = ?"
+        params.append(int(branch_id))
+    if status == "OPEN":
+        query += f" AND s.status IN {OPEN_SHIPMENT_STATUSES}"
+    elif status:
+        query += " AND s.status = ?"
+        params.append(status)
+    query += " ORDER BY s.id DESC LIMIT ?"
+    params.append(limit)
+    return get_read_hub().query(query, tuple(params))
+
+def get_shipment_lines(shipment_id):
+    """Lines of a shipment with what is still outstanding"""
+    return get_read_hub().query('''SELECT l.*, l.quantity_sent - l.quantity_received - l.quantity_lost as outstanding,
+                                          c.name as item_name, c.unit
+                                   FROM shipment_lines l
+                                   JOIN item_catalog c ON c.id = l.item_id
+                                   WHERE l.shipment_id = ?
+                                   ORDER BY l.item_id''', (int(shipment_id),))
+
+def get_in_transit(branch_id=None):
+    """In-transit stock per branch pair and item; a branch sees goods leaving and arriving"""
+    query = '''SELECT t.*, bf.branch_name as from_branch_name, bt.branch_name as to_branch_name, c.name as item_name, c.unit
+               FROM in_transit t
+               JOIN branches bf ON bf.id = t.from_branch_id
+               JOIN branches bt ON bt.id = t.to_branch_id
+               JOIN item_catalog c ON c.id = t.item_id
+               WHERE t.quantity > ?'''
+    params = [QUANTITY_EPSILON]
+    if branch_id is not None:
+        query += " AND (t.from_branch_id = ? OR t.to_branch_id = ?)"
+        params += [int(branch_id), int(branch_id)]
+    return get_read_hub().query(query + " ORDER BY bf.branch_name, bt.branch_name, c.name", tuple(params))
+
+# In-transit stock recomputed from the layers still on the road; the ledger must agree with it
+IN_TRANSIT_RECOUNT = '''SELECT t.from_branch_id, t.to_branch_id, t.item_id, t.quantity, t.value,
+                               COALESCE(r.quantity, 0) as quantity_recount, COALESCE(r.value, 0) as value_recount
+                        FROM in_transit t
+                        LEFT JOIN (SELECT s.from_branch_id, s.to_branch_id, l.item_id,
+                                          SUM(l.remaining) as quantity, SUM(l.remaining * l.unit_cost) as value
+                                   FROM shipment_lots l JOIN shipments s ON s.id = l.shipment_id
+                                   WHERE s.status IN ('IN_TRANSIT', 'PARTIAL')
+                                   GROUP BY s.from_branch_id, s.to_branch_id, l.item_id) r
+                               ON r.from_branch_id = t.from_branch_id AND r.to_branch_id = t.to_branch_id AND r.item_id = t.item_id'''
+
+def in_transit_drifted(stored_quantity, stored_value, quantity, value):
+    """Whether a ledger row disagrees with its recount in quantity or in value at layer cost"""
+    return ~(np.isclose(stored_quantity, quantity, rtol=1e-6, atol=1e-6) &
+             np.isclose(stored_value, value, rtol=1e-6, atol=1e-6))
+
+def write_rebuild_in_transit(c):
+    """Reset drifted in-transit rows to a recount on the writer's cursor, returns how many changed"""
+    drifted = [(quantity, value, from_branch_id, to_branch_id, item_id)
+               for from_branch_id, to_branch_id, item_id, stored_quantity, stored_value, quantity, value
+               in c.execute(IN_TRANSIT_RECOUNT).fetchall()
+               if in_transit_drifted(stored_quantity, stored_value or 0, quantity, value)]
+    c.executemany('''UPDATE in_transit SET quantity = ?, value = ?
+                     WHERE from_branch_id = ? AND to_branch_id = ? AND item_id = ?''', drifted)
+    return len(drifted)
+
+def check_in_transit(repair=False):
+    """Compare the in-transit ledger with the layers on open shipments, returns the rows that disagree"""
+    conn = get_connection()
+    recount = pd.read_sql_query(IN_TRANSIT_RECOUNT, conn, dtype={'quantity': float, 'quantity_recount': float,
+                                                                 'value': float, 'value_recount': float})
+    conn.close()
+    drifted = recount[in_transit_drifted(recount['quantity'], recount['value'].fillna(0), recount['quantity_recount'],
+                                         recount['value_recount'])].reset_index(drop=True)
+    if repair and not drifted.empty:
+        get_stock_writer().execute(write_rebuild_in_transit, tables=("shipments",))
+    return drifted
+
+# ===============================
+# MRP PLANNER
+# ===============================
+
+# Planning bucket sizes, as pandas period frequencies
+MRP_BUCKETS = {"D": "Daily", "W": "Weekly", "M": "Monthly"}
+
+def normalize_schedule(schedule):
+    """Schedule rows as a DataFrame of final_product_id, branch_id, quantity, due_date (YYYY-MM-DD) and reference"""
+    df = schedule.copy() if isinstance(schedule, pd.DataFrame) else pd.DataFrame(list(schedule))
+    df = df.rename(columns={'product_id': 'final_product_id', 'item_id': 'final_product_id', 'qty': 'quantity', 'due': 'due_date'})
+    missing = {'final_product_id', 'branch_id', 'quantity', 'due_date'} - set(df.columns)
+    if missing:
+        raise ValueError(f"Schedule rows need {', '.join(sorted(missing))}")
+    
+    df['final_product_id'] = df['final_product_id'].astype(str).str.strip()
+    df['branch_id'] = pd.to_numeric(df['branch_id'], errors='coerce')
+    df['quantity'] = pd.to_numeric(df['quantity'], errors='coerce')
+    df['due_date'] = pd.to_datetime(df['due_date'], errors='coerce')
+    invalid = df['branch_id'].isna() | df['due_date'].isna() | ~(df['quantity'] > 0) | (df['final_product_id'] == '')
+    if invalid.any():
+        raise ValueError(f"{int(invalid.sum())} schedule rows have no product, branch, due date or positive quantity")
+    df['branch_id'] = df['branch_id'].astype(int)
+    df['due_date'] = df['due_date'].dt.strftime("%Y-%m-%d")
+    df['reference'] = df['reference'].fillna('').astype(str) if 'reference' in df.columns else ''
+    return df[['final_product_id', 'branch_id', 'quantity', 'due_date', 'reference']]
+
+def write_schedule_production(c, rows, user_id):
+    """Add production schedule rows on the writer's cursor, returns how many"""
+    pairs = json.dumps(sorted({(product_id, branch_id) for product_id, branch_id, *_ in rows}))
+    unknown = c.execute('''SELECT json_extract(j.value, '$[0]'), json_extract(j.value, '$[1]')
+                           FROM json_each(?) j
+                           LEFT JOIN branch_stock bs ON bs.item_id = json_extract(j.value, '$[0]')
+                                                    AND bs.branch_id = json_extract(j.value, '$[1]')
+                           WHERE bs.item_id IS NULL''', (pairs,)).fetchall()
+    if unknown:
+        raise ValueError(f"Not stocked at the branch: {', '.join(f'{p} (branch {b})' for p, b in unknown[:5])}")
+    created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    c.executemany('''INSERT INTO production_schedule (final_product_id, branch_id, quantity, due_date, reference, status,
+                                                      created_at, created_by)
+                     VALUES (?, ?, ?, ?, ?, 'PLANNED', ?, ?)''',
+                  [row + (created_at, user_id) for row in rows])
+    return len(rows)
+
+@instrumented('mutator')
+def schedule_production(schedule, user_id="system"):
+    """Add runs to the production schedule from a DataFrame or row dicts, returns how many"""
+    rows = list(normalize_schedule(schedule).itertuples(index=False, name=None))
+    return get_stock_writer().execute(write_schedule_production, rows, user_id, tables=("production_schedule",),
+                                      user_id=user_id)
+
+def write_set_schedule_status(c, schedule_ids, status):
+    """Close planned schedule rows on the writer's cursor, returns how many changed"""
+    c.executemany("UPDATE production_schedule SET status = ? WHERE id = ? AND status = 'PLANNED'",
+                  [(status, int(schedule_id)) for schedule_id in schedule_ids])
+    return c.rowcount
+
+@instrumented('mutator')
+def set_schedule_status(schedule_ids, status, user_id="system"):
+    """Mark planned runs DONE or CANCELLED, returns how many changed"""
+    if status not in ("DONE", "CANCELLED"):
+        raise ValueError("status must be DONE or CANCELLED")
+    return get_stock_writer().execute(write_set_schedule_status, list(schedule_ids), status,
+                                      tables=("production_schedule",), user_id=user_id)
+
+def get_production_schedule(branch_id=None, status="PLANNED", limit=10000):
+    """Scheduled runs with product and branch names, earliest due first"""
+    query = '''SELECT ps.*, c.name as product_name, c.unit, b.branch_name
+               FROM production_schedule ps
+               JOIN item_catalog c ON c.id = ps.final_product_id
+               JOIN branches b ON b.id = ps.branch_id
+               WHERE ps.status = ?'''
+    params = [status]
+    if branch_id is not None:
+        query += " AND ps.branch_id = ?"
+        params.append(int(branch_id))
+    query += " ORDER BY ps.due_date, ps.id LIMIT ?"
+    params.append(limit)
+    return get_read_hub().query(query, tuple(params))
+
+def bom_levels(bom):
+    """Low-level code of every (branch_id, item_id) in the BOM: the deepest level it is used at"""
+    parents = bom[['branch_id', 'final_product_id']].rename(columns={'final_product_id': 'item_id'})
+    children = bom[['branch_id', 'ingredient_id']].rename(columns={'ingredient_id': 'item_id'})
+    levels = pd.concat([parents, children]).drop_duplicates().assign(level=0)
+    edges = bom[['branch_id', 'final_product_id', 'ingredient_id']]
+    
+    # A component sits one level below its deepest parent; repeat until nothing moves
+    for _ in range(len(levels) + 1):
+        pushed = (edges.merge(levels, left_on=['branch_id', 'final_product_id'], right_on=['branch_id', 'item_id'])
+                       .assign(level=lambda df: df['level'] + 1)
+                       .groupby(['branch_id', 'ingredient_id'], as_index=False)['level'].max()
+                       .rename(columns={'ingredient_id': 'item_id'}))
+        updated = levels.merge(pushed, on=['branch_id', 'item_id'], how='left', suffixes=('', '_pushed'))
+        updated['level_pushed'] = updated['level_pushed'].fillna(0).astype(int)
+        if (updated['level_pushed'] <= updated['level']).all():
+            return levels.reset_index(drop=True)
+        levels = updated.assign(level=updated[['level', 'level_pushed']].max(axis=1))[['branch_id', 'item_id', 'level']]
+    raise ValueError("The bill of materials contains a cycle")
+
+def net_requirements(gross, receipts, on_hand):
+    """Lot-for-lot netting of whole (item x bucket) matrices at once, returns (planned, projected).
+
+    A planned order covers exactly what the cumulative demand is short of
+    on-hand plus cumulative receipts, in the first bucket it is short.
+    """
+    shortfall = np.cumsum(gross - receipts, axis=1) - on_hand[:, None]
+    covered = np.maximum.accumulate(np.maximum(shortfall, 0), axis=1)
+    planned = np.diff(covered, axis=1, prepend=0)
+    projected = on_hand[:, None] + np.cumsum(receipts - gross, axis=1) + covered
+    return planned, projected
+
+def plan_requirements(conn, schedule, freq="W", lead_time_days=0, start=None):
+    """Time-phased MRP for a production schedule, returns {'plan', 'planned_orders', 'shortages'}.
+
+    The schedule's runs are exploded level by level through each branch's
+    BOM and netted against available stock (on hand minus reserved) and
+    goods in transit to the branch. Ingredients reserved for one of the
+    scheduled runs (a PRODUCTION reservation under the run's reference)
+    count as available, since the run's own demand is exploded here. Made items generate planned production
+    orders whose ingredients are needed lead_time_days before they are due;
+    bought items that come up short are the shortages.
+    """
+    schedule = normalize_schedule(schedule)
+    start = pd.Period(start or datetime.now(), freq)
+    bom = pd.read_sql_query("SELECT branch_id, final_product_id, ingredient_id, quantity_required FROM bom", conn)
+    stock = pd.read_sql_query("SELECT branch_id, item_id, current_stock - reserved_stock as on_hand FROM branch_stock", conn)
+    runs = schedule.loc[schedule['reference'] != '', ['branch_id', 'reference']].drop_duplicates()
+    held = pd.read_sql_query('''SELECT branch_id, item_id, reference, SUM(quantity) as held FROM reservations
+                                WHERE status = 'ACTIVE' AND kind = 'PRODUCTION' AND reference IN (SELECT value FROM json_each(?))
+                                GROUP BY branch_id, item_id, reference''', conn, params=[json.dumps(runs['reference'].tolist())])
+    held = held.merge(runs, on=['branch_id', 'reference']).groupby(['branch_id', 'item_id'], as_index=False)['held'].sum()
+    stock = stock.merge(held, on=['branch_id', 'item_id'], how='left')
+    stock['on_hand'] += stock['held'].fillna(0)
+    receipts = pd.read_sql_query('''SELECT s.to_branch_id as branch_id, l.item_id,
+                                            SUM(l.quantity_sent - l.quantity_received - l.quantity_lost) as quantity
+                                     FROM shipments s JOIN shipment_lines l ON l.shipment_id = s.id
+                                     WHERE s.status IN ('IN_TRANSIT', 'PARTIAL')
+                                     GROUP BY s.to_branch_id, l.item_id''', conn)
+    catalog = pd.read_sql_query("SELECT id as item_id, name, unit FROM item_catalog", conn)
+    
+    def bucket_of(dates):
+        # Past-due demand lands in the current bucket
+        return np.maximum(pd.PeriodIndex(pd.to_datetime(dates), freq=freq).asi8 - start.ordinal, 0)
+    
+    levels = bom_levels(bom)
+    made = bom[['branch_id', 'final_product_id']].drop_duplicates().rename(columns={'final_product_id': 'item_id'})
+    demand = pd.DataFrame({'branch_id': schedule['branch_id'], 'item_id': schedule['final_product_id'],
+                           'bucket': bucket_of(schedule['due_date']), 'quantity': schedule['quantity']})
+    buckets = int(demand['bucket'].max()) + 1 if not demand.empty else 1
+    
+    frames = []
+    level = 0
+    while not demand.empty:
+        demand = demand.merge(levels, on=['branch_id', 'item_id'], how='left').fillna({'level': 0})
+        # Items used deeper down wait until all their parents have been planned
+        current, demand = demand[demand['level'] <= level], demand[demand['level'] > level].drop(columns='level')
+        if not current.empty:
+            keys = current[['branch_id', 'item_id']].drop_duplicates().reset_index(drop=True)
+            row = keys.reset_index().merge(current, on=['branch_id', 'item_id'])
+            gross = np.zeros((len(keys), buckets))
+            np.add.at(gross, (row['index'].to_numpy(), row['bucket'].to_numpy().astype(int)), row['quantity'].to_numpy())
+            incoming = np.zeros((len(keys), buckets))
+            incoming[:, 0] = keys.merge(receipts, on=['branch_id', 'item_id'], how='left')['quantity'].fillna(0).to_numpy()
+            on_hand = keys.merge(stock, on=['branch_id', 'item_id'], how='left')['on_hand'].fillna(0).to_numpy()
+            planned, projected = net_requirements(gross, incoming, on_hand)
+            
+            phased = keys.loc[keys.index.repeat(buckets)].reset_index(drop=True)
+            phased['bucket'] = np.tile(np.arange(buckets), len(keys))
+            phased['level'] = level
+            phased['gross'] = gross.ravel()
+            phased['receipts'] = incoming.ravel()
+            phased['projected'] = projected.ravel()
+            phased['planned'] = planned.ravel()
+            phased = phased[(phased['gross'] > QUANTITY_EPSILON) | (phased['planned'] > QUANTITY_EPSILON)]
+            phased = phased.merge(made.assign(order_type='MAKE'), on=['branch_id', 'item_id'], how='left').fillna({'order_type': 'BUY'})
+            frames.append(phased)
+            
+            # Planned production needs its ingredients lead_time_days earlier
+            orders = phased[(phased['order_type'] == 'MAKE') & (phased['planned'] > QUANTITY_EPSILON)]
+            if not orders.empty:
+                exploded = orders.merge(bom, left_on=['branch_id', 'item_id'], right_on=['branch_id', 'final_product_id'])
+                due = (pd.PeriodIndex.from_ordinals(start.ordinal + exploded['bucket'].to_numpy(dtype=int), freq=freq).start_time
+                       - pd.Timedelta(days=lead_time_days))
+                demand = pd.concat([demand, pd.DataFrame({
+                    'branch_id': exploded['branch_id'], 'item_id': exploded['ingredient_id'], 'bucket': bucket_of(due),
+                    'quantity': exploded['planned'] * exploded['quantity_required']})], ignore_index=True)
+        level += 1
+    
+    plan = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(
+        columns=['branch_id', 'item_id', 'bucket', 'level', 'gross', 'receipts', 'projected', 'planned', 'order_type'])
+    plan['period'] = pd.PeriodIndex.from_ordinals(start.ordinal + plan['bucket'].to_numpy(dtype=int), freq=freq).start_time.date
+    plan = plan.merge(catalog, on='item_id', how='left')
+    plan = plan[['branch_id', 'item_id', 'name', 'unit', 'level', 'order_type', 'period', 'gross', 'receipts', 'projected',
+                 'planned']].sort_values(['branch_id', 'level', 'item_id', 'period']).reset_index(drop=True)
+    
+    orders = plan[plan['planned'] > QUANTITY_EPSILON].rename(columns={'planned': 'quantity', 'period': 'due'})
+    orders = orders.assign(release=pd.to_datetime(orders['due']) - pd.to_timedelta(
+        np.where(orders['order_type'] == 'MAKE', lead_time_days, 0), unit='D'))
+    orders['release'] = orders['release'].dt.date
+    planned_orders = orders[['branch_id', 'item_id', 'name', 'unit', 'order_type', 'release', 'due', 'quantity']].reset_index(drop=True)
+    shortages = planned_orders[planned_orders['order_type'] == 'BUY'].drop(columns=['order_type', 'release']).reset_index(drop=True)
+    return {'plan': plan, 'planned_orders': planned_orders, 'shortages': shortages}
+
+def run_mrp(branch_id=None, freq="W", lead_time_days=0, horizon_days=None):
+    """MRP over the planned production schedule, optionally for one branch and a limited horizon"""
+    schedule = get_production_schedule(branch_id)
+    if horizon_days is not None:
+        schedule = schedule[pd.to_datetime(schedule['due_date']) <= datetime.now() + timedelta(days=horizon_days)]
+    conn = get_connection()
+    try:
+        return plan_requirements(conn, schedule, freq, lead_time_days)
+    finally:
+        conn.close()
+
+# ===============================
+# DEMAND FORECAST
+# ===============================
+
+# Movement types that count as demand: issues, sales and production consumption
+DEMAND_TYPES = ('OUT',)
+# History read by the first fit; later fits only read the days since
+FORECAST_HISTORY_DAYS = 365
+# Days of demand kept per series: the moving average window, four weekly seasons
+FORECAST_WINDOW = 28
+FORECAST_SEASON = 7
+FORECAST_ALPHA = 0.2
+# Weight of the newest day in each model's running squared error
+FORECAST_ERROR_WEIGHT = 0.05
+FORECAST_MODELS = ('MA', 'SES', 'SNAIVE')
+# Replenishment lead time and service level (z-score) the suggestions are sized for
+FORECAST_LEAD_TIME_DAYS = 7
+FORECAST_SERVICE_Z = 1.65
+
+def epoch_day(day):
+    """Days since 1970-01-01 for a YYYY-MM-DD string, date or datetime"""
+    return int(np.datetime64(str(day)[:10], 'D').astype(np.int64))
+
+def get_demand_history(conn, first_day, last_day, scan=False):
+    """Daily demand per branch and item from first_day to last_day inclusive.
+
+    A few days are read off the movement time index; scan reads the table in
+    order instead, which is several times faster when most of it is wanted.
+    """
+    types = ", ".join(f"'{t}'" for t in DEMAND_TYPES)
+    return pd.read_sql_query(f'''SELECT branch_id, item_id, substr(date_time, 1, 10) as day, SUM(quantity) as quantity
+                                 FROM stock_movements {"NOT INDEXED" if scan else ""}
+                                 WHERE ts >= ? AND ts < ? AND movement_type IN ({types})
+                                 GROUP BY branch_id, item_id, day''', conn,
+                             params=(movement_epoch(str(first_day)), movement_epoch(str(last_day)) + 86400),
+                             dtype={'quantity': float})
+
+def step_demand_models(recent, level, mse, first_day, series_index, day_index, quantity, days):
+    """Advance every series through consecutive days from first_day, in place.
+
+    recent is a ring of the last FORECAST_WINDOW days per series, indexed by
+    epoch day; level is the exponential smoothing state and mse the running
+    squared error of each model. Each model is scored on a day before it
+    learns from it. Demand comes in sparse (series_index, day_index, quantity).
+    """
+    order = np.argsort(day_index, kind='stable')
+    series_index, day_index, quantity = series_index[order], day_index[order], quantity[order]
+    bounds = np.searchsorted(day_index, np.arange(days + 1))
+    total = recent.sum(axis=1)
+    y = np.zeros(len(level))
+    
+    for offset in range(days):
+        day = first_day + offset
+        y[:] = 0
+        y[series_index[bounds[offset]:bounds[offset + 1]]] = quantity[bounds[offset]:bounds[offset + 1]]
+        slot = day % FORECAST_WINDOW
+        predictions = np.column_stack([total / FORECAST_WINDOW, level, recent[:, (day - FORECAST_SEASON) % FORECAST_WINDOW]])
+        mse += FORECAST_ERROR_WEIGHT * ((predictions - y[:, None]) ** 2 - mse)
+        total += y - recent[:, slot]
+        recent[:, slot] = y
+        level += FORECAST_ALPHA * (y - level)
+
+def suggest_stock_levels(recent, level, mse, last_day, lead_time_days=FORECAST_LEAD_TIME_DAYS, z=FORECAST_SERVICE_Z):
+    """Best model per series and the daily demand, spread, min stock and reorder point it implies.
+
+    The min stock suggested is the safety stock for the lead time; the
+    reorder point adds the demand forecast over the lead time to it.
+    """
+    lead_time_days = max(int(lead_time_days), 1)
+    best = mse.argmin(axis=1)
+    ahead = np.arange(1, lead_time_days + 1)
+    # Seasonal naive repeats the latest week: day last_day + k reuses the same weekday before last_day
+    seasonal = recent[:, (last_day + ahead - FORECAST_SEASON * -(-ahead // FORECAST_SEASON)) % FORECAST_WINDOW].sum(axis=1)
+    lead_demand = np.choose(best, [recent.mean(axis=1) * lead_time_days, level * lead_time_days, seasonal])
+    demand_std = np.sqrt(mse[np.arange(len(best)), best])
+    safety_stock = z * demand_std * np.sqrt(lead_time_days)
+    return (np.asarray(FORECAST_MODELS)[best], lead_demand / lead_time_days, demand_std, safety_stock,
+            lead_demand + safety_stock)
+
+def write_demand_forecast(c, rows, fitted_through, previous):
+    """Store refit forecast rows on the writer's cursor unless another fit got there first"""
+    current = c.execute("SELECT fitted_through FROM demand_forecast_state WHERE id = 1").fetchone()
+    current = current[0] if current else None
+    if current != previous:
+        raise ValueError(f"Forecast was refit through {current} in the meantime")
+    c.execute("INSERT OR REPLACE INTO demand_forecast_state (id, fitted_through) VALUES (1, ?)", (fitted_through,))
+    c.executemany('''INSERT OR REPLACE INTO demand_forecast (branch_id, item_id, fitted_through, recent, level, mse_ma, mse_ses,
+                                                            mse_snaive, model, daily_demand, demand_std, suggested_min_stock,
+                                                            reorder_point, updated_at)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+    c.execute('''DELETE FROM demand_forecast WHERE NOT EXISTS (
+                     SELECT 1 FROM branch_stock s WHERE s.branch_id = demand_forecast.branch_id AND s.item_id = demand_forecast.item_id)''')
+    return len(rows)
+
+def fit_demand_forecast(through=None, lead_time_days=FORECAST_LEAD_TIME_DAYS, z=FORECAST_SERVICE_Z):
+    """Step every demand series forward to the end of day `through` (default yesterday), returns stats.
+
+    The first fit reads FORECAST_HISTORY_DAYS of history. Later fits keep the
+    model state in demand_forecast and the day it was fitted through in
+    demand_forecast_state, which advances even when no series had demand.
+    They only read the complete days since then, so a nightly refit costs
+    one day of movements however long the history. Series seen for the first time start from zero demand, and
+    movements back-dated into days already fitted are not revisited.
+    """
+    last_day = epoch_day(through or datetime.now() - timedelta(days=1))
+    conn = get_connection()
+    try:
+        state = pd.read_sql_query("SELECT branch_id, item_id, fitted_through, recent, level, mse_ma, mse_ses, mse_snaive "
+                                  "FROM demand_forecast", conn)
+        previous = conn.execute("SELECT fitted_through FROM demand_forecast_state WHERE id = 1").fetchone()
+        previous = previous[0] if previous else None
+        first_day = epoch_day(previous) + 1 if previous else last_day - FORECAST_HISTORY_DAYS + 1
+        if first_day > last_day:
+            return {'series': len(state), 'days': 0, 'movements': 0, 'fitted_through': previous}
+        history = get_demand_history(conn, np.datetime64(first_day, 'D'), np.datetime64(last_day, 'D'),
+                                     scan=last_day - first_day >= FORECAST_WINDOW)
+    finally:
+        conn.close()
+    
+    keys = pd.concat([state[['branch_id', 'item_id']], history[['branch_id', 'item_id']]]).drop_duplicates(ignore_index=True)
+    recent = np.zeros((len(keys), FORECAST_WINDOW))
+    level = np.zeros(len(keys))
+    mse = np.zeros((len(keys), len(FORECAST_MODELS)))
+    if not state.empty:
+        recent[:len(state)] = np.frombuffer(b"".join(state['recent']), dtype='<f8').reshape(len(state), FORECAST_WINDOW)
+        level[:len(state)] = state['level'].to_numpy()
+        mse[:len(state)] = state[['mse_ma', 'mse_ses', 'mse_snaive']].to_numpy()
+    
+    series_index = history[['branch_id', 'item_id']].merge(keys.reset_index(), on=['branch_id', 'item_id'])['index'].to_numpy()
+    day_index = history['day'].to_numpy(dtype='datetime64[D]').astype(np.int64) - first_day
+    step_demand_models(recent, level, mse, first_day, series_index, day_index, history['quantity'].to_numpy(),
+                       last_day - first_day + 1)
+    models, daily_demand, demand_std, min_stock, reorder_point = suggest_stock_levels(recent, level, mse, last_day,
+                                                                                       lead_time_days, z)
+    
+    fitted_through = str(np.datetime64(last_day, 'D'))
+    updated_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    rows = list(zip(keys['branch_id'].tolist(), keys['item_id'].tolist(), [fitted_through] * len(keys),
+                    [row.tobytes() for row in recent.astype('<f8')], level.tolist(), *mse.T.tolist(), models.tolist(),
+                    daily_demand.round(4).tolist(), demand_std.round(4).tolist(), min_stock.round(2).tolist(),
+                    reorder_point.round(2).tolist(), [updated_at] * len(keys)))
+    get_stock_writer().execute(write_demand_forecast, rows, fitted_through, previous,
+                               tables=("demand_forecast", "demand_forecast_state"))
+    return {'series': len(keys), 'days': last_day - first_day + 1, 'movements': len(history), 'fitted_through': fitted_through}
+
+def get_demand_forecast(branch_id=None):
+    """Forecast and suggested levels beside the current min stock, biggest demand first"""
+    query = '''SELECT f.branch_id, b.branch_name, f.item_id, c.name, c.category, c.unit, s.current_stock, s.min_stock,
+                      f.model, f.daily_demand, f.demand_std, f.suggested_min_stock, f.reorder_point, f.fitted_through
+               FROM demand_forecast f
+               JOIN branch_stock s ON s.branch_id = f.branch_id AND s.item_id = f.item_id
+               JOIN item_catalog c ON c.id = f.item_id
+               JOIN branches b ON b.id = f.branch_id'''
+    params = []
+    if branch_id is not None:
+        query += " WHERE f.branch_id = ?"
+        params.append(int(branch_id))
+    return get_read_hub().query(query + " ORDER BY f.daily_demand DESC", tuple(params))
+
+def write_apply_suggested_min_stock(c, branch_id, item_ids):
+    """Copy suggested min stock onto branch_stock on the writer's cursor, returns how many changed"""
+    query = '''UPDATE branch_stock SET min_stock = f.suggested_min_stock
+               FROM demand_forecast f
+               WHERE f.branch_id = branch_stock.branch_id AND f.item_id = branch_stock.item_id
+                 AND f.suggested_min_stock IS NOT NULL AND branch_stock.min_stock IS NOT f.suggested_min_stock'''
+    params = []
+    if branch_id is not None:
+        query += " AND branch_stock.branch_id = ?"
+        params.append(int(branch_id))
+    if item_ids is not None:
+        query += " AND branch_stock.item_id IN (SELECT value FROM json_each(?))"
+        params.append(json.dumps([str(item_id) for item_id in item_ids]))
+    return c.execute(query, params).rowcount
+
+@instrumented('mutator')
+def apply_suggested_min_stock(branch_id=None, item_ids=None, user_id="system"):
+    """Replace hand-typed min stock with the forecast's suggestion, returns how many items changed"""
+    return get_stock_writer().execute(write_apply_suggested_min_stock, branch_id, item_ids, tables=("items",),
+                                      user_id=user_id)
+
+# ===============================
+# BRANCH SUMMARY
+# ===============================
+
+BRANCH_SUMMARY_COUNTS = ['items', 'out_of_stock', 'low_stock']
+BRANCH_SUMMARY_TOTALS = ['total_stock', 'stock_value']
+
+def get_branch_summary(branch_id=None, categories=None):
+    """Headline counters per branch and category, read from the trigger-maintained summary"""
+    query = "SELECT * FROM branch_summary WHERE items > 0"
+    params = []
+    if branch_id is not None:
+        query += " AND branch_id = ?"
+        params.append(int(branch_id))
+    if categories:
+        query += f" AND category IN ({', '.join('?' * len(categories))})"
+        params += list(categories)
+    return get_read_hub().query(query + " ORDER BY branch_id, category", tuple(params))
+
+def write_rebuild_branch_summary(c):
+    """Replace every summary counter with a full recount on the writer's cursor"""
+    c.execute("DELETE FROM branch_summary")
+    c.execute(f"INSERT INTO branch_summary (branch_id, category, items, out_of_stock, low_stock, total_stock, stock_value) "
+              f"{BRANCH_SUMMARY_RECOUNT}")
+
+def check_branch_summary(repair=False):
+    """Compare the summary counters with a full recount, returns the rows that disagree.
+
+    Both sides are read in one transaction so concurrent writes cannot show up
+    as drift. With repair set, drifted counters are rebuilt through the writer.
+    """
+    conn = get_connection()
+    conn.execute("BEGIN")
+    stored = pd.read_sql_query("SELECT * FROM branch_summary WHERE items != 0 OR total_stock != 0 OR stock_value != 0", conn)
+    recount = pd.read_sql_query(BRANCH_SUMMARY_RECOUNT, conn)
+    conn.execute("COMMIT")
+    conn.close()
+    
+    merged = stored.merge(recount, on=['branch_id', 'category'], how='outer', suffixes=('', '_recount')).fillna(0)
+    drifted = pd.Series(False, index=merged.index)
+    for column in BRANCH_SUMMARY_COUNTS:
+        drifted |= merged[column] != merged[f"{column}_recount"]
+    for column in BRANCH_SUMMARY_TOTALS:
+        # Running float sums pick up rounding noise
+        drifted |= ~np.isclose(merged[column], merged[f"{column}_recount"], rtol=1e-9, atol=1e-6)
+    mismatches = merged[drifted].reset_index(drop=True)
+    
+    if repair and not mismatches.empty:
+        get_stock_writer().execute(write_rebuild_branch_summary, tables=("branch_summary",))
+    return mismatches
+
+# ===============================
+# STOCK ANALYTICS
+# ===============================
+
+TREND_FREQUENCIES = {"Daily": "D", "Weekly": "W", "Monthly": "MS"}
+
+def get_stock_timeseries(item_id, branch_id=None, days=365, freq="D"):
+    """End-of-period stock level and in/out volumes for an item, from the daily rollup.
+
+    Levels are anchored at today's stock and walked backwards with a reverse
+    running sum of later net changes, so only days with movements are read.
+    branch_id None sums every branch.
+    """
+    start = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
+    where = "item_id = ?"
+    params = [item_id]
+    if branch_id is not None:
+        where += " AND branch_id = ?"
+        params.append(int(branch_id))
+    
+    hub = get_read_hub()
+    current = hub.query("SELECT COALESCE(SUM(current_stock), 0) as stock FROM branch_stock WHERE item_id = ?" +
+                        (" AND branch_id = ?" if branch_id is not None else ""), tuple(params))['stock'].iloc[0]
+    daily = hub.query(f'''WITH daily AS (
+                              SELECT day, SUM(qty_in) as qty_in, SUM(qty_out) as qty_out, SUM(net_change) as net_change
+                              FROM stock_daily
+                              WHERE {where} AND day >= ?
+                              GROUP BY day
+                          )
+                          SELECT day, qty_in, qty_out, net_change,
+                                 SUM(net_change) OVER (ORDER BY day DESC ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) as later_change
+                          FROM daily
+                          ORDER BY day''', tuple(params + [start]))
+    
+    calendar = pd.date_range(start, datetime.now().strftime("%Y-%m-%d"), freq="D")
+    if daily.empty:
+        series = pd.DataFrame({'stock': float(current), 'qty_in': 0.0, 'qty_out': 0.0}, index=calendar)
+    else:
+        daily['stock'] = current - daily['later_change'].fillna(0)
+        daily.index = pd.to_datetime(daily['day'])
+        opening = current - daily['net_change'].sum()
+        series = daily[['stock', 'qty_in', 'qty_out']].reindex(calendar)
+        series['stock'] = series['stock'].ffill().fillna(opening)
+        series[['qty_in', 'qty_out']] = series[['qty_in', 'qty_out']].fillna(0)
+    
+    if freq != "D":
+        series = series.resample(freq).agg({'stock': 'last', 'qty_in': 'sum', 'qty_out': 'sum'})
+    series.index.name = 'date'
+    return series
+
+def get_movement_trends(branch_id=None, days=365, freq="W"):
+    """Movement counts per period, from the daily rollup"""
+    start = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
+    query = "SELECT day, SUM(movements) as movements FROM stock_daily WHERE day >= ?"
+    params = [start]
+    if branch_id is not None:
+        query += " AND branch_id = ?"
+        params.append(int(branch_id))
+    daily = get_read_hub().query(query + " GROUP BY day ORDER BY day", tuple(params))
+    
+    if daily.empty:
+        return daily
+    daily.index = pd.to_datetime(daily['day'])
+    return daily[['movements']].resample(freq).sum()
+
+# Boss report groupings of the movement analytics
+MOVEMENT_ANALYTICS_GROUPS = {
+    "Movement Type": ['movement_type'],
+    "Category": ['category'],
+    "Branch": ['branch_id'],
+    "Month": ['month'],
+    "Month and Type": ['month', 'movement_type'],
+    "User": ['user_id'],
+    "Item": ['item_id']
+}
+
+def get_movement_analytics(group_by, days=365, branch_id=None, movement_types=None):
+    """Movement quantity, value and count per group over the last `days` days.
+
+    Answered from the columnar mirror when it exists (see analytics.py), so
+    only movements newer than the last refresh are read from the live tables;
+    SQLite answers everything otherwise.
+    """
+    import analytics
+    start = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d")
+    return analytics.aggregate_movements(DB_PATH, group_by, start, None, branch_id, movement_types)
+
+# ===============================
+# BACKGROUND JOBS
+# ===============================
+
+JOB_HISTORY_DAYS = 30
+
+def compute_boss_report_data(items_df, branches_df):
+    """Aggregate the category, branch and critical item summaries for management reports"""
+    category_summary = items_df.groupby('category').agg({
+        'current_stock': 'sum',
+        'name': 'count'
+    }).rename(columns={'name': 'items', 'current_stock': 'total_stock'}).reset_index()
+    
+    branch_stats = items_df.assign(
+        is_final=items_df['category'] == 'Final Product',
+        is_critical=items_df['current_stock'] <= 0
+    ).groupby('branch_id').agg(
+        total_items=('id', 'count'),
+        final_products=('is_final', 'sum'),
+        total_stock=('current_stock', 'sum'),
+        critical=('is_critical', 'sum')
+    ).reset_index()
+    branch_summary = branches_df[['id', 'branch_name', 'location']].merge(
+        branch_stats, left_on='id', right_on='branch_id')
+    branch_summary = pd.DataFrame({
+        'Branch': branch_summary['branch_name'],
+        'Location': branch_summary['location'],
+        'Total Items': branch_summary['total_items'],
+        'Final Products': branch_summary['final_products'].astype(int),
+        'Total Stock': branch_summary['total_stock'].astype(int),
+        'Critical': branch_summary['critical'].astype(int)
+    })
+    
+    critical_items = items_df[items_df['current_stock'] <= 0][['branch_name', 'name', 'category', 'current_stock', 'min_stock']]
+    
+    return {
+        'category_summary': category_summary,
+        'branch_summary': branch_summary,
+        'critical_items': critical_items.reset_index(drop=True)
+    }
+
+def compute_bom_capacity():
+    """Max producible quantity and limiting ingredient for every BOM product in every branch"""
+    conn = get_connection()
+    bom_df = pd.read_sql_query('''SELECT b.branch_id, b.final_product_id, b.ingredient_id, b.quantity_required,
+                                         i.name as ingredient_name, i.current_stock
+                                  FROM bom b
+                                  JOIN items i ON b.ingredient_id = i.id AND b.branch_id = i.branch_id''', conn)
+    conn.close()
+    
+    if bom_df.empty:
+        return pd.DataFrame(columns=['branch_id', 'final_product_id', 'max_production', 'limiting_ingredient'])
+    
+    bom_df['possible'] = (bom_df['current_stock'] / bom_df['quantity_required']).astype(int)
+    limiting = bom_df.loc[bom_df.groupby(['branch_id', 'final_product_id'])['possible'].idxmin()]
+    return pd.DataFrame({
+        'branch_id': limiting['branch_id'].values,
+        'final_product_id': limiting['final_product_id'].values,
+        'max_production': limiting['possible'].values,
+        'limiting_ingredient': limiting['ingredient_name'].values
+    })
+
+def save_precomputed_report(report_key, frames, duration_seconds=None):
+    """Store precomputed report frames in the report cache"""
+    payload = json.dumps({name: df.to_json(orient='split', index=False) for name, df in frames.items()})
+    conn = get_connection(timeout=30)
+    conn.execute("INSERT OR REPLACE INTO report_cache (report_key, payload, computed_at, duration_seconds) VALUES (?, ?, ?, ?)",
+                 (report_key, payload, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), duration_seconds))
+    conn.commit()
+    conn.close()
+
+def get_precomputed_report(report_key):
+    """Load precomputed report frames, returns (frames, computed_at) or (None, None)"""
+    conn = get_connection()
+    row = conn.execute("SELECT payload, computed_at FROM report_cache WHERE report_key = ?", (report_key,)).fetchone()
+    conn.close()
+    
+    if not row:
+        return None, None
+    
+    frames = {name: pd.read_json(io.StringIO(data), orient='split') for name, data in json.loads(row[0]).items()}
+    return frames, row[1]
+
+def job_seal_audit():
+    """Job: chain new audit rows"""
+    return f"Sealed {seal_audit_log()} audit rows"
+
+def job_verify_audit():
+    """Job: seal, then verify the audit chains from their checkpoints"""
+    seal_audit_log()
+    results = verify_audit_log()
+    broken = [r for r in results if not r['ok']]
+    if broken:
+        raise RuntimeError("Audit chain broken: " + ", ".join(f"branch {r['branch_id']} at #{r['broken_at']}" for r in broken))
+    return f"Verified {sum(r['rows_checked'] for r in results)} new audit rows in {len(results)} branches"
+
+def job_check_branch_summary():
+    """Job: verify the branch summary counters against a recount and repair any drift"""
+    mismatches = check_branch_summary(repair=True)
+    if not mismatches.empty:
+        return f"Rebuilt branch summary, {len(mismatches)} counter rows had drifted"
+    return "Branch summary matches a full recount"
+
+def job_check_reservations():
+    """Job: verify reserved_stock against the open reservations and repair any drift"""
+    drifted = check_reservations(repair=True)
+    if not drifted.empty:
+        return f"Repaired reserved stock of {len(drifted)} items"
+    return "Reserved stock matches the open reservations"
+
+def job_check_in_transit():
+    """Job: verify the in-transit ledger against the open shipments and repair any drift"""
+    drifted = check_in_transit(repair=True)
+    if not drifted.empty:
+        return f"Repaired {len(drifted)} in-transit rows"
+    return "In-transit ledger matches the open shipments"
+
+def job_fit_demand_forecast():
+    """Job: step the demand forecasts forward through the days since the last fit"""
+    stats = fit_demand_forecast()
+    if not stats['days']:
+        return f"Forecasts already fitted through {stats['fitted_through']}"
+    return (f"Refit {stats['series']} series over {stats['days']} days from {stats['movements']} daily totals, "
+            f"through {stats['fitted_through']}")
+
+def job_refresh_analytics():
+    """Job: append new movements to the columnar analytics mirror"""
+    import analytics
+    if not analytics.mirror_available():
+        return "pyarrow is not installed, reports aggregate on SQLite"
+    stats = analytics.refresh_mirror(DB_PATH)
+    return (f"{'Rebuilt' if stats['rebuilt'] else 'Appended'} {stats['appended']} movements, "
+            f"{stats['rows']} mirrored in {stats['parts']} parts")
+
+def job_snapshot_stock():
+    """Job: record today's stock level for every item"""
+    conn = get_connection(timeout=30)
+    c = conn.cursor()
+    now = datetime.now()
+    c.execute('''INSERT OR REPLACE INTO stock_snapshots (snapshot_date, item_id, branch_id, current_stock, min_stock, taken_at)
+                 SELECT ?, item_id, branch_id, current_stock, min_stock, ? FROM branch_stock''',
+              (now.strftime("%Y-%m-%d"), now.strftime("%Y-%m-%d %H:%M:%S")))
+    count = c.rowcount
+    conn.commit()
+    conn.close()
+    return f"Snapshot of {count} items"
+
+def job_vacuum_analyze():
+    """Job: prune old job history, refresh planner statistics and compact the database"""
+    conn = get_connection(timeout=30, isolation_level=None)
+    cutoff = datetime.fromtimestamp(time.time() - JOB_HISTORY_DAYS * 86400).strftime("%Y-%m-%d %H:%M:%S")
+    pruned = conn.execute("DELETE FROM job_runs WHERE queued_at < ?", (cutoff,)).rowcount
+    pruned += conn.execute("DELETE FROM perf_metrics WHERE recorded_at < ?",
+                           (int(time.time()) - JOB_HISTORY_DAYS * 86400,)).rowcount
+    
+    # Old events only once every consumer is past them (or by age alone when nobody consumes)
+    event_cutoff = datetime.fromtimestamp(time.time() - EVENT_RETENTION_DAYS * 86400).strftime("%Y-%m-%d %H:%M:%S")
+    pruned += conn.execute('''DELETE FROM stock_events WHERE created_at < ?
+                              AND seq <= (SELECT COALESCE(MIN(last_seq), seq) FROM event_consumers)''',
+                           (event_cutoff,)).rowcount
+    conn.execute("ANALYZE")
+    conn.execute("VACUUM")
+    conn.close()
+    return f"Pruned {pruned} old job runs, metrics and events, analyzed and vacuumed"
+
+def job_precompute_reports():
+    """Job: precompute management reports and BOM production capacity"""
+    started = time.perf_counter()
+    report = compute_boss_report_data(get_items_by_role("boss"), get_all_branches())
+    save_precomputed_report('boss_reports', report, time.perf_counter() - started)
+    
+    started = time.perf_counter()
+    capacity = compute_bom_capacity()
+    save_precomputed_report('bom_capacity', {'capacity': capacity}, time.perf_counter() - started)
+    return f"Reports for {len(report['branch_summary'])} branches, capacity for {len(capacity)} products"
+
+def job_flush_metrics():
+    """Job: persist buffered performance samples to perf_metrics"""
+    samples = get_metrics().drain()
+    if samples:
+        # Plain connection so the flush does not time itself
+        conn = sqlite3.connect(DB_PATH, timeout=30)
+        conn.executemany("INSERT INTO perf_metrics (recorded_at, kind, name, duration_ms, is_error) VALUES (?, ?, ?, ?, ?)",
+                         samples)
+        conn.commit()
+        conn.close()
+    return f"Persisted {len(samples)} samples"
+
+# name: (function, default interval in seconds, description)
+BACKGROUND_JOBS = {
+    'snapshot_stock': (job_snapshot_stock, 86400, "Daily stock level snapshot"),
+    'vacuum_analyze': (job_vacuum_analyze, 7 * 86400, "Prune job history, ANALYZE and VACUUM"),
+    'precompute_reports': (job_precompute_reports, 900, "Precompute management reports and BOM capacity"),
+    'flush_metrics': (job_flush_metrics, 60, "Persist performance samples"),
+    'seal_audit': (job_seal_audit, 60, "Hash-chain new audit log rows"),
+    'verify_audit': (job_verify_audit, 86400, "Verify audit log hash chains"),
+    'check_branch_summary': (job_check_branch_summary, 86400, "Check branch summary counters against a recount"),
+    'check_reservations': (job_check_reservations, 86400, "Check reserved stock against open reservations"),
+    'check_in_transit': (job_check_in_transit, 86400, "Check the in-transit ledger against open shipments"),
+    'fit_demand_forecast': (job_fit_demand_forecast, 86400, "Refit demand forecasts and suggested stock levels"),
+    'refresh_analytics': (job_refresh_analytics, 300, "Append new movements to the columnar reporting mirror")
+}
+
+# Jobs queued again whenever the hub reports a change to these tables
+JOB_TRIGGERS = {
+    'precompute_reports': {'items', 'branches', 'bom', 'external'}
+}
+
+class JobScheduler:
+    """In-process background job runner with a persistent schedule.
+
+    A scheduler thread polls scheduled_jobs for due jobs and hands them to a
+    small thread pool, so heavy maintenance never runs inside a user's rerun.
+    Every run is recorded in job_runs with its duration and result. A job is
+    never queued twice; a request that arrives while it is running queues
+    one more run after it finishes.
+    """
 
-def delete_bom_item(final_product_id, ingredient_id, branch_id):
-    """Remove item from Bill of Materials"""
-    conn = sqlite3.connect('inventory.db')
-    c = conn.cursor()
-    c.execute('DELETE FROM bom WHERE final_product_id = ? AND ingredient_id = ? AND branch_id = ?', 
-              (final_product_id, ingredient_id, branch_id))
-    conn.commit()
-    conn.close()
+    POLL_SECONDS = 5
 
-def produce_item(final_product_id, branch_id, quantity_to_produce, user_id):
-    """Produce final product and automatically deduct ingredients based on BOM"""
-    bom_df = get_bom(final_product_id, branch_id)
-    
-    if bom_df.empty:
-        return False, "No Bill of Materials found for this product"
-    
-    # Check if enough ingredients available
-    insufficient_ingredients = []
-    for _, row in bom_df.iterrows():
-        required_qty = row['quantity_required'] * quantity_to_produce
-        if row['current_stock'] < required_qty:
-            insufficient_ingredients.append(f"{row['ingredient_name']}: Need {required_qty}, Have {row['current_stock']}")
-    
-    if insufficient_ingredients:
-        return False, f"Insufficient ingredients: {'; '.join(insufficient_ingredients)}"
-    
-    try:
-        # Deduct ingredients
-        for _, row in bom_df.iterrows():
-            required_qty = row['quantity_required'] * quantity_to_produce
-            update_stock(row['ingredient_id'], branch_id, required_qty, 'OUT', 
-                        f'Production of {quantity_to_produce} x {final_product_id}', '', '', '', user_id)
-        
-        # Add final product to stock
-        update_stock(final_product_id, branch_id, quantity_to_produce, 'PRODUCTION', 
-                    f'Produced {quantity_to_produce} units', '', '', '', user_id)
+    def __init__(self, db_path, max_workers=2):
+        self.db_path = db_path
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="inventory-job")
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._active = set()
+        self._rerun = set()
+        self._thread = None
+
+    def _connect(self):
+        return get_connection(self.db_path, timeout=30)
+
+    def start(self):
+        """Register jobs, close out runs left over from a previous process and start polling"""
+        now = datetime.now()
+        conn = self._connect()
+        c = conn.cursor()
+        for name, (_, interval, description) in BACKGROUND_JOBS.items():
+            c.execute("INSERT OR IGNORE INTO scheduled_jobs (name, description, interval_seconds, enabled, next_run) VALUES (?, ?, ?, 1, ?)",
+                      (name, description, interval, datetime.fromtimestamp(now.timestamp() + interval).strftime("%Y-%m-%d %H:%M:%S")))
+        # Jobs that no longer exist would never run; their history stays in job_runs
+        c.execute(f"DELETE FROM scheduled_jobs WHERE name NOT IN ({', '.join('?' * len(BACKGROUND_JOBS))})",
+                  tuple(BACKGROUND_JOBS))
+        c.execute("UPDATE job_runs SET status = 'abandoned' WHERE status IN ('queued', 'running')")
+        conn.commit()
+        conn.close()
         
-        return True, f"Successfully produced {quantity_to_produce} units"
-    
-    except Exception as e:
-        return False, f"Error during production: {str(e)}"
+        get_data_hub().subscribe(self._on_data_change)
+        self._thread = threading.Thread(target=self._loop, name="inventory-scheduler", daemon=True)
+        self._thread.start()
 
-def clean_duplicate_movements():
-    """Clean up duplicate movement records"""
-    conn = sqlite3.connect('inventory.db')
-    c = conn.cursor()
-    
-    try:
-        # Remove duplicate movements (keep only the first occurrence)
-        c.execute('''
-            DELETE FROM stock_movements 
-            WHERE id NOT IN (
-                SELECT MIN(id) 
-                FROM stock_movements 
-                GROUP BY item_id, branch_id, movement_type, quantity, date_time, user_id, from_branch_id, to_branch_id
-            )
-        ''')
+    def stop(self):
+        """Stop polling and wait for running jobs"""
+        self._stop.set()
+        self._executor.shutdown(wait=True)
+
+    def _on_data_change(self, change):
+        for name, tables in JOB_TRIGGERS.items():
+            if tables.intersection(change['tables']):
+                self.submit(name, "change")
+
+    def _loop(self):
+        while not self._stop.wait(self.POLL_SECONDS):
+            try:
+                conn = self._connect()
+                due = conn.execute("SELECT name FROM scheduled_jobs WHERE enabled = 1 AND next_run <= ?",
+                                   (datetime.now().strftime("%Y-%m-%d %H:%M:%S"),)).fetchall()
+                conn.close()
+                for (name,) in due:
+                    self.submit(name, "schedule")
+            except sqlite3.Error:
+                pass
+
+    def submit(self, name, trigger="manual", user_id=None):
+        """Queue a job run, returns the run id or None if it is already queued"""
+        if name not in BACKGROUND_JOBS:
+            raise ValueError(f"Unknown job: {name}")
+        
+        with self._lock:
+            if name in self._active:
+                self._rerun.add(name)
+                return None
+            self._active.add(name)
         
-        deleted = c.rowcount
+        conn = self._connect()
+        c = conn.cursor()
+        c.execute("INSERT INTO job_runs (job_name, trigger, status, queued_at, user_id) VALUES (?, ?, 'queued', ?, ?)",
+                  (name, trigger, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), user_id))
+        run_id = c.lastrowid
         conn.commit()
         conn.close()
-        return deleted
-    except Exception as e:
-        conn.rollback()
-        conn.close()
-        return 0
+        
+        self._executor.submit(self._run, name, run_id)
+        return run_id
 
-def add_item(item_id, name, category, unit, current_stock, min_stock, branch_id, user_id):
-    """Add new item to branch"""
-    conn = sqlite3.connect('inventory.db')
-    c = conn.cursor()
-    c.execute('''INSERT INTO items (id, branch_id, name, category, unit, current_stock, min_stock, cost_per_unit, location, warehouse_area, created_date, created_by)
-                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-              (item_id, branch_id, name, category, unit, current_stock, min_stock, 0, "Main", "General",
-               datetime.now().strftime("%Y-%m-%d %H:%M:%S"), user_id))
+    def _run(self, name, run_id):
+        func = BACKGROUND_JOBS[name][0]
+        started_at = datetime.now()
+        started = time.perf_counter()
+        result, error, status = None, None, 'success'
+        
+        try:
+            conn = self._connect()
+            conn.execute("UPDATE job_runs SET status = 'running', started_at = ? WHERE id = ?",
+                         (started_at.strftime("%Y-%m-%d %H:%M:%S"), run_id))
+            conn.commit()
+            conn.close()
+            
+            with measure('job', name):
+                result = func()
+        except Exception as e:
+            status = 'failed'
+            error = str(e)
+        
+        duration = time.perf_counter() - started
+        finished_at = datetime.now()
+        
+        try:
+            conn = self._connect()
+            c = conn.cursor()
+            c.execute("UPDATE job_runs SET status = ?, finished_at = ?, duration_seconds = ?, result = ?, error = ? WHERE id = ?",
+                      (status, finished_at.strftime("%Y-%m-%d %H:%M:%S"), duration, result, error, run_id))
+            c.execute('''UPDATE scheduled_jobs SET last_run = ?, last_status = ?, last_duration = ?,
+                         next_run = datetime(?, '+' || interval_seconds || ' seconds')
+                         WHERE name = ?''',
+                      (started_at.strftime("%Y-%m-%d %H:%M:%S"), status, duration,
+                       finished_at.strftime("%Y-%m-%d %H:%M:%S"), name))
+            conn.commit()
+            conn.close()
+        finally:
+            with self._lock:
+                self._active.discard(name)
+                rerun = name in self._rerun
+                self._rerun.discard(name)
+            if rerun:
+                self.submit(name, "change")
+
+    def is_active(self, name):
+        """Whether a job is queued or running"""
+        with self._lock:
+            return name in self._active
+
+@st.cache_resource
+def get_job_scheduler():
+    """Get the process-wide background job scheduler"""
+    scheduler = JobScheduler(DB_PATH)
+    scheduler.start()
+    return scheduler
+
+def get_scheduled_jobs():
+    """Get the job schedule with last run details"""
+    conn = get_connection()
+    df = pd.read_sql_query("SELECT * FROM scheduled_jobs ORDER BY name", conn)
+    conn.close()
+    return df
+
+def get_job_runs(limit=50):
+    """Get the most recent job runs"""
+    conn = get_connection()
+    df = pd.read_sql_query("SELECT * FROM job_runs ORDER BY id DESC LIMIT ?", conn, params=[limit])
+    conn.close()
+    return df
+
+def update_job_schedule(name, interval_seconds, enabled):
+    """Change how often a job runs and whether it is enabled"""
+    conn = get_connection()
+    conn.execute('''UPDATE scheduled_jobs SET interval_seconds = ?, enabled = ?,
+                    next_run = datetime('now', 'localtime', '+' || ? || ' seconds')
+                    WHERE name = ?''',
+                 (int(interval_seconds), 1 if enabled else 0, int(interval_seconds), name))
     conn.commit()
     conn.close()
 
@@ -559,9 +3989,15 @@ def get_navigation_items(user_role):
             ("🔄", "Transfers", "manager_transfers"),
             ("🏭", "Production", "manager_production"),
             ("🧾", "BOM", "manager_bom"),
+            ("🗓️", "Planning", "manager_planning"),
             ("⚙️", "Items", "manager_items"),
             ("📈", "Movements", "manager_movements"),
-            ("👥", "Users", "manager_users")
+            ("🏷️", "Lots", "manager_lots"),
+            ("📋", "Counts", "manager_counts"),
+            ("📌", "Reservations", "manager_reservations"),
+            ("👥", "Users", "manager_users"),
+            ("⏱️", "Jobs", "manager_jobs"),
+            ("📉", "Performance", "manager_performance")
         ]
     return []
 
@@ -599,6 +4035,124 @@ def show_navigation(user_role):
     
     return st.session_state.current_page
 
+def show_search_pagination(scope, total):
+    """Previous/next controls for one result list, returns the current offset"""
+    pages = st.session_state.setdefault('search_pages', {})
+    page = min(pages.get(scope, 0), max(0, (total - 1) // SEARCH_PAGE_SIZE))
+    
+    col1, col2, col3 = st.columns([1, 2, 1])
+    
+    with col1:
+        if st.button("◀ Previous", key=f"search_prev_{scope}", disabled=page == 0, use_container_width=True):
+            pages[scope] = page - 1
+            st.rerun(scope="fragment")
+    
+    with col2:
+        last = min(total, (page + 1) * SEARCH_PAGE_SIZE)
+        st.caption(f"Showing {page * SEARCH_PAGE_SIZE + 1}-{last} of {total} matches")
+    
+    with col3:
+        if st.button("Next ▶", key=f"search_next_{scope}", disabled=last >= total, use_container_width=True):
+            pages[scope] = page + 1
+            st.rerun(scope="fragment")
+    
+    return page * SEARCH_PAGE_SIZE
+
+DATE_RANGES = {"All time": None, "Today": 0, "Last 7 days": 7, "Last 30 days": 30, "Last 90 days": 90, "Custom": None}
+
+def show_date_range_filter(key):
+    """Date range picker for movement pages, returns (start_ts, end_ts) or (None, None) for all time"""
+    col1, col2 = st.columns([1, 2])
+    
+    with col1:
+        choice = st.selectbox("📅 Period", options=list(DATE_RANGES), key=f"{key}_period")
+    
+    today = datetime.now().date()
+    if choice == "All time":
+        return None, None
+    if choice == "Custom":
+        with col2:
+            picked = st.date_input("Dates", value=(today - timedelta(days=7), today), key=f"{key}_dates")
+        if not isinstance(picked, (tuple, list)) or len(picked) < 2:
+            # Only the start picked so far
+            picked = (picked[0] if isinstance(picked, (tuple, list)) and picked else today, today)
+        start, end = picked[0], picked[1]
+    else:
+        start, end = today - timedelta(days=DATE_RANGES[choice]), today
+    
+    start_ts = movement_epoch(datetime.combine(start, datetime.min.time()))
+    return start_ts, movement_epoch(datetime.combine(end, datetime.min.time())) + 86400
+
+def movement_tracking_labels(movements_df):
+    """'Batch: x | Inv: y' per movement, '-' when neither is set"""
+    batch = movements_df['batch_nr'].fillna('').astype(str)
+    invoice = movements_df['invoice_nr'].fillna('').astype(str)
+    labels = (("Batch: " + batch).where(batch != '', '')
+              + pd.Series(np.where((batch != '') & (invoice != ''), " | ", ""), index=movements_df.index)
+              + ("Inv: " + invoice).where(invoice != '', ''))
+    return labels.replace('', '-')
+
+def stock_status_labels(items_df):
+    """OUT / LOW / OK label per item row"""
+    return np.select([items_df['current_stock'] <= 0, items_df['current_stock'] <= items_df['min_stock']],
+                     ["❌ OUT", "⚠️ LOW"], default="✅ OK")
+
+@st.fragment
+@instrumented('page')
+def show_global_search(user_role):
+    """Global search box with ranked, paginated results; typing and paging rerun only the search"""
+    search_text = st.text_input("🔎 Search", placeholder="🔎 Search items, IDs, batch, invoice or PO numbers, references...",
+                                key="global_search", label_visibility="collapsed")
+    
+    # New search text starts again from the first page
+    if st.session_state.get('last_search') != search_text:
+        st.session_state.last_search = search_text
+        st.session_state.search_pages = {}
+    
+    if not search_text.strip():
+        return
+    
+    with st.expander(f"🔎 Results for '{search_text}'", expanded=True):
+        scopes = ["📦 Items"] if user_role == "viewer" else ["📦 Items", "📈 Movements"]
+        tabs = st.tabs(scopes)
+        
+        with tabs[0]:
+            pages = st.session_state.get('search_pages', {})
+            items_df, total = search_items(search_text, user_role, offset=pages.get('items', 0) * SEARCH_PAGE_SIZE)
+            
+            if total:
+                offset = show_search_pagination('items', total)
+                if offset != pages.get('items', 0) * SEARCH_PAGE_SIZE:
+                    items_df, total = search_items(search_text, user_role, offset=offset)
+                
+                if user_role == "viewer":
+                    items_df['Status'] = np.where(items_df['current_stock'] > 0, "✅ Available", "❌ Out of Stock")
+                    display_df = items_df[['name', 'branch_name', 'Status']]
+                    display_df.columns = ['Product', 'Branch', 'Status']
+                else:
+                    display_df = items_df[['id', 'name', 'category', 'branch_name', 'current_stock', 'unit']]
+                    display_df.columns = ['ID', 'Name', 'Category', 'Branch', 'Stock', 'Unit']
+                st.dataframe(display_df, use_container_width=True)
+            else:
+                st.info("No matching items")
+        
+        if len(tabs) > 1:
+            with tabs[1]:
+                pages = st.session_state.get('search_pages', {})
+                movements_df, total = search_movements(search_text, offset=pages.get('movements', 0) * SEARCH_PAGE_SIZE)
+                
+                if total:
+                    offset = show_search_pagination('movements', total)
+                    if offset != pages.get('movements', 0) * SEARCH_PAGE_SIZE:
+                        movements_df, total = search_movements(search_text, offset=offset)
+                    
+                    display_df = movements_df[['date_time', 'branch_name', 'item_name', 'movement_type', 'quantity',
+                                               'batch_nr', 'invoice_nr', 'po_nr', 'reference']]
+                    display_df.columns = ['Date', 'Branch', 'Item', 'Type', 'Qty', 'Batch', 'Invoice', 'PO', 'Reference']
+                    st.dataframe(display_df, use_container_width=True)
+                else:
+                    st.info("No matching movements")
+
 # ===============================
 # VIEWER PAGES
 # ===============================
@@ -607,6 +4161,12 @@ def show_viewer_branches():
     """Viewer: Select branch to view final products"""
     st.header("🏪 Select Branch")
     
+    show_viewer_branch_products()
+
+@st.fragment
+@instrumented('page')
+def show_viewer_branch_products():
+    """Viewer: products and availability for the chosen branch"""
     branches_df = get_all_branches()
     
     if not branches_df.empty:
@@ -649,13 +4209,13 @@ def show_viewer_branches():
                 st.markdown("---")
                 col1, col2 = st.columns(2)
                 
+                summary = get_branch_summary(selected_branch_id, ["Final Product"])
+                
                 with col1:
-                    available = len(items_df[items_df['current_stock'] > 0])
-                    st.metric("✅ Available", available)
+                    st.metric("✅ Available", int((summary['items'] - summary['out_of_stock']).sum()))
                 
                 with col2:
-                    out_of_stock = len(items_df[items_df['current_stock'] <= 0])
-                    st.metric("❌ Out of Stock", out_of_stock)
+                    st.metric("❌ Out of Stock", int(summary['out_of_stock'].sum()))
             else:
                 st.info(f"No final products found in {branch_info['branch_name']}")
     else:
@@ -697,36 +4257,34 @@ def show_admin_dashboard():
     st.header("🔧 Stock Admin Dashboard")
     
     branches_df = get_all_branches()
-    items_df = get_items_by_role("admin")
+    summary = get_branch_summary()
     
-    if not items_df.empty:
+    if not summary.empty:
         # Summary metrics
         col1, col2, col3, col4 = st.columns(4)
         
         with col1:
-            st.metric("Final Products", len(items_df))
+            st.metric("Final Products", int(summary['items'].sum()))
         
         with col2:
             st.metric("Branches", len(branches_df))
         
         with col3:
-            total_stock = items_df['current_stock'].sum()
-            st.metric("Total Units", int(total_stock))
+            st.metric("Total Units", int(summary['total_stock'].sum()))
         
         with col4:
-            out_of_stock = len(items_df[items_df['current_stock'] <= 0])
-            st.metric("Out of Stock", out_of_stock)
+            st.metric("Out of Stock", int(summary['out_of_stock'].sum()))
         
         # Branch overview
         st.subheader("📊 Stock by Branch")
         
+        product_counts = summary.groupby('branch_id')['items'].sum()
         for _, branch in branches_df.iterrows():
-            branch_items = items_df[items_df['branch_id'] == branch['id']]
-            
-            if not branch_items.empty:
-                with st.expander(f"🏪 {branch['branch_name']} ({len(branch_items)} products)"):
-                    display_df = branch_items[['name', 'current_stock', 'min_stock', 'unit']].copy()
-                    display_df.columns = ['Product', 'Current', 'Min', 'Unit']
+            if product_counts.get(branch['id'], 0) > 0:
+                with st.expander(f"🏪 {branch['branch_name']} ({int(product_counts[branch['id']])} products)"):
+                    branch_items = get_items_by_role("admin", branch['id'])
+                    display_df = branch_items[['name', 'current_stock', 'available_stock', 'min_stock', 'unit']].copy()
+                    display_df.columns = ['Product', 'Current', 'Available', 'Min', 'Unit']
                     st.dataframe(display_df, use_container_width=True)
     else:
         st.info("No final products found")
@@ -802,19 +4360,8 @@ def show_admin_update():
                     
                     if update_type == "SET":
                         # Set absolute value
-                        conn = sqlite3.connect('inventory.db')
-                        c = conn.cursor()
-                        old_stock = current_item['current_stock']
-                        c.execute("UPDATE items SET current_stock = ? WHERE id = ? AND branch_id = ?", 
-                                 (quantity, selected_item, selected_branch_id))
-                        
-                        c.execute('''INSERT INTO stock_movements (item_id, branch_id, movement_type, quantity, reference, batch_nr, invoice_nr, date_time, user_id)
-                                     VALUES (?, ?, 'ADMIN_SET', ?, ?, ?, ?, ?, ?)''',
-                                  (selected_item, selected_branch_id, quantity, f"SET from {old_stock} to {quantity} - {reference}", 
-                                   batch_nr, invoice_nr, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), st.session_state.username))
-                        
-                        conn.commit()
-                        conn.close()
+                        old_stock = set_stock_level(selected_item, selected_branch_id, quantity, reference, batch_nr,
+                                                    invoice_nr, st.session_state.username)
                         
                         st.success(f"✅ Set {current_item['name']} from {old_stock} to {quantity} {current_item['unit']}")
                         st.rerun()
@@ -871,10 +4418,16 @@ def show_admin_transfer():
             format_func=lambda x: f"{branches_df[branches_df['id']==x]['branch_name'].iloc[0]}"
         )
     
+    # Shipments are the normal path; the one-step move is kept for admin corrections
+    mode = st.radio("Mode", ["🚚 Shipment", "✏️ Correction"], horizontal=True, key="admin_transfer_mode",
+                    help="A shipment debits the source now and credits the destination when it is received. "
+                         "A correction moves stock in one step, for goods already on site or fixing a booking error.")
+    correction = mode == "✏️ Correction"
+    
     if from_branch_id and to_branch_id:
         # Get available items
         from_items = get_items_by_role("admin", from_branch_id)
-        available_items = from_items[from_items['current_stock'] > 0]
+        available_items = from_items[from_items['available_stock'] > 0]
         
         if not available_items.empty:
             # Transfer form
@@ -885,53 +4438,80 @@ def show_admin_transfer():
                     selected_item = st.selectbox(
                         "📦 Product",
                         options=available_items['id'].tolist(),
-                        format_func=lambda x: f"{available_items[available_items['id']==x]['name'].iloc[0]} ({available_items[available_items['id']==x]['current_stock'].iloc[0]})"
+                        format_func=lambda x: f"{available_items[available_items['id']==x]['name'].iloc[0]} ({available_items[available_items['id']==x]['available_stock'].iloc[0]})"
                     )
                     
                     if selected_item:
-                        max_qty = available_items[available_items['id'] == selected_item]['current_stock'].iloc[0]
+                        max_qty = available_items[available_items['id'] == selected_item]['available_stock'].iloc[0]
                         quantity = st.number_input("Quantity", min_value=0.0, max_value=max_qty, value=1.0)
                 
                 with col2:
-                    reference = st.text_input("Reference", placeholder="Transfer reason")
-                    batch_nr = st.text_input("Batch Number", placeholder="Optional")
-                    invoice_nr = st.text_input("Invoice Number", placeholder="Optional")
+                    if correction:
+                        reference = st.text_input("Correction Reason", placeholder="Required: what is being corrected")
+                        batch_nr = st.text_input("Batch Number", placeholder="Optional")
+                        invoice_nr = st.text_input("Invoice Number", placeholder="Optional")
+                    else:
+                        reference = st.text_input("Reference", placeholder="Transfer reason")
                 
-                submitted = st.form_submit_button("🔀 Transfer", type="primary")
+                submitted = st.form_submit_button("✏️ Book Correction" if correction else "🚚 Dispatch", type="primary")
                 
                 if submitted and selected_item and quantity > 0:
-                    success, message = transfer_stock_between_branches(
-                        selected_item, from_branch_id, to_branch_id, quantity, 
-                        f"ADMIN TRANSFER: {reference}", batch_nr, invoice_nr, "", st.session_state.username
-                    )
-                    
-                    if success:
-                        st.success(message)
-                        st.rerun()
+                    if correction and not reference.strip():
+                        st.error("❌ A correction needs a reason")
+                    elif correction:
+                        success, message = transfer_stock_between_branches(
+                            selected_item, from_branch_id, to_branch_id, quantity,
+                            f"CORRECTION: {reference}", batch_nr, invoice_nr, "", st.session_state.username
+                        )
+                        
+                        if success:
+                            st.success(message)
+                            st.rerun()
+                        else:
+                            st.error(message)
                     else:
-                        st.error(message)
+                        try:
+                            shipment_id = dispatch_shipment(from_branch_id, to_branch_id, [(selected_item, quantity)],
+                                                            f"ADMIN TRANSFER: {reference}", st.session_state.username)
+                            st.success(f"✅ Shipment #{shipment_id} is on its way; stock arrives when it is received")
+                        except ValueError as e:
+                            st.error(f"❌ {e}")
         else:
             st.warning("No final products with stock in source branch")
 
+def show_duplicate_movements():
+    """Identical movements in the same second, for review rather than deletion"""
+    duplicates = find_duplicate_movements()
+    if duplicates.empty:
+        st.info("No duplicate movements found")
+        return
+    st.warning(f"⚠️ {len(duplicates)} groups of identical movements. They are often real (repeated scans, batches); "
+               "reverse any that are mistakes with a correcting movement.")
+    st.dataframe(duplicates, use_container_width=True, hide_index=True)
+
 def show_admin_movements():
-    """Admin: View movements with proper filtering and cleanup"""
+    """Admin: View movements with proper filtering and duplicate review"""
     st.header("📈 Stock Movements")
     
-    # Cleanup option for admin
+    # Duplicate review for admin
     col1, col2 = st.columns([3, 1])
     
     with col1:
         st.subheader("📊 Final Product Movement Records")
     
     with col2:
-        if st.button("🧹 Clean Duplicates", type="secondary", help="Remove duplicate movement records"):
-            deleted = clean_duplicate_movements()
-            if deleted > 0:
-                st.success(f"✅ Cleaned {deleted} duplicate records!")
-                st.rerun()
-            else:
-                st.info("No duplicates found")
+        find_duplicates = st.button("🔍 Find Duplicates", type="secondary",
+                                    help="List movements recorded more than once in the same second")
     
+    if find_duplicates:
+        show_duplicate_movements()
+    
+    show_admin_movement_records()
+
+@st.fragment
+@instrumented('page')
+def show_admin_movement_records():
+    """Admin: filtered final product movements"""
     # Filters
     col1, col2 = st.columns(2)
     
@@ -948,20 +4528,23 @@ def show_admin_movements():
             options=["All", "My Actions", "Manager Actions"]
         )
     
-    # Get movements with proper filtering and deduplication
-    conn = sqlite3.connect('inventory.db')
+    start_ts, end_ts = show_date_range_filter("admin_movements")
     
+    # Get movements with proper filtering
     query = '''
-        SELECT DISTINCT sm.*, i.name as item_name, i.unit, b.branch_name
+        SELECT sm.*, i.name as item_name, i.unit, b.branch_name
         FROM stock_movements sm
-        JOIN items i ON sm.item_id = i.id 
+        JOIN items i ON sm.item_id = i.id AND sm.branch_id = i.branch_id
         JOIN branches b ON sm.branch_id = b.id
         WHERE i.category = 'Final Product'
-        AND EXISTS (SELECT 1 FROM items i2 WHERE i2.id = sm.item_id AND i2.branch_id = sm.branch_id)
     '''
     
     params = []
     
+    if start_ts is not None:
+        query += " AND sm.ts >= ? AND sm.ts < ?"
+        params += [start_ts, end_ts]
+    
     # Branch filtering
     if branch_filter != "All":
         branch_id = branches_df[branches_df['branch_name'] == branch_filter]['id'].iloc[0]
@@ -975,52 +4558,28 @@ def show_admin_movements():
     elif user_filter == "Manager Actions":
         query += " AND sm.user_id LIKE '%manager%'"
     
-    query += " ORDER BY sm.date_time DESC, sm.id DESC LIMIT 100"
+    query += " ORDER BY sm.ts DESC, sm.id DESC LIMIT 100"
     
-    movements_df = pd.read_sql_query(query, conn, params=params)
-    conn.close()
+    movements_df = get_read_hub().query(query, params)
     
     if not movements_df.empty:
         st.info(f"📊 Found {len(movements_df)} movements")
         
-        # Display movements
-        display_data = []
-        
-        for _, row in movements_df.iterrows():
-            tracking_info = []
-            if row.get('batch_nr'):
-                tracking_info.append(f"Batch: {row['batch_nr']}")
-            if row.get('invoice_nr'):
-                tracking_info.append(f"Inv: {row['invoice_nr']}")
-            
-            tracking = " | ".join(tracking_info) if tracking_info else "-"
-            
-            # Format movement type
-            movement_type = row['movement_type']
-            if movement_type == 'ADMIN_SET':
-                movement_type = 'SET Stock'
-            elif movement_type == 'ADMIN_IN':
-                movement_type = 'ADD Stock'
-            elif movement_type == 'ADMIN_OUT':
-                movement_type = 'SUBTRACT Stock'
-            elif movement_type == 'TRANSFER_OUT':
-                movement_type = 'Transfer Out'
-            elif movement_type == 'TRANSFER_IN':
-                movement_type = 'Transfer In'
-            
-            display_data.append({
-                'Date': row['date_time'][:16],
-                'Branch': row['branch_name'],
-                'Product': row['item_name'],
-                'Type': movement_type,
-                'Quantity': f"{row['quantity']} {row['unit']}",
-                'Tracking': tracking,
-                'Reference': row['reference'] or '-',
-                'User': row['user_id']
-            })
+        # Display movements, formatted column-wise
+        type_labels = {'ADMIN_SET': 'SET Stock', 'ADMIN_IN': 'ADD Stock', 'ADMIN_OUT': 'SUBTRACT Stock',
+                       'TRANSFER_OUT': 'Transfer Out', 'TRANSFER_IN': 'Transfer In'}
+        movements_display_df = pd.DataFrame({
+            'Date': pd.to_datetime(movements_df['ts'], unit='s').dt.strftime('%Y-%m-%d %H:%M'),
+            'Branch': movements_df['branch_name'],
+            'Product': movements_df['item_name'],
+            'Type': movements_df['movement_type'].replace(type_labels),
+            'Quantity': movements_df['quantity'].astype(str) + " " + movements_df['unit'],
+            'Tracking': movement_tracking_labels(movements_df),
+            'Reference': movements_df['reference'].fillna('').replace('', '-'),
+            'User': movements_df['user_id']
+        })
         
-        if display_data:
-            movements_display_df = pd.DataFrame(display_data)
+        if not movements_display_df.empty:
             st.dataframe(movements_display_df, use_container_width=True, height=400)
             
             # Summary
@@ -1050,7 +4609,8 @@ def show_boss_dashboard():
     st.header("📊 Management Overview")
     
     branches_df = get_all_branches()
-    items_df = get_items_by_role("boss")
+    summary = get_branch_summary()
+    finals = summary[summary['category'] == 'Final Product']
     
     # High-level metrics
     col1, col2, col3, col4 = st.columns(4)
@@ -1059,32 +4619,27 @@ def show_boss_dashboard():
         st.metric("Branches", len(branches_df))
     
     with col2:
-        st.metric("Total Items", len(items_df))
+        st.metric("Total Items", int(summary['items'].sum()))
     
     with col3:
-        final_products = len(items_df[items_df['category'] == 'Final Product'])
-        st.metric("Final Products", final_products)
+        st.metric("Final Products", int(finals['items'].sum()))
     
     with col4:
-        critical = len(items_df[items_df['current_stock'] <= 0])
-        st.metric("Critical Items", critical)
+        st.metric("Critical Items", int(summary['out_of_stock'].sum()))
     
     # Branch performance
     st.subheader("🏪 Branch Performance")
     
     branch_data = []
     for _, branch in branches_df.iterrows():
-        branch_items = items_df[items_df['branch_id'] == branch['id']]
-        if not branch_items.empty:
-            final_count = len(branch_items[branch_items['category'] == 'Final Product'])
-            critical_count = len(branch_items[branch_items['current_stock'] <= 0])
-            
+        branch_summary = summary[summary['branch_id'] == branch['id']]
+        if not branch_summary.empty:
             branch_data.append({
                 'Branch': branch['branch_name'],
                 'Location': branch['location'],
-                'Total Items': len(branch_items),
-                'Final Products': final_count,
-                'Critical': critical_count
+                'Total Items': int(branch_summary['items'].sum()),
+                'Final Products': int(finals.loc[finals['branch_id'] == branch['id'], 'items'].sum()),
+                'Critical': int(branch_summary['out_of_stock'].sum())
             })
     
     if branch_data:
@@ -1096,25 +4651,24 @@ def show_boss_branches():
     st.header("🏪 Branch Overview")
     
     branches_df = get_all_branches()
-    items_df = get_items_by_role("boss")
+    summary = get_branch_summary()
     
     for _, branch in branches_df.iterrows():
         with st.expander(f"🏪 {branch['branch_name']} - {branch['location']}", expanded=False):
-            branch_items = items_df[items_df['branch_id'] == branch['id']]
+            branch_summary = summary[summary['branch_id'] == branch['id']]
             
-            if not branch_items.empty:
+            if not branch_summary.empty:
                 col1, col2, col3 = st.columns(3)
                 
                 with col1:
-                    st.metric("Total Items", len(branch_items))
+                    st.metric("Total Items", int(branch_summary['items'].sum()))
                 
                 with col2:
-                    final_products = len(branch_items[branch_items['category'] == 'Final Product'])
-                    st.metric("Final Products", final_products)
+                    final_products = branch_summary.loc[branch_summary['category'] == 'Final Product', 'items'].sum()
+                    st.metric("Final Products", int(final_products))
                 
                 with col3:
-                    critical = len(branch_items[branch_items['current_stock'] <= 0])
-                    st.metric("Critical", critical)
+                    st.metric("Critical", int(branch_summary['out_of_stock'].sum()))
             else:
                 st.info("No items in this branch")
 
@@ -1122,6 +4676,12 @@ def show_boss_stock():
     """Boss: View stock across all branches"""
     st.header("📦 Stock Overview")
     
+    show_boss_stock_table()
+
+@st.fragment
+@instrumented('page')
+def show_boss_stock_table():
+    """Boss: stock table with branch and category filters"""
     branches_df = get_all_branches()
     
     # Branch filter
@@ -1148,18 +4708,11 @@ def show_boss_stock():
     
     if not items_df.empty:
         # Add status
-        def get_status(row):
-            if row['current_stock'] <= 0:
-                return "❌ OUT"
-            elif row['current_stock'] <= row['min_stock']:
-                return "⚠️ LOW"
-            else:
-                return "✅ OK"
-        
-        items_df['Status'] = items_df.apply(get_status, axis=1)
+        items_df = items_df.copy()
+        items_df['Status'] = stock_status_labels(items_df)
         
-        display_df = items_df[['branch_name', 'name', 'category', 'current_stock', 'min_stock', 'unit', 'Status']]
-        display_df.columns = ['Branch', 'Item', 'Category', 'Stock', 'Min', 'Unit', 'Status']
+        display_df = items_df[['branch_name', 'name', 'category', 'current_stock', 'reserved_stock', 'available_stock', 'min_stock', 'unit', 'Status']]
+        display_df.columns = ['Branch', 'Item', 'Category', 'On Hand', 'Reserved', 'Available', 'Min', 'Unit', 'Status']
         
         st.dataframe(display_df, use_container_width=True, height=400)
         
@@ -1185,6 +4738,12 @@ def show_boss_movements():
     """Boss: View all movements"""
     st.header("📈 Movement History")
     
+    show_boss_movement_records()
+
+@st.fragment
+@instrumented('page')
+def show_boss_movement_records():
+    """Boss: filtered movement history"""
     # Filters
     col1, col2, col3 = st.columns(3)
     
@@ -1207,9 +4766,9 @@ def show_boss_movements():
             options=["All", "Admin", "Manager"]
         )
     
-    # Get movements
-    conn = sqlite3.connect('inventory.db')
+    start_ts, end_ts = show_date_range_filter("boss_movements")
     
+    # Get movements
     query = '''
         SELECT sm.*, i.name as item_name, i.unit, i.category, b.branch_name
         FROM stock_movements sm
@@ -1234,15 +4793,18 @@ def show_boss_movements():
     elif user_filter == "Manager":
         query += " AND sm.user_id LIKE '%manager%'"
     
-    query += " ORDER BY sm.date_time DESC LIMIT 100"
+    if start_ts is not None:
+        query += " AND sm.ts >= ? AND sm.ts < ?"
+        params += [start_ts, end_ts]
     
-    movements_df = pd.read_sql_query(query, conn, params=params)
-    conn.close()
+    query += " ORDER BY sm.ts DESC, sm.id DESC LIMIT 100"
+    
+    movements_df = get_read_hub().query(query, params)
     
     if not movements_df.empty:
-        display_df = movements_df[['date_time', 'branch_name', 'category', 'item_name', 'movement_type', 'quantity', 'unit', 'user_id']]
+        display_df = movements_df[['ts', 'branch_name', 'category', 'item_name', 'movement_type', 'quantity', 'unit', 'user_id']].copy()
         display_df.columns = ['Date', 'Branch', 'Category', 'Item', 'Type', 'Qty', 'Unit', 'User']
-        display_df['Date'] = pd.to_datetime(display_df['Date']).dt.strftime('%m-%d %H:%M')
+        display_df['Date'] = pd.to_datetime(display_df['Date'], unit='s').dt.strftime('%m-%d %H:%M')
         
         st.dataframe(display_df, use_container_width=True, height=400)
         
@@ -1264,45 +4826,147 @@ def show_boss_reports():
     """Boss: Management reports"""
     st.header("📋 Management Reports")
     
-    items_df = get_items_by_role("boss")
-    branches_df = get_all_branches()
+    # Reports are precomputed by the background scheduler
+    report, computed_at = get_precomputed_report('boss_reports')
     
-    if not items_df.empty:
+    if report is None:
+        items_df = get_items_by_role("boss")
+        if items_df.empty:
+            return
+        report = compute_boss_report_data(items_df, get_all_branches())
+        save_precomputed_report('boss_reports', report)
+        computed_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    
+    col1, col2 = st.columns([3, 1])
+    
+    with col1:
+        refreshing = get_job_scheduler().is_active('precompute_reports')
+        st.caption(f"🕒 Computed at {computed_at}" + (" - refreshing in the background..." if refreshing else ""))
+    
+    with col2:
+        if st.button("🔄 Recompute", use_container_width=True):
+            get_job_scheduler().submit('precompute_reports', "manual", st.session_state.username)
+            st.rerun()
+    
+    category_summary = report['category_summary']
+    
+    if not category_summary.empty:
         # Category summary
         st.subheader("📊 Inventory by Category")
-        category_summary = items_df.groupby('category').agg({
-            'current_stock': 'sum',
-            'name': 'count'
-        }).rename(columns={'name': 'items', 'current_stock': 'total_stock'})
-        
-        st.dataframe(category_summary, use_container_width=True)
+        st.dataframe(category_summary.set_index('category'), use_container_width=True)
         
         # Branch summary
         st.subheader("🏪 Inventory by Branch")
-        branch_summary = []
+        branch_summary = report['branch_summary']
         
-        for _, branch in branches_df.iterrows():
-            branch_items = items_df[items_df['branch_id'] == branch['id']]
-            if not branch_items.empty:
-                total_stock = branch_items['current_stock'].sum()
-                final_products = len(branch_items[branch_items['category'] == 'Final Product'])
-                critical = len(branch_items[branch_items['current_stock'] <= 0])
-                
-                branch_summary.append({
-                    'Branch': branch['branch_name'],
-                    'Location': branch['location'],
-                    'Total Items': len(branch_items),
-                    'Final Products': final_products,
-                    'Total Stock': int(total_stock),
-                    'Critical': critical
-                })
+        if not branch_summary.empty:
+            st.dataframe(branch_summary, use_container_width=True)
+        
+        # Inventory value
+        st.subheader("💰 Inventory Value")
+        value_columns = {'items': 'Items', 'total_stock': 'Total Stock', 'average_value': 'Value (Avg Cost)',
+                         'fifo_value': 'Value (FIFO)'}
+        col1, col2 = st.columns(2)
+        
+        with col1:
+            value_df = get_inventory_valuation("branch").set_index('branch').rename(columns=value_columns)
+            st.dataframe(value_df.round(2), use_container_width=True)
+        
+        with col2:
+            value_df = get_inventory_valuation("category").set_index('category').rename(columns=value_columns)
+            st.dataframe(value_df.round(2), use_container_width=True)
+        
+        total_column = 'Value (FIFO)' if COSTING_METHOD == 'FIFO' else 'Value (Avg Cost)'
+        st.metric(f"Total Inventory Value ({COSTING_METHOD})", f"{value_df[total_column].sum():,.2f}")
+        
+        # Stock trends
+        st.subheader("📈 Stock Trends")
+        items_df = get_items_by_role("boss")
+        branches_df = get_all_branches()
+        col1, col2, col3, col4 = st.columns(4)
+        
+        with col1:
+            trend_item = st.selectbox(
+                "Item",
+                options=sorted(items_df['id'].unique().tolist()),
+                format_func=lambda x: f"{x} - {items_df[items_df['id']==x]['name'].iloc[0]}",
+                key="trend_item"
+            )
+        
+        with col2:
+            trend_branch = st.selectbox(
+                "Branch",
+                options=[None] + branches_df['id'].tolist(),
+                format_func=lambda x: "All Branches" if x is None else branches_df[branches_df['id']==x]['branch_name'].iloc[0],
+                key="trend_branch"
+            )
+        
+        with col3:
+            trend_days = st.selectbox("Period", [30, 90, 180, 365, 730], index=3,
+                                      format_func=lambda x: f"Last {x} days", key="trend_days")
+        
+        with col4:
+            trend_freq = st.selectbox("Resolution", list(TREND_FREQUENCIES), index=1, key="trend_freq")
+        
+        if trend_item:
+            series = get_stock_timeseries(trend_item, trend_branch, trend_days, TREND_FREQUENCIES[trend_freq])
+            st.line_chart(series['stock'], use_container_width=True)
+            st.bar_chart(series[['qty_in', 'qty_out']].rename(columns={'qty_in': 'In', 'qty_out': 'Out'}),
+                         use_container_width=True)
+        
+        activity = get_movement_trends(trend_branch, trend_days, TREND_FREQUENCIES[trend_freq])
+        if not activity.empty:
+            st.caption("Movements per period")
+            st.bar_chart(activity['movements'], use_container_width=True)
+        
+        # Movement analytics, for the same branch and period
+        st.subheader("📦 Movement Analytics")
+        col1, col2 = st.columns(2)
+        
+        with col1:
+            analytics_group = st.selectbox("Group By", list(MOVEMENT_ANALYTICS_GROUPS), key="analytics_group")
+        
+        with col2:
+            analytics_types = st.multiselect("Movement Types", sorted(STOCK_IN_TYPES + ['OUT', 'ADMIN_OUT', 'TRANSFER_OUT']),
+                                             key="analytics_types")
+        
+        group_by = MOVEMENT_ANALYTICS_GROUPS[analytics_group]
+        totals = get_movement_analytics(group_by, trend_days, trend_branch, analytics_types or None)
+        source = "columnar mirror" if totals.attrs.get('source') == 'mirror' else "live database"
+        st.caption(f"{int(totals['movements'].sum()):,} movements, aggregated from the {source}")
+        if 'branch_id' in totals.columns:
+            totals.insert(0, 'branch', totals.pop('branch_id').map(branches_df.set_index('id')['branch_name']))
+        if 'item_id' in totals.columns:
+            totals = totals.sort_values('value', ascending=False).head(50)
+            totals.insert(1, 'name', totals['item_id'].map(items_df.drop_duplicates('id').set_index('id')['name']))
+        st.dataframe(totals.round(2), use_container_width=True, hide_index=True)
+        if len(group_by) == 1 and not totals.empty and analytics_group != "Item":
+            st.bar_chart(totals.set_index(totals.columns[0])['value'], use_container_width=True)
         
-        if branch_summary:
-            summary_df = pd.DataFrame(branch_summary)
-            st.dataframe(summary_df, use_container_width=True)
+        # Month-end workbook, computed per branch in worker processes
+        st.subheader("🗓️ Month-End Report")
+        first_of_month = datetime.now().replace(day=1)
+        months = [(first_of_month - timedelta(days=31 * n)).strftime("%Y-%m") for n in range(0, 13)]
+        col1, col2 = st.columns([2, 1])
+        
+        with col1:
+            month = st.selectbox("Month", months, index=1, key="month_end_month")
+        
+        with col2:
+            if st.button("⚙️ Generate Workbook", use_container_width=True):
+                import month_end
+                with st.spinner(f"Computing {month} for all branches..."):
+                    workbook, stats = month_end.run_month_end(DB_PATH, month)
+                st.session_state['month_end_workbook'] = (month, workbook, stats)
+        
+        if st.session_state.get('month_end_workbook'):
+            month, workbook, stats = st.session_state['month_end_workbook']
+            st.caption(f"{stats['branches']} branches on {stats['workers']} workers in {stats['compute_seconds']}s")
+            st.download_button("📥 Download Month-End Workbook", workbook, file_name=f"month_end_{month}.xlsx",
+                               mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
         
         # Critical items
-        critical_items = items_df[items_df['current_stock'] <= 0]
+        critical_items = report['critical_items']
         if not critical_items.empty:
             st.subheader("🚨 Critical Items")
             critical_display = critical_items[['branch_name', 'name', 'category', 'current_stock', 'min_stock']]
@@ -1318,7 +4982,7 @@ def show_manager_dashboard():
     st.header("📊 Warehouse Manager Dashboard")
     
     branches_df = get_all_branches()
-    items_df = get_items_by_role("warehouse_manager")
+    summary = get_branch_summary()
     
     # Summary metrics
     col1, col2, col3, col4 = st.columns(4)
@@ -1327,45 +4991,44 @@ def show_manager_dashboard():
         st.metric("Branches", len(branches_df))
     
     with col2:
-        st.metric("Total Items", len(items_df))
+        st.metric("Total Items", int(summary['items'].sum()))
     
     with col3:
-        final_products = len(items_df[items_df['category'] == 'Final Product'])
-        st.metric("Final Products", final_products)
+        final_products = summary.loc[summary['category'] == 'Final Product', 'items'].sum()
+        st.metric("Final Products", int(final_products))
     
     with col4:
-        critical = len(items_df[items_df['current_stock'] <= 0])
-        st.metric("Critical Items", critical)
+        st.metric("Critical Items", int(summary['out_of_stock'].sum()))
     
     # Branch status
     st.subheader("🏪 Branch Status")
     
     for _, branch in branches_df.iterrows():
-        branch_items = items_df[items_df['branch_id'] == branch['id']]
+        branch_summary = summary[summary['branch_id'] == branch['id']]
         
-        if not branch_items.empty:
-            with st.expander(f"🏪 {branch['branch_name']} ({len(branch_items)} items)"):
+        if not branch_summary.empty:
+            counts = branch_summary.set_index('category')['items']
+            critical_count = int(branch_summary['out_of_stock'].sum())
+            
+            with st.expander(f"🏪 {branch['branch_name']} ({int(counts.sum())} items)"):
                 col1, col2, col3, col4 = st.columns(4)
                 
                 with col1:
-                    raw_count = len(branch_items[branch_items['category'] == 'Raw Material'])
-                    st.metric("Raw Materials", raw_count)
+                    st.metric("Raw Materials", int(counts.get('Raw Material', 0)))
                 
                 with col2:
-                    pre_final_count = len(branch_items[branch_items['category'] == 'Pre-Final'])
-                    st.metric("Components", pre_final_count)
+                    st.metric("Components", int(counts.get('Pre-Final', 0)))
                 
                 with col3:
-                    final_count = len(branch_items[branch_items['category'] == 'Final Product'])
-                    st.metric("Final Products", final_count)
+                    st.metric("Final Products", int(counts.get('Final Product', 0)))
                 
                 with col4:
-                    critical_count = len(branch_items[branch_items['current_stock'] <= 0])
                     st.metric("Critical", critical_count)
                 
-                # Critical items
-                critical_items = branch_items[branch_items['current_stock'] <= 0]
-                if not critical_items.empty:
+                # Critical items, only listed when the counters say there are some
+                if critical_count:
+                    branch_items = get_items_by_role("warehouse_manager", branch['id'])
+                    critical_items = branch_items[branch_items['current_stock'] <= 0]
                     st.error(f"🚨 Critical items in {branch['branch_name']}:")
                     for _, item in critical_items.iterrows():
                         st.write(f"❌ {item['name']}")
@@ -1450,18 +5113,11 @@ def show_manager_stock():
         
         if not items_df.empty:
             # Add status
-            def get_status(row):
-                if row['current_stock'] <= 0:
-                    return "❌ OUT"
-                elif row['current_stock'] <= row['min_stock']:
-                    return "⚠️ LOW"
-                else:
-                    return "✅ OK"
-            
-            items_df['Status'] = items_df.apply(get_status, axis=1)
+            items_df = items_df.copy()
+            items_df['Status'] = stock_status_labels(items_df)
             
-            display_df = items_df[['id', 'name', 'category', 'current_stock', 'unit', 'Status']]
-            display_df.columns = ['ID', 'Name', 'Category', 'Stock', 'Unit', 'Status']
+            display_df = items_df[['id', 'name', 'category', 'current_stock', 'reserved_stock', 'available_stock', 'unit', 'Status']]
+            display_df.columns = ['ID', 'Name', 'Category', 'On Hand', 'Reserved', 'Available', 'Unit', 'Status']
             
             st.dataframe(display_df, use_container_width=True, height=300)
             
@@ -1484,6 +5140,9 @@ def show_manager_stock():
                     reference = st.text_input("Reference", placeholder="Delivery, sale, adjustment, etc.")
                     batch_nr = st.text_input("Batch Number", placeholder="Optional")
                     invoice_nr = st.text_input("Invoice Number", placeholder="Optional")
+                    expiry_date = st.date_input("Expiry Date (IN only)", value=None)
+                    unit_cost = st.number_input("Unit Cost (IN only)", min_value=0.0, value=None,
+                                                placeholder="Current average cost")
                 
                 submitted = st.form_submit_button("💾 Update Stock", type="primary")
                 
@@ -1495,7 +5154,9 @@ def show_manager_stock():
                         
                         # Update stock with enhanced tracking
                         update_stock(selected_item, selected_branch_id, abs(quantity), movement_type, 
-                                   reference, batch_nr, invoice_nr, "", st.session_state.username)
+                                   reference, batch_nr, invoice_nr, "", st.session_state.username,
+                                   expiry_date.strftime("%Y-%m-%d") if expiry_date and movement_type == "IN" else None,
+                                   unit_cost if movement_type == "IN" else None)
                         
                         # Calculate new stock for feedback
                         if movement_type == "IN":
@@ -1543,7 +5204,7 @@ def show_manager_transfers():
         st.warning("Need at least 2 branches")
         return
     
-    tab1, tab2 = st.tabs(["🔄 Transfer", "📈 History"])
+    tab1, tab2, tab3, tab4 = st.tabs(["🚚 Dispatch", "📥 Receive", "🛣️ In Transit", "📈 History"])
     
     with tab1:
         # Branch selection
@@ -1567,47 +5228,100 @@ def show_manager_transfers():
         if from_branch_id and to_branch_id:
             # Get available items
             from_items = get_items_by_role("warehouse_manager", from_branch_id)
-            available_items = from_items[from_items['current_stock'] > 0]
+            available_items = from_items[from_items['available_stock'] > 0]
             
             if not available_items.empty:
-                with st.form("transfer_form"):
-                    col1, col2 = st.columns(2)
-                    
-                    with col1:
-                        selected_item = st.selectbox(
-                            "📦 Item",
-                            options=available_items['id'].tolist(),
-                            format_func=lambda x: f"{available_items[available_items['id']==x]['name'].iloc[0]} ({available_items[available_items['id']==x]['current_stock'].iloc[0]})"
-                        )
-                        
-                        if selected_item:
-                            max_qty = available_items[available_items['id'] == selected_item]['current_stock'].iloc[0]
-                            quantity = st.number_input("Quantity", min_value=0.0, max_value=max_qty, value=1.0)
-                    
-                    with col2:
-                        reference = st.text_input("Reference")
-                        batch_nr = st.text_input("Batch Number")
+                with st.form("dispatch_form"):
+                    reference = st.text_input("Reference", placeholder="e.g. delivery note or truck")
+                    lines = st.data_editor(pd.DataFrame({'item_id': pd.Series(dtype=str), 'quantity': pd.Series(dtype=float)}),
+                                           num_rows="dynamic", use_container_width=True,
+                                           column_config={'item_id': st.column_config.SelectboxColumn(
+                                                              "Item", options=available_items['id'].tolist(), required=True),
+                                                          'quantity': st.column_config.NumberColumn("Quantity", min_value=0.0)})
                     
-                    submitted = st.form_submit_button("🔄 Transfer", type="primary")
+                    submitted = st.form_submit_button("🚚 Dispatch", type="primary")
                     
-                    if submitted and selected_item and quantity > 0:
-                        success, message = transfer_stock_between_branches(
-                            selected_item, from_branch_id, to_branch_id, quantity, 
-                            reference, batch_nr, "", "", st.session_state.username
-                        )
-                        
-                        if success:
-                            st.success(message)
-                            st.rerun()
+                    if submitted:
+                        lines = lines.dropna()
+                        if lines.empty:
+                            st.error("❌ Add at least one line")
                         else:
-                            st.error(message)
+                            try:
+                                shipment_id = dispatch_shipment(from_branch_id, to_branch_id,
+                                                                lines[['item_id', 'quantity']].itertuples(index=False),
+                                                                reference, st.session_state.username)
+                                st.success(f"✅ Shipment #{shipment_id} is on its way; stock arrives when it is received")
+                            except ValueError as e:
+                                st.error(f"❌ {e}")
+                
+                display_df = available_items[['id', 'name', 'current_stock', 'available_stock', 'unit']]
+                display_df.columns = ['ID', 'Item', 'On Hand', 'Available', 'Unit']
+                st.dataframe(display_df, use_container_width=True, height=250)
             else:
                 st.warning("No items with stock in source branch")
     
     with tab2:
+        receiving_branch_id = st.selectbox("📥 Receiving Branch", options=branches_df['id'].tolist(),
+                                           format_func=lambda x: branches_df[branches_df['id']==x]['branch_name'].iloc[0],
+                                           key="receiving_branch")
+        inbound_df = get_shipments(receiving_branch_id, "inbound", "OPEN")
+        
+        if inbound_df.empty:
+            st.info("Nothing on its way to this branch")
+        else:
+            st.metric("Open Inbound Shipments", len(inbound_df))
+            shipment_id = st.selectbox(
+                "Shipment",
+                options=inbound_df['id'].tolist(),
+                format_func=lambda x: (lambda r: f"#{x} from {r['from_branch_name']} - {r['reference'] or 'no reference'} "
+                                                 f"({r['dispatched_at']}, {r['status'].replace('_', ' ').lower()})")(
+                    inbound_df[inbound_df['id'] == x].iloc[0]),
+                key="receive_shipment"
+            )
+            
+            lines_df = get_shipment_lines(shipment_id)
+            received = st.data_editor(
+                lines_df[['item_id', 'item_name', 'quantity_sent', 'quantity_received', 'outstanding']].assign(receive=lines_df['outstanding']),
+                disabled=['item_id', 'item_name', 'quantity_sent', 'quantity_received', 'outstanding'],
+                column_config={'receive': st.column_config.NumberColumn("Receive Now", min_value=0.0)},
+                use_container_width=True, key=f"receive_lines_{shipment_id}"
+            )
+            
+            if st.button("📥 Receive", type="primary"):
+                lines = received[received['receive'] > 0][['item_id', 'receive']].itertuples(index=False)
+                ok, message = receive_shipment(shipment_id, list(lines), st.session_state.username)
+                if ok:
+                    st.success(f"✅ {message}")
+                    st.rerun()
+                else:
+                    st.error(f"❌ {message}")
+            
+            # Whatever is still missing on old shipments is written off together
+            st.markdown("---")
+            st.subheader("🧾 Close Out Variances")
+            to_close = st.multiselect("Shipments to close", options=inbound_df['id'].tolist(),
+                                      format_func=lambda x: f"#{x} ({inbound_df[inbound_df['id']==x]['outstanding'].iloc[0]:g} outstanding)")
+            if st.button("🧾 Close Selected", disabled=not to_close):
+                closed, value = close_shipments(to_close, st.session_state.username)
+                st.success(f"✅ Closed {closed} shipments, {value:,.2f} written off in transit")
+                st.rerun()
+    
+    with tab3:
+        in_transit_df = get_in_transit()
+        
+        if in_transit_df.empty:
+            st.info("Nothing in transit")
+        else:
+            col1, col2 = st.columns(2)
+            col1.metric("Units In Transit", f"{in_transit_df['quantity'].sum():,.1f}")
+            col2.metric("Value In Transit", f"{in_transit_df['value'].sum():,.2f}")
+            display_df = in_transit_df[['from_branch_name', 'to_branch_name', 'item_id', 'item_name', 'quantity', 'unit', 'value']]
+            display_df.columns = ['From', 'To', 'Item ID', 'Item', 'Qty', 'Unit', 'Value']
+            st.dataframe(display_df, use_container_width=True, height=400)
+    
+    with tab4:
         # Transfer history
-        conn = sqlite3.connect('inventory.db')
-        transfers_df = pd.read_sql_query('''
+        transfers_df = get_read_hub().query('''
             SELECT sm.*, i.name as item_name, i.unit,
                    b1.branch_name as from_branch_name,
                    b2.branch_name as to_branch_name
@@ -1616,16 +5330,15 @@ def show_manager_transfers():
             LEFT JOIN branches b1 ON sm.from_branch_id = b1.id
             LEFT JOIN branches b2 ON sm.to_branch_id = b2.id
             WHERE sm.movement_type = 'TRANSFER_OUT'
-            ORDER BY sm.date_time DESC 
+            ORDER BY sm.ts DESC, sm.id DESC
             LIMIT 50
-        ''', conn)
-        conn.close()
+        ''')
         
         if not transfers_df.empty:
-            display_df = transfers_df[['date_time', 'item_name', 'quantity', 'unit', 
-                                     'from_branch_name', 'to_branch_name', 'reference', 'user_id']]
+            display_df = transfers_df[['ts', 'item_name', 'quantity', 'unit', 
+                                     'from_branch_name', 'to_branch_name', 'reference', 'user_id']].copy()
             display_df.columns = ['Date', 'Item', 'Qty', 'Unit', 'From', 'To', 'Reference', 'User']
-            display_df['Date'] = pd.to_datetime(display_df['Date']).dt.strftime('%m-%d %H:%M')
+            display_df['Date'] = pd.to_datetime(display_df['Date'], unit='s').dt.strftime('%m-%d %H:%M')
             
             st.dataframe(display_df, use_container_width=True, height=400)
 
@@ -1660,11 +5373,29 @@ def show_manager_production():
                 )
                 
                 quantity = st.number_input("Quantity to Produce", min_value=1, value=1)
+                batch_nr = st.text_input("Batch Number", placeholder="Optional, generated if empty")
+                expiry_date = st.date_input("Expiry Date", value=None)
+                
+                # Ingredients reserved earlier for this product can be drawn on by the run
+                planned = get_reservations(selected_branch_id, kind="PRODUCTION")
+                planned = planned[planned['reference'].str.startswith(f"Production {selected_product} ")]
+                reservation = st.selectbox("📌 Use Reservation", options=[None] + planned['reference'].unique().tolist(),
+                                           format_func=lambda x: "None" if x is None else x)
+                
+                if st.button("📌 Reserve Ingredients"):
+                    success, message = allocate_production(selected_product, selected_branch_id, quantity, st.session_state.username)
+                    if success:
+                        st.success(message)
+                        st.rerun()
+                    else:
+                        st.error(message)
                 
                 if st.button("🚀 Start Production", type="primary"):
                     if selected_product and quantity > 0:
                         # Use BOM-based production
-                        success, message = produce_item(selected_product, selected_branch_id, quantity, st.session_state.username)
+                        success, message = produce_item(selected_product, selected_branch_id, quantity, st.session_state.username,
+                                                        batch_nr, expiry_date.strftime("%Y-%m-%d") if expiry_date else None,
+                                                        reservation)
                         
                         if success:
                             st.success(message)
@@ -1695,10 +5426,11 @@ def show_manager_production():
                     if not bom_df.empty:
                         st.write(f"**To produce {quantity} units:**")
                         
+                        held = planned[planned['reference'] == reservation].groupby('item_id')['quantity'].sum()
                         can_produce = True
                         for _, row in bom_df.iterrows():
                             required_qty = row['quantity_required'] * quantity
-                            available_qty = row['current_stock']
+                            available_qty = row['available_stock'] + held.get(row['ingredient_id'], 0)
                             
                             if available_qty >= required_qty:
                                 status = "✅"
@@ -1722,6 +5454,111 @@ def show_manager_production():
             st.warning("No final products found in this branch")
             st.info("💡 Add final products using the 'Items' section")
 
+def show_manager_planning():
+    """Manager: Production schedule and time-phased material requirements"""
+    st.header("🗓️ Production Planning")
+    
+    branches_df = get_all_branches()
+    tab1, tab2 = st.tabs(["🗓️ Schedule", "📊 Requirements"])
+    
+    with tab1:
+        with st.expander("➕ Schedule Production"):
+            branch_id = st.selectbox("Branch", options=branches_df['id'].tolist(), key="schedule_branch",
+                                     format_func=lambda x: branches_df[branches_df['id']==x]['branch_name'].iloc[0])
+            items_df = get_items_by_role("warehouse_manager", branch_id)
+            products = items_df[items_df['category'] == 'Final Product']
+            with st.form("schedule_run"):
+                col1, col2 = st.columns(2)
+                with col1:
+                    product_id = st.selectbox("Final Product", options=products['id'].tolist(),
+                                              format_func=lambda x: products[products['id']==x]['name'].iloc[0])
+                with col2:
+                    quantity = st.number_input("Quantity", min_value=1.0, value=10.0)
+                    due_date = st.date_input("Due Date")
+                reference = st.text_input("Reference", placeholder="e.g. customer order or campaign")
+                
+                if st.form_submit_button("🗓️ Add to Schedule", type="primary") and product_id:
+                    schedule_production([{'final_product_id': product_id, 'branch_id': branch_id, 'quantity': quantity,
+                                          'due_date': due_date, 'reference': reference}], st.session_state.username)
+                    st.success("✅ Run scheduled")
+            
+            uploaded = st.file_uploader("Or upload a schedule (final_product_id, branch_id, quantity, due_date)",
+                                        type=["csv", "xlsx"], key="schedule_upload")
+            if uploaded is not None and st.button("📥 Import Schedule"):
+                try:
+                    sheet = pd.read_csv(uploaded) if uploaded.name.endswith(".csv") else pd.read_excel(uploaded)
+                    st.success(f"✅ Scheduled {schedule_production(sheet, st.session_state.username)} runs")
+                except ValueError as e:
+                    st.error(f"❌ {e}")
+        
+        schedule_df = get_production_schedule()
+        if schedule_df.empty:
+            st.info("Nothing scheduled")
+        else:
+            display_df = schedule_df[['id', 'due_date', 'branch_name', 'product_name', 'quantity', 'unit', 'reference']]
+            display_df.columns = ['ID', 'Due', 'Branch', 'Product', 'Qty', 'Unit', 'Reference']
+            st.dataframe(display_df, use_container_width=True, height=300)
+            
+            selected = st.multiselect("Runs", options=schedule_df['id'].tolist(), key="schedule_selected",
+                                      format_func=lambda x: (lambda r: f"#{x} {r['product_name']} x {r['quantity']:g} due {r['due_date']}")(
+                                          schedule_df[schedule_df['id'] == x].iloc[0]))
+            col1, col2 = st.columns(2)
+            with col1:
+                if st.button("✅ Mark Done", disabled=not selected, use_container_width=True):
+                    set_schedule_status(selected, "DONE", st.session_state.username)
+                    st.rerun()
+            with col2:
+                if st.button("🗑️ Cancel Runs", disabled=not selected, use_container_width=True):
+                    set_schedule_status(selected, "CANCELLED", st.session_state.username)
+                    st.rerun()
+    
+    with tab2:
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            branch_id = st.selectbox("Branch", options=[None] + branches_df['id'].tolist(), key="mrp_branch",
+                                     format_func=lambda x: "All Branches" if x is None else branches_df[branches_df['id']==x]['branch_name'].iloc[0])
+        with col2:
+            freq = st.selectbox("Buckets", options=list(MRP_BUCKETS), index=1, format_func=MRP_BUCKETS.get, key="mrp_freq")
+        with col3:
+            lead_time_days = st.number_input("Production Lead Time (days)", min_value=0, value=0, key="mrp_lead")
+        
+        st.caption("Nets the schedule against available stock (on hand - reserved) and goods in transit.")
+        if st.button("📊 Run MRP", type="primary"):
+            st.session_state.mrp_result = run_mrp(branch_id, freq, lead_time_days)
+        
+        result = st.session_state.get('mrp_result')
+        if result is not None:
+            planned_orders, shortages = result['planned_orders'], result['shortages']
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Planned Production Orders", int((planned_orders['order_type'] == 'MAKE').sum()))
+            col2.metric("Items Short", shortages[['branch_id', 'item_id']].drop_duplicates().shape[0])
+            col3.metric("First Shortage", str(shortages['due'].min()) if not shortages.empty else "-")
+            
+            st.subheader("🛒 Shortages")
+            if shortages.empty:
+                st.success("✅ Every bought item is covered")
+            else:
+                st.dataframe(shortages, use_container_width=True, height=250)
+            
+            st.subheader("🏭 Planned Orders")
+            st.dataframe(planned_orders, use_container_width=True, height=300)
+            
+            st.subheader("📈 Time-Phased Plan")
+            plan = result['plan']
+            item_id = st.selectbox("Item", options=plan['item_id'].unique().tolist(), key="mrp_item",
+                                   format_func=lambda x: f"{x} - {plan[plan['item_id']==x]['name'].iloc[0]}")
+            if item_id:
+                phased = plan[plan['item_id'] == item_id]
+                st.dataframe(phased.pivot_table(index='period', columns='branch_id',
+                                                values=['gross', 'receipts', 'planned', 'projected'], aggfunc='sum').T,
+                             use_container_width=True)
+            
+            buffer = io.BytesIO()
+            with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
+                for name, frame in result.items():
+                    frame.to_excel(writer, sheet_name=name.replace('_', ' ').title(), index=False)
+            st.download_button("📥 Download Plan", buffer.getvalue(), file_name=f"mrp_{datetime.now():%Y%m%d}.xlsx")
+
 def show_manager_bom():
     """Manager: Bill of Materials management"""
     st.header("🧾 Bill of Materials (BOM)")
@@ -1897,13 +5734,19 @@ def show_manager_bom():
             st.markdown("---")
             st.subheader("📊 BOM Statistics")
             
-            total_products = len(final_products)
-            products_with_bom = 0
+            # Capacity for every product is precomputed by the background scheduler
+            capacity_report, computed_at = get_precomputed_report('bom_capacity')
+            if capacity_report is None:
+                capacity_df = compute_bom_capacity()
+                save_precomputed_report('bom_capacity', {'capacity': capacity_df})
+            else:
+                capacity_df = capacity_report['capacity']
             
-            for _, product in final_products.iterrows():
-                bom_df = get_bom(product['id'], selected_branch_id)
-                if not bom_df.empty:
-                    products_with_bom += 1
+            branch_capacity = capacity_df[capacity_df['branch_id'] == selected_branch_id]
+            branch_capacity = branch_capacity[branch_capacity['final_product_id'].isin(final_products['id'])]
+            
+            total_products = len(final_products)
+            products_with_bom = len(branch_capacity)
             
             col1, col2, col3 = st.columns(3)
             
@@ -1915,12 +5758,23 @@ def show_manager_bom():
             
             with col3:
                 st.metric("Without BOM", total_products - products_with_bom)
+            
+            if not branch_capacity.empty:
+                names = final_products.set_index('id')['name']
+                capacity_display = pd.DataFrame({
+                    'Product': branch_capacity['final_product_id'].map(names).values,
+                    'Max Production': branch_capacity['max_production'].values,
+                    'Limited By': branch_capacity['limiting_ingredient'].values
+                })
+                st.dataframe(capacity_display, use_container_width=True)
+                if computed_at:
+                    st.caption(f"🕒 Capacity computed at {computed_at}")
 
 def show_manager_items():
     """Manager: Item management with delete functionality"""
     st.header("⚙️ Item Management")
     
-    tab1, tab2, tab3 = st.tabs(["➕ Add Item", "📋 View Items", "🗑️ Delete Items"])
+    tab1, tab2, tab3, tab4 = st.tabs(["➕ Add Item", "📋 View Items", "🗑️ Delete Items", "📈 Demand Forecast"])
     
     with tab1:
         branches_df = get_all_branches()
@@ -1942,12 +5796,14 @@ def show_manager_items():
                 unit = st.selectbox("Unit", ["kg", "g", "L", "ml", "pieces", "units"])
                 current_stock = st.number_input("Current Stock", min_value=0.0, value=0.0)
                 min_stock = st.number_input("Min Stock", min_value=0.0, value=0.0)
+                cost_per_unit = st.number_input("Cost per Unit", min_value=0.0, value=0.0)
             
             submitted = st.form_submit_button("➕ Add Item", type="primary")
             
             if submitted and name and item_id and branch_id:
                 try:
-                    add_item(item_id, name, category, unit, current_stock, min_stock, branch_id, st.session_state.username)
+                    add_item(item_id, name, category, unit, current_stock, min_stock, branch_id, st.session_state.username,
+                             cost_per_unit)
                     st.success(f"✅ Added {name}!")
                     st.rerun()
                 except Exception as e:
@@ -1968,8 +5824,8 @@ def show_manager_items():
             items_df = get_items_by_role("warehouse_manager", branch_id)
         
         if not items_df.empty:
-            display_df = items_df[['branch_name', 'id', 'name', 'category', 'current_stock', 'min_stock', 'unit']]
-            display_df.columns = ['Branch', 'ID', 'Name', 'Category', 'Stock', 'Min', 'Unit']
+            display_df = items_df[['branch_name', 'id', 'name', 'category', 'current_stock', 'reserved_stock', 'available_stock', 'min_stock', 'unit']]
+            display_df.columns = ['Branch', 'ID', 'Name', 'Category', 'On Hand', 'Reserved', 'Available', 'Min', 'Unit']
             
             st.dataframe(display_df, use_container_width=True, height=400)
     
@@ -2019,15 +5875,7 @@ def show_manager_items():
                             if st.session_state.get('confirm_delete_item') == item_to_delete:
                                 # DELETE THE ITEM
                                 try:
-                                    conn = sqlite3.connect('inventory.db')
-                                    c = conn.cursor()
-                                    
-                                    # Delete from all tables
-                                    c.execute('DELETE FROM items WHERE id = ? AND branch_id = ?', (item_to_delete, branch_id))
-                                    c.execute('DELETE FROM stock_movements WHERE item_id = ? AND branch_id = ?', (item_to_delete, branch_id))
-                                    
-                                    conn.commit()
-                                    conn.close()
+                                    delete_item(item_to_delete, branch_id, st.session_state.username)
                                     
                                     st.success(f"🗑️ DELETED '{item_info['name']}' from {item_info['branch_name']}!")
                                     if 'confirm_delete_item' in st.session_state:
@@ -2053,47 +5901,86 @@ def show_manager_items():
                                 st.rerun()
             else:
                 st.info(f"No items found in {del_branch_filter}")
-    
+
+    with tab4:
+        st.caption(f"Daily demand from OUT movements, fitted nightly with a moving average, exponential smoothing and "
+                   f"a weekly seasonal naive model; each item uses whichever has tracked its demand best. "
+                   f"Suggestions assume a {FORECAST_LEAD_TIME_DAYS}-day lead time.")
+        branches_df = get_all_branches()
+        forecast_branch = st.selectbox("🏪 Branch", options=[None] + branches_df['id'].tolist(), key="forecast_branch",
+                                       format_func=lambda x: "All" if x is None else branches_df[branches_df['id']==x]['branch_name'].iloc[0])
+        forecast_df = get_demand_forecast(forecast_branch)
+
+        if forecast_df.empty:
+            st.info("No forecast yet - it is fitted by the nightly fit_demand_forecast job")
+            if st.button("📈 Fit Now"):
+                stats = fit_demand_forecast()
+                st.success(f"✅ Fitted {stats['series']} demand series through {stats['fitted_through']}")
+                st.rerun()
+        else:
+            changed = forecast_df[(forecast_df['min_stock'] - forecast_df['suggested_min_stock']).abs() > 0.01]
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Forecast Items", len(forecast_df))
+            col2.metric("Min Stock Differs", len(changed))
+            col3.metric("Fitted Through", str(forecast_df['fitted_through'].iloc[0]))
+
+            display_df = forecast_df[['branch_name', 'item_id', 'name', 'unit', 'current_stock', 'min_stock', 'model',
+                                      'daily_demand', 'suggested_min_stock', 'reorder_point']]
+            display_df.columns = ['Branch', 'ID', 'Name', 'Unit', 'On Hand', 'Min', 'Model', 'Daily Demand',
+                                  'Suggested Min', 'Reorder Point']
+            st.dataframe(display_df, use_container_width=True, height=400)
+
+            selected = st.multiselect("Items to update", options=changed['item_id'].unique().tolist(), key="forecast_items",
+                                      help="Leave empty to apply every suggestion shown")
+            if st.button(f"✅ Apply Suggested Min Stock ({len(selected) or len(changed)} items)", type="primary",
+                         disabled=changed.empty):
+                updated = apply_suggested_min_stock(forecast_branch, selected or None, st.session_state.username)
+                st.success(f"✅ Min stock updated for {updated} items")
+                st.rerun()
+
     # Quick stats
-    items_df = get_items_by_role("warehouse_manager")
-    if not items_df.empty:
+    summary = get_branch_summary()
+    if not summary.empty:
         st.markdown("---")
         col1, col2, col3, col4 = st.columns(4)
+        total_items, zero_stock_items = int(summary['items'].sum()), int(summary['out_of_stock'].sum())
         
         with col1:
-            st.metric("Total Items", len(items_df))
+            st.metric("Total Items", total_items)
         
         with col2:
-            active_items = len(items_df[items_df['current_stock'] > 0])
-            st.metric("Active Items", active_items)
+            st.metric("Active Items", total_items - zero_stock_items)
         
         with col3:
-            low_stock_items = len(items_df[items_df['current_stock'] <= items_df['min_stock']])
-            st.metric("Low Stock", low_stock_items)
+            # At or below minimum, empty items included
+            st.metric("Low Stock", int(summary['low_stock'].sum()) + zero_stock_items)
         
         with col4:
-            zero_stock_items = len(items_df[items_df['current_stock'] <= 0])
             st.metric("Zero Stock", zero_stock_items)
 
 def show_manager_movements():
-    """Manager: View all movements with enhanced filtering and cleanup"""
+    """Manager: View all movements with enhanced filtering and duplicate review"""
     st.header("📈 Movement History")
     
-    # Cleanup option
+    # Duplicate review
     col1, col2 = st.columns([3, 1])
     
     with col1:
         st.subheader("📊 Stock Movement Records")
     
     with col2:
-        if st.button("🧹 Clean Duplicates", type="secondary", help="Remove duplicate movement records"):
-            deleted = clean_duplicate_movements()
-            if deleted > 0:
-                st.success(f"✅ Cleaned {deleted} duplicate records!")
-                st.rerun()
-            else:
-                st.info("No duplicates found")
+        find_duplicates = st.button("🔍 Find Duplicates", type="secondary",
+                                    help="List movements recorded more than once in the same second")
     
+    if find_duplicates:
+        show_duplicate_movements()
+    
+    show_manager_movement_records()
+
+@st.fragment
+@instrumented('page')
+def show_manager_movement_records():
+    """Manager: filtered movement records"""
     # Filters
     col1, col2, col3 = st.columns(3)
     
@@ -2132,19 +6019,23 @@ def show_manager_movements():
             index=1
         )
     
-    # Get movements with better deduplication
-    conn = sqlite3.connect('inventory.db')
+    start_ts, end_ts = show_date_range_filter("manager_movements")
     
+    # Get movements; joining on the item's own branch keeps each movement once
     query = '''
-        SELECT DISTINCT sm.*, i.name as item_name, i.unit, i.category, b.branch_name
+        SELECT sm.*, i.name as item_name, i.unit, i.category, b.branch_name
         FROM stock_movements sm
-        JOIN items i ON sm.item_id = i.id 
+        JOIN items i ON sm.item_id = i.id AND sm.branch_id = i.branch_id
         JOIN branches b ON sm.branch_id = b.id
-        WHERE EXISTS (SELECT 1 FROM items i2 WHERE i2.id = sm.item_id AND i2.branch_id = sm.branch_id)
+        WHERE 1=1
     '''
     
     params = []
     
+    if start_ts is not None:
+        query += " AND sm.ts >= ? AND sm.ts < ?"
+        params += [start_ts, end_ts]
+    
     # Branch filtering
     if branch_filter != "All":
         branch_id = branches_df[branches_df['branch_name'] == branch_filter]['id'].iloc[0]
@@ -2173,45 +6064,24 @@ def show_manager_movements():
     elif movement_filter == "Stock Updates":
         query += " AND sm.movement_type IN ('IN', 'OUT')"
     
-    query += f" ORDER BY sm.date_time DESC, sm.id DESC LIMIT {limit_records}"
+    query += f" ORDER BY sm.ts DESC, sm.id DESC LIMIT {limit_records}"
     
-    movements_df = pd.read_sql_query(query, conn, params=params)
-    conn.close()
+    movements_df = get_read_hub().query(query, params)
     
     if not movements_df.empty:
         st.info(f"📊 Found {len(movements_df)} movements")
         
-        # Build tracking info and display
-        def build_tracking(row):
-            tracking = []
-            if row.get('batch_nr'):
-                tracking.append(f"Batch: {row['batch_nr']}")
-            if row.get('invoice_nr'):
-                tracking.append(f"Inv: {row['invoice_nr']}")
-            return " | ".join(tracking) if tracking else "-"
-        
-        movements_df['Tracking'] = movements_df.apply(build_tracking, axis=1)
-        
-        # Format movement types for better readability
-        def format_movement_type(movement_type):
-            if movement_type == 'ADMIN_SET':
-                return 'Admin: SET'
-            elif movement_type == 'ADMIN_IN':
-                return 'Admin: ADD'
-            elif movement_type == 'ADMIN_OUT':
-                return 'Admin: SUBTRACT'
-            elif movement_type == 'TRANSFER_OUT':
-                return 'Transfer: OUT'
-            elif movement_type == 'TRANSFER_IN':
-                return 'Transfer: IN'
-            else:
-                return movement_type
-        
-        movements_df['FormattedType'] = movements_df['movement_type'].apply(format_movement_type)
+        # Tracking info and readable movement types, column-wise
+        movements_df = movements_df.copy()
+        movements_df['Tracking'] = movement_tracking_labels(movements_df)
+        movements_df['FormattedType'] = movements_df['movement_type'].replace({
+            'ADMIN_SET': 'Admin: SET', 'ADMIN_IN': 'Admin: ADD', 'ADMIN_OUT': 'Admin: SUBTRACT',
+            'TRANSFER_OUT': 'Transfer: OUT', 'TRANSFER_IN': 'Transfer: IN'
+        })
         
-        display_df = movements_df[['date_time', 'branch_name', 'category', 'item_name', 'FormattedType', 'quantity', 'unit', 'Tracking', 'user_id']]
+        display_df = movements_df[['ts', 'branch_name', 'category', 'item_name', 'FormattedType', 'quantity', 'unit', 'Tracking', 'user_id']].copy()
         display_df.columns = ['Date', 'Branch', 'Category', 'Item', 'Type', 'Qty', 'Unit', 'Tracking', 'User']
-        display_df['Date'] = pd.to_datetime(display_df['Date']).dt.strftime('%m-%d %H:%M')
+        display_df['Date'] = pd.to_datetime(display_df['Date'], unit='s').dt.strftime('%m-%d %H:%M')
         
         st.dataframe(display_df, use_container_width=True, height=400)
         
@@ -2242,7 +6112,7 @@ def show_manager_users():
     st.header("👥 User Management")
     
     # Show current users
-    conn = sqlite3.connect('inventory.db')
+    conn = get_connection()
     users_df = pd.read_sql_query("SELECT username, role, full_name, last_login FROM users ORDER BY role", conn)
     conn.close()
     
@@ -2296,7 +6166,7 @@ def show_manager_users():
                     st.error("❌ Password must be at least 6 characters")
                 else:
                     try:
-                        conn = sqlite3.connect('inventory.db')
+                        conn = get_connection()
                         c = conn.cursor()
                         
                         # Check if exists
@@ -2361,7 +6231,7 @@ def show_manager_users():
                             
                             if update_submitted:
                                 try:
-                                    conn = sqlite3.connect('inventory.db')
+                                    conn = get_connection()
                                     c = conn.cursor()
                                     c.execute("UPDATE users SET full_name = ?, role = ? WHERE username = ?",
                                              (new_full_name, new_role, selected_user))
@@ -2384,7 +6254,7 @@ def show_manager_users():
                         if st.button("🗑️ DELETE USER", type="secondary", use_container_width=True):
                             if st.session_state.get('confirm_delete_user') == selected_user:
                                 try:
-                                    conn = sqlite3.connect('inventory.db')
+                                    conn = get_connection()
                                     c = conn.cursor()
                                     c.execute('DELETE FROM users WHERE username = ?', (selected_user,))
                                     conn.commit()
@@ -2440,7 +6310,7 @@ def show_manager_users():
                                 st.error("❌ Passwords do not match!")
                             else:
                                 try:
-                                    conn = sqlite3.connect('inventory.db')
+                                    conn = get_connection()
                                     c = conn.cursor()
                                     
                                     password_hash = hashlib.sha256(new_temp_password.encode()).hexdigest()
@@ -2498,10 +6368,525 @@ def show_manager_users():
             viewer_count = len(users_df[users_df['role'] == 'viewer'])
             st.metric("👁️ Viewers", viewer_count)
 
+def show_manager_lots():
+    """Manager: Stock lots, expiry and batch traceability"""
+    st.header("🏷️ Lots & Traceability")
+    
+    tab1, tab2, tab3 = st.tabs(["📦 Lots by Item", "⏰ Expiring", "🔍 Trace Batch"])
+    
+    with tab1:
+        branches_df = get_all_branches()
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            selected_branch_id = st.selectbox(
+                "Branch",
+                options=branches_df['id'].tolist(),
+                format_func=lambda x: branches_df[branches_df['id']==x]['branch_name'].iloc[0],
+                key="lots_branch"
+            )
+        
+        items_df = get_items_by_role("warehouse_manager", selected_branch_id)
+        
+        if not items_df.empty:
+            with col2:
+                selected_item = st.selectbox(
+                    "Item",
+                    options=items_df['id'].tolist(),
+                    format_func=lambda x: f"{x} - {items_df[items_df['id']==x]['name'].iloc[0]}",
+                    key="lots_item"
+                )
+            
+            show_empty = st.checkbox("Show empty lots")
+            lots_df = get_item_lots(selected_item, selected_branch_id, show_empty)
+            
+            if not lots_df.empty:
+                item_stock = items_df[items_df['id'] == selected_item]['current_stock'].iloc[0]
+                st.caption(f"Allocation order: **{LOT_ALLOCATION}** · In lots: {lots_df['quantity'].sum():g} · Item stock: {item_stock:g}")
+                display_df = lots_df[['id', 'batch_nr', 'quantity', 'received_quantity', 'received_date', 'expiry_date']].copy()
+                display_df.columns = ['Lot', 'Batch', 'Remaining', 'Received', 'Received Date', 'Expiry']
+                st.dataframe(display_df, use_container_width=True)
+            else:
+                st.info("No lots for this item")
+        else:
+            st.info("No items in this branch")
+    
+    with tab2:
+        days = st.number_input("Expiring within (days)", min_value=1, value=30)
+        expiring_df = get_expiring_lots(days)
+        
+        if not expiring_df.empty:
+            st.warning(f"⚠️ {len(expiring_df)} lots expire within {days} days")
+            display_df = expiring_df[['branch_name', 'item_id', 'item_name', 'batch_nr', 'quantity', 'expiry_date']].copy()
+            display_df.columns = ['Branch', 'Item ID', 'Item', 'Batch', 'Remaining', 'Expiry']
+            st.dataframe(display_df, use_container_width=True)
+        else:
+            st.success("✅ No lots expiring in this window")
+    
+    with tab3:
+        batch_nr = st.text_input("Batch Number", placeholder="e.g. LOT000123")
+        
+        if batch_nr:
+            found_df = find_lots(batch_nr.strip())
+            
+            if found_df.empty:
+                st.info(f"No lots with batch {batch_nr}")
+                return
+            
+            display_df = found_df[['id', 'branch_name', 'item_id', 'item_name', 'quantity', 'received_quantity', 'received_date', 'expiry_date']].copy()
+            display_df.columns = ['Lot', 'Branch', 'Item ID', 'Item', 'Remaining', 'Received', 'Received Date', 'Expiry']
+            st.dataframe(display_df, use_container_width=True)
+            
+            lot_id = st.selectbox("Trace lot", options=found_df['id'].tolist(),
+                                  format_func=lambda x: f"Lot {x} @ {found_df[found_df['id']==x]['branch_name'].iloc[0]}")
+            
+            trace_columns = ['depth', 'relation', 'linked_quantity', 'lot_id', 'item_id', 'item_name', 'branch_name', 'batch_nr', 'remaining']
+            trace_names = ['Level', 'Relation', 'Qty', 'Lot', 'Item ID', 'Item', 'Branch', 'Batch', 'Remaining']
+            
+            col1, col2 = st.columns(2)
+            with col1:
+                st.subheader("⬅️ Came From")
+                backward_df = trace_lot(lot_id, "backward")
+                if not backward_df.empty:
+                    display_df = backward_df[trace_columns].copy()
+                    display_df.columns = trace_names
+                    st.dataframe(display_df, use_container_width=True)
+                else:
+                    st.info("Received directly, no upstream lots")
+            
+            with col2:
+                st.subheader("➡️ Went Into")
+                forward_df = trace_lot(lot_id, "forward")
+                if not forward_df.empty:
+                    display_df = forward_df[trace_columns].copy()
+                    display_df.columns = trace_names
+                    st.dataframe(display_df, use_container_width=True)
+                else:
+                    st.info("Not used in production or transferred yet")
+
+COUNT_STATUS_LABELS = {'over': "⬆️ Over", 'short': "⬇️ Short", 'match': "✅ Match",
+                       'not counted': "⏳ Not counted", 'unknown': "❓ Unknown item"}
+
+def show_count_report(variances, key):
+    """Variance metrics, table and CSV download for one count session"""
+    counted = variances[variances['status'].isin(['over', 'short', 'match'])]
+    off = variances[variances['status'].isin(['over', 'short'])]
+    
+    col1, col2, col3, col4 = st.columns(4)
+    with col1:
+        st.metric("Counted", f"{len(counted)} / {int(variances['frozen_stock'].notna().sum())}")
+    with col2:
+        st.metric("Variances", len(off))
+    with col3:
+        st.metric("Net Value", f"{off['variance_value'].sum():,.2f}")
+    with col4:
+        st.metric("Unknown Items", int((variances['status'] == 'unknown').sum()))
+    
+    show = st.multiselect("Show", options=list(COUNT_STATUS_LABELS), default=['over', 'short', 'unknown'],
+                          format_func=COUNT_STATUS_LABELS.get, key=f"{key}_show")
+    display_df = variances[variances['status'].isin(show)].copy()
+    display_df['status'] = display_df['status'].map(COUNT_STATUS_LABELS)
+    display_df = display_df[['item_id', 'name', 'frozen_stock', 'counted_qty', 'variance', 'variance_value',
+                             'moved_since', 'new_stock', 'status']]
+    display_df.columns = ['ID', 'Item', 'Frozen', 'Counted', 'Variance', 'Value', 'Moved Since', 'New Stock', 'Status']
+    st.dataframe(display_df, use_container_width=True, height=400)
+    
+    st.download_button("📥 Download Variance Report", variances.to_csv(index=False), file_name=f"{key}.csv",
+                       mime="text/csv", key=f"{key}_download")
+
+def show_manager_counts():
+    """Manager: Cycle counts from frozen snapshot to posted adjustments"""
+    st.header("📋 Cycle Counts")
+    
+    tab1, tab2, tab3 = st.tabs(["📝 Open Counts", "➕ New Count", "📜 Posted"])
+    
+    with tab2:
+        branches_df = get_all_branches()
+        
+        with st.form("new_count"):
+            branch_id = st.selectbox("Branch", options=branches_df['id'].tolist(),
+                                     format_func=lambda x: branches_df[branches_df['id']==x]['branch_name'].iloc[0])
+            categories = st.multiselect("Categories (empty for all)", ["Raw Material", "Pre-Final", "Final Product"])
+            reference = st.text_input("Reference", placeholder="e.g. Q3 stock-take, aisle 4")
+            
+            if st.form_submit_button("🧊 Freeze Stock & Start Count", type="primary"):
+                session_id = start_count_session(branch_id, st.session_state.username, reference, categories)
+                st.success(f"✅ Count #{session_id} started; stock is frozen as of now")
+    
+    with tab1:
+        sessions_df = get_count_sessions(status='OPEN')
+        
+        if sessions_df.empty:
+            st.info("No open counts. Start one under '➕ New Count'.")
+        else:
+            session_id = st.selectbox(
+                "Count",
+                options=sessions_df['id'].tolist(),
+                format_func=lambda x: (lambda r: f"#{x} {r['branch_name']} - {r['reference'] or 'no reference'} "
+                                                 f"({r['counted_items']}/{r['snapshot_items']} counted)")(
+                    sessions_df[sessions_df['id'] == x].iloc[0]),
+                key="count_session"
+            )
+            
+            with st.expander("📤 Upload Counted Quantities", expanded=True):
+                st.caption("CSV or Excel with item_id and counted_qty columns. Scanners post batches to /counts/lines.")
+                uploaded = st.file_uploader("Count sheet", type=["csv", "xlsx"], key=f"count_upload_{session_id}")
+                mode = st.radio("Lines already counted", options=["set", "add"], horizontal=True,
+                                format_func=lambda m: {"set": "Replace", "add": "Add to"}[m], key="count_mode")
+                
+                if uploaded is not None and st.button("📥 Record Counts", type="primary"):
+                    try:
+                        sheet = pd.read_csv(uploaded) if uploaded.name.endswith(".csv") else pd.read_excel(uploaded)
+                        stored = record_count_lines(session_id, sheet, st.session_state.username, "upload", mode)
+                        st.success(f"✅ Recorded {stored} count lines")
+                    except ValueError as e:
+                        st.error(f"❌ {e}")
+            
+            variances = get_count_variances(session_id)
+            show_count_report(variances, f"count_{session_id}")
+            
+            col1, col2 = st.columns(2)
+            with col1:
+                confirm = st.checkbox("I have reviewed the variances", key=f"count_confirm_{session_id}")
+                if st.button("✅ Post Adjustments", type="primary", disabled=not confirm, use_container_width=True):
+                    ok, message = post_count_session(session_id, st.session_state.username)
+                    if ok:
+                        st.success(f"✅ {message}")
+                        st.rerun()
+                    else:
+                        st.error(f"❌ {message}")
+            with col2:
+                if st.button("🗑️ Cancel Count", use_container_width=True):
+                    cancel_count_session(session_id, st.session_state.username)
+                    st.rerun()
+    
+    with tab3:
+        posted_df = get_count_sessions(status='POSTED')
+        
+        if posted_df.empty:
+            st.info("No posted counts yet")
+        else:
+            display_df = posted_df[['id', 'branch_name', 'reference', 'posted_at', 'posted_by', 'counted_items',
+                                    'adjusted_items', 'variance_value']]
+            display_df.columns = ['Count', 'Branch', 'Reference', 'Posted', 'By', 'Counted', 'Adjusted', 'Net Value']
+            st.dataframe(display_df, use_container_width=True)
+            
+            report_id = st.selectbox("Report", options=posted_df['id'].tolist(), format_func=lambda x: f"Count #{x}",
+                                     key="posted_count")
+            show_count_report(get_count_variances(report_id), f"count_{report_id}_posted")
+
+def show_manager_reservations():
+    """Manager: Stock promised to orders and planned production"""
+    st.header("📌 Reservations")
+    
+    branches_df = get_all_branches()
+    branch_id = st.selectbox("🏪 Branch", options=branches_df['id'].tolist(),
+                             format_func=lambda x: branches_df[branches_df['id']==x]['branch_name'].iloc[0],
+                             key="reservation_branch")
+    
+    tab1, tab2, tab3 = st.tabs(["📌 Active", "➕ Reserve", "📜 Closed"])
+    
+    with tab1:
+        active_df = get_reservations(branch_id)
+        
+        if active_df.empty:
+            st.info("Nothing is reserved in this branch")
+        else:
+            orders = (active_df.groupby(['reference', 'kind'], as_index=False)
+                               .agg(lines=('item_id', 'count'), quantity=('quantity', 'sum'), created=('created_at', 'min')))
+            col1, col2, col3 = st.columns(3)
+            col1.metric("References", len(orders))
+            col2.metric("Lines", len(active_df))
+            col3.metric("Units Reserved", f"{active_df['quantity'].sum():,.1f}")
+            
+            display_df = active_df[['reference', 'kind', 'item_id', 'item_name', 'quantity', 'unit', 'created_at', 'created_by']]
+            display_df.columns = ['Reference', 'Kind', 'Item ID', 'Item', 'Qty', 'Unit', 'Reserved', 'By']
+            st.dataframe(display_df, use_container_width=True, height=300)
+            
+            reference = st.selectbox("Reference", options=orders['reference'].tolist(), key="reservation_reference")
+            kind = orders.loc[orders['reference'] == reference, 'kind'].iloc[0]
+            col1, col2 = st.columns(2)
+            with col1:
+                # Production reservations are consumed from the Production page
+                if st.button("🚚 Fulfil Order", type="primary", disabled=kind != 'ORDER', use_container_width=True):
+                    ok, message = fulfil_reservations(reference, st.session_state.username)
+                    if ok:
+                        st.success(f"✅ {message}")
+                        st.rerun()
+                    else:
+                        st.error(f"❌ {message}")
+            with col2:
+                if st.button("↩️ Release", use_container_width=True):
+                    released = release_reservations(reference, st.session_state.username)
+                    st.success(f"✅ Released {released} lines")
+                    st.rerun()
+    
+    with tab2:
+        items_df = get_items_by_role("warehouse_manager", branch_id)
+        items_df = items_df[items_df['available_stock'] > 0]
+        
+        if items_df.empty:
+            st.warning("No available stock in this branch")
+        else:
+            with st.form("new_reservation"):
+                reference = st.text_input("Order Reference", placeholder="e.g. SO-1042")
+                lines = st.data_editor(pd.DataFrame({'item_id': pd.Series(dtype=str), 'quantity': pd.Series(dtype=float)}),
+                                       num_rows="dynamic", use_container_width=True,
+                                       column_config={'item_id': st.column_config.SelectboxColumn(
+                                                          "Item", options=items_df['id'].tolist(), required=True),
+                                                      'quantity': st.column_config.NumberColumn("Quantity", min_value=0.0)})
+                
+                if st.form_submit_button("📌 Reserve", type="primary"):
+                    lines = lines.dropna()
+                    if not reference or lines.empty:
+                        st.error("❌ Enter a reference and at least one line")
+                    else:
+                        ok, message = allocate_stock(reference, branch_id, lines[['item_id', 'quantity']].itertuples(index=False),
+                                                     st.session_state.username)
+                        if ok:
+                            st.success(f"✅ {message}")
+                        else:
+                            st.error(f"❌ {message}")
+            
+            st.caption("Available = on hand - reserved")
+            display_df = items_df[['id', 'name', 'current_stock', 'reserved_stock', 'available_stock', 'unit']]
+            display_df.columns = ['ID', 'Item', 'On Hand', 'Reserved', 'Available', 'Unit']
+            st.dataframe(display_df, use_container_width=True, height=300)
+    
+    with tab3:
+        closed_df = pd.concat([get_reservations(branch_id, status, limit=200) for status in ('FULFILLED', 'RELEASED')])
+        
+        if closed_df.empty:
+            st.info("No closed reservations yet")
+        else:
+            display_df = closed_df.sort_values('id', ascending=False)[['reference', 'kind', 'item_name', 'quantity', 'status',
+                                                                       'closed_at', 'closed_by']]
+            display_df.columns = ['Reference', 'Kind', 'Item', 'Qty', 'Status', 'Closed', 'By']
+            st.dataframe(display_df, use_container_width=True, height=400)
+
+def show_manager_jobs():
+    """Manager: Background job status and schedule"""
+    st.header("⏱️ Background Jobs")
+    
+    scheduler = get_job_scheduler()
+    jobs_df = get_scheduled_jobs()
+    
+    if jobs_df.empty:
+        st.info("No background jobs registered")
+        return
+    
+    # Job overview
+    st.subheader("📋 Scheduled Jobs")
+    
+    for _, job in jobs_df.iterrows():
+        running = scheduler.is_active(job['name'])
+        status_icon = "⏳" if running else {"success": "✅", "failed": "❌"}.get(job['last_status'], "⚪")
+        
+        with st.expander(f"{status_icon} {job['description']} ({job['name']})"):
+            col1, col2, col3 = st.columns(3)
+            
+            with col1:
+                st.write(f"**Last Run:** {job['last_run'] or 'Never'}")
+                st.write(f"**Status:** {'running' if running else (job['last_status'] or '-')}")
+            
+            with col2:
+                duration = f"{job['last_duration']:.2f}s" if pd.notna(job['last_duration']) else "-"
+                st.write(f"**Duration:** {duration}")
+                st.write(f"**Next Run:** {job['next_run'] if job['enabled'] else 'Disabled'}")
+            
+            with col3:
+                if st.button("▶️ Run Now", key=f"run_job_{job['name']}", disabled=running, use_container_width=True):
+                    scheduler.submit(job['name'], "manual", st.session_state.username)
+                    st.success(f"✅ Queued {job['name']}")
+                    st.rerun()
+            
+            with st.form(f"job_schedule_{job['name']}"):
+                col1, col2 = st.columns(2)
+                
+                with col1:
+                    interval_minutes = st.number_input("Interval (minutes)", min_value=1,
+                                                       value=max(1, int(job['interval_seconds'] // 60)))
+                
+                with col2:
+                    enabled = st.checkbox("Enabled", value=bool(job['enabled']))
+                
+                if st.form_submit_button("💾 Save Schedule"):
+                    update_job_schedule(job['name'], interval_minutes * 60, enabled)
+                    st.success("✅ Schedule updated")
+                    st.rerun()
+    
+    # Run history
+    st.subheader("📈 Recent Runs")
+    runs_df = get_job_runs()
+    
+    if not runs_df.empty:
+        display_df = runs_df[['job_name', 'trigger', 'status', 'queued_at', 'duration_seconds', 'result', 'error', 'user_id']].copy()
+        display_df.columns = ['Job', 'Trigger', 'Status', 'Queued', 'Duration (s)', 'Result', 'Error', 'User']
+        display_df['Duration (s)'] = display_df['Duration (s)'].round(3)
+        st.dataframe(display_df, use_container_width=True, height=400)
+        
+        # Duration summary
+        finished = runs_df[runs_df['status'] == 'success']
+        if not finished.empty:
+            summary = finished.groupby('job_name')['duration_seconds'].agg(['count', 'mean', 'max']).round(3)
+            summary.columns = ['Runs', 'Avg (s)', 'Max (s)']
+            st.dataframe(summary, use_container_width=True)
+    else:
+        st.info("No job runs yet")
+    
+    # Change feed consumers
+    st.subheader("📡 Change Feed")
+    consumers_df = get_event_consumers()
+    st.caption(f"Latest event: #{get_latest_event_seq()}")
+    
+    if not consumers_df.empty:
+        consumers_df.columns = ['Consumer', 'Last Event', 'Updated', 'Lag']
+        st.dataframe(consumers_df, use_container_width=True)
+    else:
+        st.info("No consumers registered yet")
+    
+    st.subheader("🔏 Audit Log")
+    col1, col2 = st.columns(2)
+    with col1:
+        verify = st.button("🔍 Verify New Rows", use_container_width=True)
+    with col2:
+        verify_full = st.button("🔍 Verify Everything", use_container_width=True)
+    if verify or verify_full:
+        with st.spinner("Verifying audit chains..."):
+            seal_audit_log()
+            results = verify_audit_log(full=verify_full)
+        broken = [r for r in results if not r['ok']]
+        if broken:
+            for r in broken:
+                st.error(f"❌ Branch {r['branch_id']}: chain broken at audit row #{r['broken_at']}")
+        else:
+            st.success(f"✅ {sum(r['rows_checked'] for r in results)} rows verified, all chains intact")
+    
+    audit_df = get_audit_trail(limit=100)
+    if not audit_df.empty:
+        audit_df['sealed'] = audit_df['sealed'].map({1: "🔒", 0: "⏳"})
+        audit_df.columns = ['#', 'Time', 'Branch', 'Event', 'Type', 'Item', 'User', 'Reference', 'Movement', 'Quantity',
+                            'Stock Change', 'Sealed']
+        st.dataframe(audit_df, use_container_width=True, height=300)
+    
+    st.subheader("📲 Scanner Sync")
+    conflicts_df = get_sync_receipts('conflict')
+    if not conflicts_df.empty:
+        st.warning(f"{len(conflicts_df)} scans could not be applied; devices retry them on their next sync")
+        conflicts_df = conflicts_df[['synced_at', 'device_id', 'client_id', 'scan_type', 'item_id', 'branch_id', 'quantity', 'message']]
+        conflicts_df.columns = ['Synced', 'Device', 'Scan ID', 'Type', 'Item', 'Branch', 'Quantity', 'Conflict']
+        st.dataframe(conflicts_df, use_container_width=True)
+    else:
+        st.success("No open scan conflicts")
+
+def get_persisted_metrics(hours):
+    """Per-name percentiles from persisted samples over the last hours"""
+    conn = get_connection()
+    samples_df = pd.read_sql_query("SELECT kind, name, duration_ms, is_error FROM perf_metrics WHERE recorded_at >= ?",
+                                   conn, params=[int(time.time()) - hours * 3600])
+    conn.close()
+    
+    if samples_df.empty:
+        return samples_df
+    
+    grouped = samples_df.groupby(['kind', 'name'])['duration_ms']
+    summary = pd.DataFrame({
+        'count': grouped.count(),
+        'p50_ms': grouped.quantile(0.5),
+        'p95_ms': grouped.quantile(0.95),
+        'max_ms': grouped.max(),
+        'errors': samples_df.groupby(['kind', 'name'])['is_error'].sum()
+    }).reset_index()
+    return summary
+
+def show_manager_performance():
+    """Manager: Query, page and mutator timings"""
+    st.header("📉 Performance")
+    
+    metrics = get_metrics()
+    summary_df = metrics.summary()
+    
+    # Headline metrics
+    col1, col2, col3, col4 = st.columns(4)
+    
+    with col1:
+        st.metric("Statements", int(summary_df[summary_df['kind'] == 'query']['count'].sum()))
+    
+    with col2:
+        st.metric("Page Renders", int(summary_df[summary_df['kind'] == 'page']['count'].sum()))
+    
+    with col3:
+        st.metric("Lock Errors", metrics.lock_errors)
+    
+    with col4:
+        st.metric(f"Writes ≥ {int(LOCK_WAIT_THRESHOLD * 1000)} ms", metrics.slow_writes,
+                  help="Write statements this slow were most likely waiting for the database lock")
+    
+    st.caption(f"📅 Live figures since {metrics.started_at} (last {METRIC_WINDOW} samples per entry for percentiles)")
+    
+    tab1, tab2, tab3, tab4 = st.tabs(["🐢 Slowest Queries", "📄 Pages", "✏️ Mutators", "🗄️ History"])
+    
+    def show_timings(df, label, sort_by='p95_ms', limit=None):
+        if df.empty:
+            st.info(f"No {label} recorded yet")
+            return
+        df = df.sort_values(sort_by, ascending=False)
+        if limit:
+            df = df.head(limit)
+        display_df = df[['name', 'count', 'p50_ms', 'p95_ms', 'max_ms', 'total_ms', 'errors']].round(2)
+        display_df.columns = [label.title(), 'Count', 'p50 (ms)', 'p95 (ms)', 'Max (ms)', 'Total (ms)', 'Errors']
+        st.dataframe(display_df, use_container_width=True, height=400)
+    
+    with tab1:
+        sort_label = st.selectbox("Sort by", ["p95", "Total time", "Count"], key="perf_query_sort")
+        sort_by = {'p95': 'p95_ms', 'Total time': 'total_ms', 'Count': 'count'}[sort_label]
+        show_timings(summary_df[summary_df['kind'] == 'query'], "query", sort_by, limit=25)
+    
+    with tab2:
+        show_timings(summary_df[summary_df['kind'] == 'page'], "page")
+    
+    with tab3:
+        show_timings(summary_df[summary_df['kind'].isin(['mutator', 'writer', 'job'])], "operation")
+        
+        writer_stats = get_stock_writer().stats()
+        if writer_stats['batches']:
+            st.caption(f"✍️ Write queue: {writer_stats['mutations']} mutations in {writer_stats['batches']} group commits "
+                       f"(avg {writer_stats['mutations'] / writer_stats['batches']:.1f}, largest {writer_stats['largest_batch']}, "
+                       f"{writer_stats['queued']} queued)")
+    
+    with tab4:
+        col1, col2 = st.columns([3, 1])
+        
+        with col1:
+            hours = st.selectbox("Window", [1, 24, 168], index=1,
+                                 format_func=lambda h: {1: "Last hour", 24: "Last 24 hours", 168: "Last 7 days"}[h])
+        
+        with col2:
+            if st.button("💾 Flush Now", use_container_width=True):
+                get_job_scheduler().submit('flush_metrics', "manual", st.session_state.username)
+                st.rerun()
+        
+        history_df = get_persisted_metrics(hours)
+        
+        if not history_df.empty:
+            kind_filter = st.selectbox("Kind", ["page", "query", "mutator", "writer", "job"], key="perf_history_kind")
+            kind_df = history_df[history_df['kind'] == kind_filter].sort_values('p95_ms', ascending=False)
+            display_df = kind_df[['name', 'count', 'p50_ms', 'p95_ms', 'max_ms', 'errors']].round(2)
+            display_df.columns = ['Name', 'Count', 'p50 (ms)', 'p95 (ms)', 'Max (ms)', 'Errors']
+            st.dataframe(display_df, use_container_width=True, height=400)
+        else:
+            st.info("No persisted samples in this window yet")
+
 # ===============================
 # MAIN APPLICATION
 # ===============================
 
+@st.cache_resource
+def prepare_database():
+    """Create and migrate the schema once per process instead of on every rerun"""
+    init_database()
+    return True
+
 def main():
     st.set_page_config(
         page_title="🔥 FLAMEBLOCK INVENTORY",
@@ -2537,22 +6922,32 @@ def main():
     </style>
     """, unsafe_allow_html=True)
     
-    # Initialize database
-    init_database()
+    # Initialize database and background jobs, once per process
+    prepare_database()
+    get_job_scheduler()
     
     # Check authentication
     if not st.session_state.get('authenticated', False):
         show_login()
         return
     
-    # Load sample data if needed
-    items_df = get_items_by_role("warehouse_manager")
-    if items_df.empty:
+    # Load sample data if needed; the summary counters answer this without loading any items
+    if get_branch_summary().empty:
         with st.spinner("Loading inventory data..."):
             load_sample_data()
             st.success("✅ Inventory data loaded!")
             st.rerun()
-    
+
+    # Changes made by other users since this session last rendered
+    hub = get_data_hub()
+    last_seen = st.session_state.get('data_generation')
+    if last_seen is not None:
+        others = [c for c in hub.changes_since(last_seen) if c['user_id'] != st.session_state.username]
+        if others:
+            changed_by = sorted({c['user_id'] or 'another process' for c in others})
+            st.toast(f"🔄 Inventory updated by {', '.join(changed_by)}")
+    st.session_state.data_generation = hub.generation
+
     # Header
     col1, col2 = st.columns([3, 1])
     
@@ -2581,61 +6976,85 @@ def main():
                 del st.session_state[key]
             st.rerun()
     
+    # Global search
+    show_global_search(st.session_state.user_role)
+    
     # Navigation and routing
     current_page = show_navigation(st.session_state.user_role)
     
-    # Route to pages
+    # Read-only roles are served from the snapshot copy
+    if st.session_state.user_role in READ_ONLY_ROLES:
+        snapshot = get_snapshot_hub()
+        if snapshot.refreshed_at:
+            st.caption(f"📸 Data as of {datetime.fromtimestamp(snapshot.refreshed_at).strftime('%H:%M:%S')} "
+                       f"(refreshed at most every {SNAPSHOT_MAX_AGE}s)")
+    
+    # Route to pages. Filter-heavy sections are st.fragment functions: their widgets
+    # rerun only that fragment, not this whole script.
     try:
-        # Viewer pages
-        if current_page == "viewer_branches":
-            show_viewer_branches()
-        elif current_page == "viewer_products":
-            show_viewer_products()
-        
-        # Admin pages
-        elif current_page == "admin_dashboard":
-            show_admin_dashboard()
-        elif current_page == "admin_update":
-            show_admin_update()
-        elif current_page == "admin_transfer":
-            show_admin_transfer()
-        elif current_page == "admin_movements":
-            show_admin_movements()
-        
-        # Boss pages
-        elif current_page == "boss_dashboard":
-            show_boss_dashboard()
-        elif current_page == "boss_branches":
-            show_boss_branches()
-        elif current_page == "boss_stock":
-            show_boss_stock()
-        elif current_page == "boss_movements":
-            show_boss_movements()
-        elif current_page == "boss_reports":
-            show_boss_reports()
-        
-        # Manager pages
-        elif current_page == "manager_dashboard":
-            show_manager_dashboard()
-        elif current_page == "manager_branches":
-            show_manager_branches()
-        elif current_page == "manager_stock":
-            show_manager_stock()
-        elif current_page == "manager_transfers":
-            show_manager_transfers()
-        elif current_page == "manager_production":
-            show_manager_production()
-        elif current_page == "manager_bom":
-            show_manager_bom()
-        elif current_page == "manager_items":
-            show_manager_items()
-        elif current_page == "manager_movements":
-            show_manager_movements()
-        elif current_page == "manager_users":
-            show_manager_users()
+        with measure('page', current_page):
+            # Viewer pages
+            if current_page == "viewer_branches":
+                show_viewer_branches()
+            elif current_page == "viewer_products":
+                show_viewer_products()
         
-        else:
-            st.error("Page not found")
+            # Admin pages
+            elif current_page == "admin_dashboard":
+                show_admin_dashboard()
+            elif current_page == "admin_update":
+                show_admin_update()
+            elif current_page == "admin_transfer":
+                show_admin_transfer()
+            elif current_page == "admin_movements":
+                show_admin_movements()
+        
+            # Boss pages
+            elif current_page == "boss_dashboard":
+                show_boss_dashboard()
+            elif current_page == "boss_branches":
+                show_boss_branches()
+            elif current_page == "boss_stock":
+                show_boss_stock()
+            elif current_page == "boss_movements":
+                show_boss_movements()
+            elif current_page == "boss_reports":
+                show_boss_reports()
+        
+            # Manager pages
+            elif current_page == "manager_dashboard":
+                show_manager_dashboard()
+            elif current_page == "manager_branches":
+                show_manager_branches()
+            elif current_page == "manager_stock":
+                show_manager_stock()
+            elif current_page == "manager_transfers":
+                show_manager_transfers()
+            elif current_page == "manager_production":
+                show_manager_production()
+            elif current_page == "manager_bom":
+                show_manager_bom()
+            elif current_page == "manager_items":
+                show_manager_items()
+            elif current_page == "manager_movements":
+                show_manager_movements()
+            elif current_page == "manager_users":
+                show_manager_users()
+            elif current_page == "manager_lots":
+                show_manager_lots()
+            elif current_page == "manager_counts":
+                show_manager_counts()
+            elif current_page == "manager_planning":
+                show_manager_planning()
+            elif current_page == "manager_reservations":
+                show_manager_reservations()
+            elif current_page == "manager_jobs":
+                show_manager_jobs()
+            elif current_page == "manager_performance":
+                show_manager_performance()
+        
+            else:
+                st.error("Page not found")
     
     except Exception as e:
         st.error(f"An error occurred: {str(e)}")
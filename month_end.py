@@ -0,0 +1,176 @@
+"""Month-end reporting for every branch.
+
+Each branch is computed in its own worker process with its own read-only
+SQLite connection, and the results are merged into one Excel workbook:
+
+    python month_end.py --month 2026-09 --output month_end_2026-09.xlsx
+    python month_end.py --month 2026-09 --workers 1    # serial baseline
+
+The boss Reports page runs the same pipeline. Movement sections are
+aggregated through analytics.aggregate_movements, so they are read from the
+columnar mirror when there is one. This module only needs pandas and sqlite3
+(pyarrow for the mirror) so worker processes start without importing Streamlit.
+"""
+
+import argparse
+import io
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+
+import pandas as pd
+
+import analytics
+
+OUT_TYPES = ('OUT', 'ADMIN_OUT')
+SECTIONS = ['consumption', 'production', 'transfers', 'valuation']
+
+# ===============================
+# PER-BRANCH WORK
+# ===============================
+
+def month_bounds(month):
+    """First day of the month and first day of the next, as date strings"""
+    start = datetime.strptime(month, "%Y-%m")
+    end = start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+    return start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
+
+def open_read_only(db_path):
+    """Read-only connection; workers never take the write lock"""
+    return sqlite3.connect(f"file:{os.path.abspath(db_path)}?mode=ro", uri=True)
+
+def compute_branch_month_end(db_path, branch_id, month):
+    """All month-end sections for one branch, returns (branch_id, frames, seconds)"""
+    started = time.perf_counter()
+    start, end = month_bounds(month)
+    conn = open_read_only(db_path)
+
+    names = pd.read_sql_query("SELECT id as item_id, name as item_name, unit FROM items WHERE branch_id = ?", conn,
+                              params=[branch_id])
+
+    def movements(group_by, types, columns):
+        totals = analytics.aggregate_movements(db_path, group_by, start, end, branch_id, types)
+        totals = totals.rename(columns={'value': 'cost', 'movement_type': 'direction'})
+        return totals.merge(names, on='item_id', how='left')[['item_id', 'item_name', 'unit'] + columns]
+
+    frames = {
+        'consumption': movements(['item_id'], OUT_TYPES, ['quantity', 'cost', 'movements']),
+        'production': movements(['item_id'], ('PRODUCTION',), ['quantity', 'cost', 'movements']).rename(
+            columns={'movements': 'runs'}),
+        'transfers': movements(['item_id', 'movement_type', 'other_branch_id'], ('TRANSFER_OUT', 'TRANSFER_IN'),
+                               ['direction', 'other_branch_id', 'quantity', 'cost']),
+        'valuation': pd.read_sql_query('''SELECT i.category, COUNT(*) as items, SUM(i.current_stock) as total_stock,
+                                                 SUM(i.current_stock * i.cost_per_unit) as average_value,
+                                                 SUM(COALESCE(l.fifo_value, 0)) as fifo_value
+                                          FROM items i
+                                          LEFT JOIN (SELECT item_id, SUM(quantity * unit_cost) as fifo_value
+                                                     FROM stock_lots WHERE branch_id = ? AND quantity > 0
+                                                     GROUP BY item_id) l ON l.item_id = i.id
+                                          WHERE i.branch_id = ?
+                                          GROUP BY i.category
+                                          ORDER BY i.category''', conn, params=[branch_id, branch_id])
+    }
+
+    conn.close()
+    return branch_id, frames, time.perf_counter() - started
+
+# ===============================
+# PIPELINE
+# ===============================
+
+def run_month_end(db_path, month, workers=None, output=None):
+    """Compute every active branch in parallel and merge into one workbook.
+
+    output is a path or a file-like object; None returns the workbook bytes.
+    Returns (workbook, stats).
+    """
+    started = time.perf_counter()
+    conn = open_read_only(db_path)
+    branches = pd.read_sql_query("SELECT id, branch_code, branch_name FROM branches WHERE is_active = 1 ORDER BY id", conn)
+    conn.close()
+
+    workers = max(1, min(workers or os.cpu_count() or 1, len(branches)))
+    branch_ids = branches['id'].tolist()
+
+    if workers == 1:
+        results = [compute_branch_month_end(db_path, branch_id, month) for branch_id in branch_ids]
+    else:
+        # spawn: the caller may be a threaded Streamlit server, which must not be forked
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as pool:
+            results = list(pool.map(compute_branch_month_end, [db_path] * len(branch_ids), branch_ids,
+                                    [month] * len(branch_ids)))
+    computed = time.perf_counter() - started
+
+    # Merge per-branch frames into one sheet per section
+    names = branches.set_index('id')['branch_name']
+    merged = {}
+    for section in SECTIONS:
+        parts = [frames[section].assign(branch=names[branch_id]) for branch_id, frames, _ in results if not frames[section].empty]
+        merged[section] = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
+        if not merged[section].empty:
+            merged[section] = merged[section][['branch'] + [c for c in merged[section].columns if c != 'branch']]
+    if not merged['transfers'].empty:
+        merged['transfers']['other_branch'] = merged['transfers']['other_branch_id'].map(names)
+
+    summary = pd.DataFrame({
+        'branch': [names[branch_id] for branch_id, _, _ in results],
+        'consumption_cost': [frames['consumption']['cost'].sum() for _, frames, _ in results],
+        'production_cost': [frames['production']['cost'].sum() for _, frames, _ in results],
+        'transfer_out_cost': [frames['transfers'].loc[frames['transfers']['direction'] == 'TRANSFER_OUT', 'cost'].sum()
+                              for _, frames, _ in results],
+        'transfer_in_cost': [frames['transfers'].loc[frames['transfers']['direction'] == 'TRANSFER_IN', 'cost'].sum()
+                             for _, frames, _ in results],
+        'inventory_value_fifo': [frames['valuation']['fifo_value'].sum() for _, frames, _ in results],
+        'inventory_value_avg': [frames['valuation']['average_value'].sum() for _, frames, _ in results],
+        'seconds': [round(seconds, 3) for _, _, seconds in results]
+    })
+
+    target = output if output is not None else io.BytesIO()
+    with pd.ExcelWriter(target, engine="openpyxl") as writer:
+        summary.to_excel(writer, sheet_name="Summary", index=False)
+        for section in SECTIONS:
+            merged[section].to_excel(writer, sheet_name=section.title(), index=False)
+
+    stats = {
+        'month': month,
+        'branches': len(branch_ids),
+        'workers': workers,
+        'compute_seconds': round(computed, 3),
+        'total_seconds': round(time.perf_counter() - started, 3),
+        'branch_seconds': round(sum(seconds for _, _, seconds in results), 3)
+    }
+    return (target.getvalue() if output is None else output), stats
+
+# ===============================
+# COMMAND LINE
+# ===============================
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Month-end report for every branch")
+    parser.add_argument("--month", default=None, help="YYYY-MM, defaults to the previous month")
+    parser.add_argument("--db", default="inventory.db", help="Inventory database")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: one per core)")
+    parser.add_argument("--output", default=None, help="Workbook path (default: month_end_<month>.xlsx)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    config = parse_args(argv)
+    if config.month is None:
+        first = datetime.now().replace(day=1)
+        config.month = (first.replace(year=first.year - 1, month=12) if first.month == 1
+                        else first.replace(month=first.month - 1)).strftime("%Y-%m")
+    output = config.output or f"month_end_{config.month}.xlsx"
+
+    if not os.path.exists(config.db):
+        sys.exit(f"Database not found: {config.db}")
+
+    _, stats = run_month_end(config.db, config.month, config.workers, output)
+    print(f"Month end {stats['month']}: {stats['branches']} branches on {stats['workers']} workers "
+          f"in {stats['compute_seconds']}s (branch work {stats['branch_seconds']}s), written to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+import logging
+import os
+import sys
+
+import pytest
+import streamlit as st
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import inventory_app as app
+
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """A fresh database with the sample branches, users and items; cached writers and hubs start over"""
+    monkeypatch.setattr(app, "DB_PATH", str(tmp_path / "inventory.db"))
+    st.cache_resource.clear()
+    app.init_database()
+    yield app.DB_PATH
+    st.cache_resource.clear()
+
+@pytest.fixture
+def stocked(db):
+    """An item with 10 units in branch 1, returns (item_id, from_branch_id, to_branch_id)"""
+    app.add_item("T1", "Test item", "Final Product", "pcs", 0, 0, 1, "admin")
+    app.update_stock("T1", 1, 10, "IN", unit_cost=2.0)
+    return "T1", 1, 2
@@ -0,0 +1,70 @@
+import base64
+import http.client
+import json
+import threading
+
+import pytest
+
+import api_server
+import inventory_app as app
+
+VIEWER = "viewer:viewer123"
+MANAGER = "warehouse_manager:manager123"
+
+FULL_READ_ROUTES = ["/reservations", "/shipments", "/in-transit", "/counts/variances?session_id=1", "/schedule",
+                    "/mrp", "/analytics/movements"]
+
+@pytest.fixture
+def api(db):
+    """A running API server on a free port, returns a call(credentials, method, path, body) helper"""
+    server = api_server.serve(port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def call(credentials, method, path, body=None):
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=10)
+        conn.request(method, path, body=json.dumps(body) if body is not None else None,
+                     headers={"Authorization": "Basic " + base64.b64encode(credentials.encode()).decode()})
+        response = conn.getresponse()
+        payload = json.loads(response.read() or b"null")
+        conn.close()
+        return response.status, payload
+
+    yield call
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def raw_and_final(db):
+    """One movement on a raw material and one on a final product in branch 1"""
+    app.add_item("RAW1", "Raw", "Raw Material", "kg", 0, 0, 1, "admin")
+    app.add_item("FIN1", "Final", "Final Product", "pcs", 0, 0, 1, "admin")
+    app.update_stock("RAW1", 1, 5, "IN", reference="raw delivery")
+    app.update_stock("FIN1", 1, 5, "IN", reference="final delivery")
+    return "RAW1", "FIN1"
+
+def test_viewer_movements_are_final_products_only(api, raw_and_final):
+    raw, final = raw_and_final
+    status, movements = api(VIEWER, "GET", "/movements?limit=1000")
+    assert status == 200
+    assert final in {m['item_id'] for m in movements} and raw not in {m['item_id'] for m in movements}
+    _, movements = api(MANAGER, "GET", "/movements?limit=1000")
+    assert raw in {m['item_id'] for m in movements}
+
+def test_viewer_events_are_final_products_only(api, raw_and_final):
+    raw, final = raw_and_final
+    status, events = api(VIEWER, "GET", "/events?after=0&limit=1000")
+    assert status == 200
+    assert final in {e['item_id'] for e in events} and raw not in {e['item_id'] for e in events}
+    _, events = api(MANAGER, "GET", "/events?after=0&limit=1000")
+    assert raw in {e['item_id'] for e in events}
+
+@pytest.mark.parametrize("path", FULL_READ_ROUTES)
+def test_viewer_cannot_read_routes_covering_every_item(api, path):
+    assert api(VIEWER, "GET", path)[0] == 403
+    assert api(MANAGER, "GET", path)[0] in (200, 404)
+
+def test_movement_checks_stock_and_item(api, raw_and_final):
+    raw, _ = raw_and_final
+    assert api(MANAGER, "POST", "/movements", {"item_id": raw, "branch_id": 1, "quantity": 50, "movement_type": "OUT"})[0] == 409
+    assert api(MANAGER, "POST", "/movements", {"item_id": "NOPE", "branch_id": 1, "quantity": 1})[0] == 404
+    assert api(VIEWER, "POST", "/movements", {"item_id": raw, "branch_id": 1, "quantity": 1})[0] == 403
@@ -0,0 +1,23 @@
+import sqlite3
+from datetime import date
+
+import inventory_app as app
+
+def test_empty_fit_advances_the_watermark(db):
+    first = app.fit_demand_forecast(through=date(2026, 3, 1))
+    assert first['series'] == 0 and first['days'] == app.FORECAST_HISTORY_DAYS
+    second = app.fit_demand_forecast(through=date(2026, 3, 2))
+    assert second['days'] == 1 and second['fitted_through'] == '2026-03-02'
+    again = app.fit_demand_forecast(through=date(2026, 3, 2))
+    assert again['days'] == 0
+
+def test_watermark_is_seeded_from_existing_rows(db):
+    conn = sqlite3.connect(db)
+    conn.execute("DELETE FROM demand_forecast_state")
+    conn.execute("INSERT INTO demand_forecast (branch_id, item_id, fitted_through, recent) VALUES (1, 'T1', '2026-03-01', ?)",
+                 (bytes(8 * app.FORECAST_WINDOW),))
+    conn.commit()
+    conn.close()
+    app.init_database()
+    stats = app.fit_demand_forecast(through=date(2026, 3, 3))
+    assert stats['days'] == 2
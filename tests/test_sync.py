@@ -0,0 +1,53 @@
+import sqlite3
+
+import inventory_app as app
+
+def query(db, sql, params=()):
+    conn = sqlite3.connect(db)
+    rows = conn.execute(sql, params).fetchall()
+    conn.close()
+    return rows
+
+def transfer(client_id, item_id, source, destination, quantity=3):
+    return {'client_id': client_id, 'type': 'TRANSFER', 'item_id': item_id, 'branch_id': source,
+            'to_branch_id': destination, 'quantity': quantity}
+
+def test_sync_transfer_dispatches_a_shipment(db, stocked):
+    item_id, source, destination = stocked
+    [result] = app.sync_scans("scanner-1", [transfer("t-1", item_id, source, destination)], "warehouse_manager")
+    assert result['status'] == 'applied' and "Shipment #" in result['message']
+    # The source is debited now; the destination only when the shipment is received
+    assert query(db, "SELECT branch_id, current_stock FROM branch_stock WHERE item_id = ? ORDER BY branch_id",
+                 (item_id,)) == [(source, 7), (destination, 0)]
+    assert query(db, "SELECT quantity FROM in_transit WHERE item_id = ?", (item_id,)) == [(3,)]
+    assert query(db, "SELECT status FROM shipments") == [('IN_TRANSIT',)]
+
+def test_sync_transfer_resent_is_not_dispatched_twice(db, stocked):
+    item_id, source, destination = stocked
+    scan = transfer("t-1", item_id, source, destination)
+    app.sync_scans("scanner-1", [scan], "warehouse_manager")
+    [result] = app.sync_scans("scanner-1", [scan], "warehouse_manager")
+    assert result['status'] == 'duplicate'
+    assert query(db, "SELECT COUNT(*) FROM shipments") == [(1,)]
+
+def test_sync_transfer_to_unknown_branch_conflicts(db, stocked):
+    item_id, source, _ = stocked
+    [result] = app.sync_scans("scanner-1", [transfer("t-1", item_id, source, 999)], "warehouse_manager")
+    assert result['status'] == 'conflict'
+    assert query(db, "SELECT COUNT(*) FROM branch_stock WHERE branch_id = 999") == [(0,)]
+    assert query(db, "SELECT COUNT(*) FROM shipments") == [(0,)]
+
+def test_sync_transfer_within_one_branch_conflicts(db, stocked):
+    item_id, source, _ = stocked
+    [result] = app.sync_scans("scanner-1", [transfer("t-1", item_id, source, source)], "warehouse_manager")
+    assert result['status'] == 'conflict'
+    assert query(db, "SELECT COUNT(*) FROM stock_movements WHERE movement_type LIKE 'TRANSFER%'") == [(0,)]
+    assert query(db, "SELECT current_stock FROM branch_stock WHERE item_id = ?", (item_id,)) == [(10,)]
+
+def test_sync_out_leaves_reserved_stock(db, stocked):
+    item_id, source, _ = stocked
+    app.allocate_stock("ORD-1", source, [(item_id, 8)], "admin")
+    results = app.sync_scans("scanner-1", [{'client_id': 'o-1', 'type': 'OUT', 'item_id': item_id, 'branch_id': source, 'quantity': 5},
+                                           {'client_id': 'o-2', 'type': 'OUT', 'item_id': item_id, 'branch_id': source, 'quantity': 2}],
+                             "warehouse_manager")
+    assert [result['status'] for result in results] == ['conflict', 'applied']
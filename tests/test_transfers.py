@@ -0,0 +1,39 @@
+import sqlite3
+
+import pytest
+
+import inventory_app as app
+
+def stock(db, item_id):
+    conn = sqlite3.connect(db)
+    rows = dict(conn.execute("SELECT branch_id, current_stock FROM branch_stock WHERE item_id = ?", (item_id,)).fetchall())
+    conn.close()
+    return rows
+
+def test_correction_moves_stock_in_one_step(db, stocked):
+    item_id, source, destination = stocked
+    ok, _ = app.transfer_stock_between_branches(item_id, source, destination, 4, "CORRECTION: test", user_id="admin")
+    assert ok
+    assert stock(db, item_id) == {source: 6, destination: 4}
+
+def test_correction_rejects_same_branch(db, stocked):
+    item_id, source, _ = stocked
+    ok, message = app.transfer_stock_between_branches(item_id, source, source, 4, user_id="admin")
+    assert not ok and "differ" in message
+    assert stock(db, item_id) == {source: 10}
+
+def test_correction_rejects_unknown_destination(db, stocked):
+    item_id, source, _ = stocked
+    ok, message = app.transfer_stock_between_branches(item_id, source, 999, 4, user_id="admin")
+    assert not ok and "999" in message
+    assert stock(db, item_id) == {source: 10}
+
+def test_correction_tolerates_rounding_but_not_shortage(db, stocked):
+    item_id, source, destination = stocked
+    assert not app.transfer_stock_between_branches(item_id, source, destination, 11, user_id="admin")[0]
+    assert app.transfer_stock_between_branches(item_id, source, destination, 10 + 1e-12, user_id="admin")[0]
+
+def test_shipment_rejects_unknown_destination(db, stocked):
+    item_id, source, _ = stocked
+    with pytest.raises(ValueError, match="999"):
+        app.dispatch_shipment(source, 999, [(item_id, 1)], user_id="admin")